@@ -17,6 +17,7 @@ from colorama import Fore
 import gleam.main
 import gleam.read_files as rf
 import gleam.constants as c
+import gleam.kernels as kernels
 
 warnings.filterwarnings("ignore")
 
@@ -101,8 +102,29 @@ def find_source_properties(find_spectra, targets):
         yield (spectrum_file, target)
 
 
+def find_sources(path, spectra):
+    """
+    Find the spectra of a project and their properties in the metadata files
+    Input:
+        path: path to recursively look for metadata files and spectra
+        spectra: filter for spectra file paths, or None for all the spectra in
+                 path
+    Return:
+        list of unique combinations of spectrum and its corresponding properties
+    """
+    # Find all the metadata files as the targets inside them
+    targets = Targets(f"{path}/**/meta.*")
+
+    # Find all the spectrum files
+    if spectra is None:
+        spectra = f"{path}/**/spec1d*fits"
+    find_spectra = sorted(glob.glob(f"{spectra}", recursive=True))
+
+    return list(find_source_properties(find_spectra, targets))
+
+
 # Define command line arguments
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option("--path", default=".", help='Path to recursively look for metadata files and spectra. See --spectra for overrides.')
 @click.option("--spectra", help='Filter for spectra file paths. e.g. "./**/spec1d.Cosmos.Keck.P1.*.fits" to select all sources in the Cosmos sample observed with Keck in pointing P1.')
 @click.option("--config", default="gleamconfig.yaml", help='Configuration file in YAML format.')
@@ -111,30 +133,96 @@ def find_source_properties(find_spectra, targets):
 @click.option("--verbose", is_flag=True, help='Print full output from LMFIT.')
 @click.option("--bin", default=1, help='Bin the spectrum before fitting.')
 @click.option("--nproc", default=8, type=int, help='Number of threads.')
-def pipeline(path, spectra, config, plot, inspect, verbose, bin, nproc):
+@click.option("--batch", default=1, type=int, help='Number of sources fit together as a batch. Line groups fit with the native engine are fit in all the sources of a batch at once.')
+@click.option("--pack", help='Fit the spectra in a pack made by "gleam pack", instead of the spectra and metadata files. --spectra filters the paths of the original spectrum files.')
+@click.option("--plan", "coverage", is_flag=True, help='Before reading the spectra, plan which groups of lines each spectrum covers from its range of wavelengths, and skip the sources that cover none. Not used with --plot.')
+@click.pass_context
+def pipeline(
+    ctx, path, spectra, config, plot, inspect, verbose, bin, nproc, batch, pack, coverage
+):
+    # Run a subcommand, e.g. gleam pack, instead of the fitting
+    if ctx.invoked_subcommand is not None:
+        return
+
     # Read configuration file
     config = c.read_config(config)
 
-    # Find all the metadata files as the targets inside them
-    targets = Targets(f"{path}/**/meta.*")
+    # Tabulate the luminosity distances of the project cosmology once, before
+    # the worker processes are started, so that they all share the table
+    c.distance_table((config.cosmology or c.Cosmology()).cosmo)
+
+    # Likewise, check the numba kernels against the numpy code only once
+    if "numba" in config.kernels:
+        kernels.check()
+
+    # Make a list of all sources with their properties, from the files of the
+    # project or from its pack
+    if pack is None:
+        sources = find_sources(path, spectra)
+    else:
+        sources = rf.open_pack(pack).sources(spectra)
+
+    # If requested and unless the spectra are plotted, plan which groups of
+    # lines each spectrum covers from its range of wavelengths alone, and skip
+    # the sources with nothing to fit
+    if plot or not coverage:
+        plan = [None] * len(sources)
+    else:
+        plan = gleam.main.plan_coverage(sources, config)
+        for (_, target), groups in zip(sources, plan):
+            if not groups.any():
+                print(
+                    Fore.YELLOW
+                    + f'Warning: no emission lines covered on {target["Sample"]} '
+                    + f'in {target["Setup"]} + {target["Pointing"]} '
+                    + f'on source {target["SourceNumber"]} '
+                    + f'at z={target["Redshift"]:1.3f}. Skipping.'
+                )
+        sources = [source for source, groups in zip(sources, plan) if groups.any()]
+        plan = [groups for groups in plan if groups.any()]
 
-    # Find all the spectrum files
-    if spectra is None:
-        spectra = f"{path}/**/spec1d*fits"
-    find_spectra = sorted(glob.glob(f"{spectra}", recursive=True))
+    # Set up multithread processing as executing the fitting on different
+    # sources is trivially parallelizable
+    nproc = 1 if inspect else nproc
+
+    # Fit the sources in batches, where the same group of lines is fit in all
+    # the sources of a batch at once
+    if batch > 1:
+        batches = (
+            (sources[i : i + batch], plan[i : i + batch])
+            for i in range(0, len(sources), batch)
+        )
+        with Pool(nproc) as p:
+            p.starmap(
+                gleam.main.run_batch,
+                (
+                    (sources_batch, inspect, plot, verbose, bin, config, groups)
+                    for sources_batch, groups in batches
+                ),
+            )
+        return
 
-    # Make a list of all sources with their properties
     unique_sources = (
-        (*unique_source, inspect, plot, verbose, bin, config)
-        for unique_source in find_source_properties(find_spectra, targets)
+        (*unique_source, inspect, plot, verbose, bin, config, groups)
+        for unique_source, groups in zip(sources, plan)
     )
 
-    # Set up multithread processing as executing the fitting on different
-    # sources is trivially parallelizable
-    nproc = 1 if inspect else nproc
     with Pool(nproc) as p:
         p.starmap(gleam.main.run_main, unique_sources)
 
 
+@pipeline.command()
+@click.option("--path", default=".", help='Path to recursively look for metadata files and spectra.')
+@click.option("--spectra", help='Filter for spectra file paths, as for gleam.')
+@click.option("--output", default="gleampack.fits", help='Pack file. If it exists, the spectra of new sources are appended to it.')
+def pack(path, spectra, output):
+    """
+    Pack the spectra of a project, with the properties of their targets, into
+    a single file to fit from with gleam --pack.
+    """
+    added = rf.pack_spectra(find_sources(path, spectra), output)
+    print(f"Packed {added} spectra into {output}.")
+
+
 if __name__ == "__main__":
     pipeline()
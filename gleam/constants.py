@@ -7,19 +7,32 @@ __version__ = "0.1"
 
 import yaml
 from dataclasses import replace, asdict, is_dataclass, field, dataclass as dat
-from typing import Dict, Optional, List, Union, Literal, NamedTuple
+from typing import Dict, Optional, List, Union, Literal, NamedTuple, Tuple
 import operator
 import functools
 
 
+import numpy as np
 from pydantic.dataclasses import dataclass
 from astropy import units as u
 from astropy.table import QTable
 from astropy.cosmology import FlatLambdaCDM
 from colorama import Fore
 
+import gleam.spectra_operations as so
+
 AllLines = Literal["all"]
-CenterConstraint = Literal["free", "constrained", "fixed"]
+CenterConstraint = Literal["free", "constrained", "fixed", "auto"]
+SigmaConstraint = Literal["free", "fixed"]
+Kinematics = Literal["independent", "tied"]
+# Flux ratio of a line to a reference line: (reference line, ratio)
+LineRatio = Tuple[str, float]
+Engine = Literal["lmfit", "native"]
+Selection = Literal["exhaustive", "backward"]
+Precision = Literal["double", "single"]
+Kernels = Literal["numpy", "numba"]
+Continuum = Literal["local", "global"]
+ResampleGrid = Literal["none", "log", "velocity", "rest"]
 
 
 class Quantity(u.SpecificTypeQuantity):
@@ -56,6 +69,15 @@ class Length(Quantity):
     _equivalent_unit = u.m
 
 
+class Velocity(Quantity):
+    _equivalent_unit = u.m / u.s
+
+
+# Width of the pixels of a resampling grid: in dex, as a velocity or as a
+# restframe length
+ResampleStep = Union[Velocity, Length, float]
+
+
 class Frequency(Quantity):
     _equivalent_unit = (1 / u.s).unit
 
@@ -123,6 +145,62 @@ class Cosmology:
         return FlatLambdaCDM(H0=self.H0, Om0=self.Om0, Tcmb0=self.Tcmb0)
 
 
+@dat(frozen=True)
+class DistanceTable:
+    """
+    Luminosity distances of a cosmology, tabulated once on a grid uniform in
+    log(1+z) and interpolated linearly. The grid is refined until the 
+    interpolation error is below rtol halfway between all nodes; redshifts 
+    outside the grid are computed exactly.
+    """
+
+    cosmo: FlatLambdaCDM
+    log_z: np.ndarray
+    # D_L / z in Mpc, which is smooth down to z = 0
+    distance: np.ndarray
+
+    @staticmethod
+    def from_cosmology(cosmo, z_max=20.0, rtol=1e-6, n=256) -> "DistanceTable":
+        while True:
+            log_z = np.linspace(0.0, np.log1p(z_max), n + 1)
+            z = np.expm1(log_z)
+            distance = np.empty(n + 1)
+            distance[0] = cosmo.hubble_distance.to_value(u.Mpc)
+            distance[1:] = cosmo.luminosity_distance(z[1:]).to_value(u.Mpc) / z[1:]
+            table = DistanceTable(cosmo=cosmo, log_z=log_z, distance=distance)
+            z_half = np.expm1((log_z[1:] + log_z[:-1]) / 2.0)
+            exact = cosmo.luminosity_distance(z_half).to_value(u.Mpc)
+            if np.max(np.abs(table(z_half).to_value(u.Mpc) / exact - 1.0)) < rtol:
+                return table
+            n *= 2
+
+    def __call__(self, z):
+        """
+        Luminosity distance at redshift(s) z
+        """
+        z = np.asarray(z, dtype=float)
+        inside = (z >= 0) & (z <= np.expm1(self.log_z[-1]))
+        log_z = np.log1p(np.where(inside, z, 0.0))
+        distance = z * np.interp(log_z, self.log_z, self.distance)
+        if not np.all(inside):
+            exact = self.cosmo.luminosity_distance(np.where(inside, 0.0, z))
+            distance = np.where(inside, distance, exact.to_value(u.Mpc))
+        return distance * u.Mpc
+
+
+@functools.lru_cache(maxsize=None)
+def tabulate_distances(H0, Om0, Tcmb0) -> DistanceTable:
+    return DistanceTable.from_cosmology(FlatLambdaCDM(H0=H0, Om0=Om0, Tcmb0=Tcmb0))
+
+
+def distance_table(cosmo) -> DistanceTable:
+    """
+    Table of the luminosity distances of a flat LambdaCDM cosmology, built 
+    once per process for each set of cosmological parameters
+    """
+    return tabulate_distances(cosmo.H0.value, cosmo.Om0, cosmo.Tcmb0.value)
+
+
 @dataclass
 class FittingParametersOverrides:
     """
@@ -137,6 +215,20 @@ class FittingParametersOverrides:
     mask_width: Optional[Length] = None
     cont_width: Optional[Length] = None
     center: Optional[CenterConstraint] = None
+    sigma: Optional[SigmaConstraint] = None
+    engine: Optional[Engine] = None
+    selection: Optional[Selection] = None
+    kinematics: Optional[Kinematics] = None
+    ratios: Optional[Dict[str, LineRatio]] = None
+    prescreen: Optional[float] = None
+    parallel: Optional[bool] = None
+    coarse: Optional[int] = None
+    max_nfev: Optional[int] = None
+    group_timeout: Optional[float] = None
+    source_timeout: Optional[float] = None
+    precision: Optional[Precision] = None
+    kernels: Optional[Kernels] = None
+    continuum: Optional[Continuum] = None
 
 
 @dataclass
@@ -152,6 +244,43 @@ class FittingParameters:
     mask_width: Length = 20 * u.Angstrom
     cont_width: Length = 70 * u.Angstrom
     center: CenterConstraint = "free"
+    sigma: SigmaConstraint = "free"
+    engine: Engine = "lmfit"
+    selection: Selection = "exhaustive"
+    kinematics: Kinematics = "independent"
+    ratios: Dict[str, LineRatio] = field(default_factory=dict)
+    prescreen: Optional[float] = None
+    parallel: bool = False
+    coarse: Optional[int] = None
+    max_nfev: Optional[int] = None
+    group_timeout: Optional[float] = None
+    source_timeout: Optional[float] = None
+    precision: Precision = "double"
+    kernels: Kernels = "numpy"
+    continuum: Continuum = "local"
+
+
+@dataclass
+class ResamplingParametersOverrides:
+    """
+    Class to hold overrides for the resampling of the spectra. If no overrides
+    are set, then the parameters are set to the defaults in the 
+    ResamplingParameters class.
+    """
+
+    grid: Optional[ResampleGrid] = None
+    step: Optional[ResampleStep] = None
+
+
+@dataclass
+class ResamplingParameters:
+    """
+    Grid onto which the spectra are resampled before fitting. By default, the
+    spectra are not resampled.
+    """
+
+    grid: ResampleGrid = "none"
+    step: Optional[ResampleStep] = None
 
 
 @dataclass
@@ -169,6 +298,7 @@ class ConfigOverrides:
     resolution: Optional[Length] = None
     lines: Union[AllLines, None, List[str]] = None
     fitting: Optional[FittingParametersOverrides] = None
+    resample: Optional[ResamplingParametersOverrides] = None
 
 
 @dataclass
@@ -183,6 +313,7 @@ class Config:
     mask_sky: bool = False
     lines: Union[AllLines, List[str]] = "all"
     fitting: FittingParameters = FittingParameters()
+    resample: ResamplingParameters = ResamplingParameters()
     cosmology: Cosmology = Cosmology()
 
     @property
@@ -234,6 +365,19 @@ class Config:
             if self.mask_sky is False:
                 return None
 
+    @property
+    def sky_bands(self):
+        """
+        Return the sky regions of sky_list compiled into sorted, disjoint bands
+        in the observed frame, or None if not masking is necessary. The sky 
+        table is only read and compiled once per project.
+        Output:
+            so.SkyBands
+        """
+        if self.sky is None or self.mask_sky is not True:
+            return self.sky_list
+        return so.read_sky(self.sky)
+
 
 @dataclass
 class Constants:
@@ -269,6 +413,22 @@ class Constants:
 
         return Config(**extra)
 
+    @property
+    def kernels(self):
+        """
+        Kernels requested by the configuration, globally or for any setup or
+        source
+        """
+        fittings = [
+            overrides.fitting
+            for overrides in [self.globals, *self.setups.values(), *self.sources.values()]
+        ]
+        return {
+            fitting.kernels
+            for fitting in fittings
+            if fitting is not None and fitting.kernels is not None
+        }
+
 
 def read_config(config_file) -> Constants:
     """
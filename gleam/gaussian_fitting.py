@@ -3,16 +3,20 @@ __version__ = "0.1"
 
 import os, sys
 import random
-from typing import List, Union, Iterable
+import time
+from typing import List, Union, Iterable, Optional
+import dataclasses
 from dataclasses import dataclass
 from typing import TypeVar, Generic
 import itertools
+from contextlib import contextmanager
+from typing import Callable
 
 import numpy as np
 import astropy
 from astropy import units as u
 from astropy import constants as const
-from astropy.table import QTable, Column, hstack
+from astropy.table import QTable, Table, MaskedColumn
 from astropy.units.quantity import Quantity as Qty
 from colorama import Fore
 from colorama import init
@@ -24,7 +28,8 @@ from lmfit.model import ModelResult
 
 import gleam.plot_gaussian as pg
 import gleam.spectra_operations as so
-from gleam.constants import Length
+import gleam.native_fitting as nf
+from gleam.constants import Length, distance_table
 
 Qty = astropy.units.quantity.Quantity
 
@@ -54,6 +59,10 @@ class RandomVariable:
         """ other * self """
         return self * other
 
+    def __add__(self, other):
+        """ self + other, for an exactly known other """
+        return RandomVariable(value=self.value + other, error=self.error)
+
 
 @dataclass
 class Line:
@@ -67,6 +76,8 @@ class Line:
     z: float
     cosmo: FlatLambdaCDM
     resolution: Length
+    center_constraint: Optional[str] = None
+    flag: Optional[str] = None
 
     @property
     def flux(self):
@@ -76,7 +87,7 @@ class Line:
     @property
     def luminosity(self):
         # Line luminosity
-        ld = self.cosmo.luminosity_distance(self.z).to(10 ** 28 * u.cm)
+        ld = distance_table(self.cosmo)(self.z).to(10 ** 28 * u.cm)
         v = 4.0 * np.pi * ld ** 2 * self.flux.value
         e = 4.0 * np.pi * ld ** 2 * self.flux.error
         return RandomVariable(v, e)
@@ -115,206 +126,62 @@ class Line:
 
     @property
     def velocity_fwhm(self):
-        # Deconvolved velocity fwhm
-        # Observed resolution at the restframe wavelength
-        if (self.fwhm.value ** 2.0 - self.resolution ** 2.0) < 0:
-            return RandomVariable(value=np.nan * u.km / u.s, error=np.nan * u.km / u.s)
-        else:
-            eff_fwhm = np.sqrt(self.fwhm.value ** 2.0 - self.resolution ** 2.0)
-            v = const.c.to("km/s") * eff_fwhm / self.restwl
-            e = const.c.to("km/s") * self.fwhm.error / self.restwl
-            return RandomVariable(value=v, error=e)
-
-    def as_fits_table(self, line: QTable) -> QTable:
-        """ 
-        Writes out the results of all the line fits for a single emission line 
-        (either stand alone or one that was part of a doublet, triplet etc), for
-        a particular source using astropy
-        Input:
-            self: emission line fit parameters
-            line: lab properties of the fitted emission line
-        Return: 
-            Fits table with all the lab and measured properties of a particular
-            emission line
-        """
-        t = QTable()
-        # Vacuum/laboratory properties of the line
-        t = hstack([t, line])
-
-        # Source properties
-        t["z"] = Column(
-            [self.z], dtype="f", description="Source redshift, from specpro"
-        )
-
-        # Redshift calculated from the line
-        t["zline"] = Column(
-            [self.z_line.value.value],
-            dtype="f",
-            unit=self.z_line.value.unit,
-            description="Redshift calculated from this emission line",
-        )
-        t["zline_err"] = Column(
-            [self.z_line.error.value],
-            dtype="f",
-            unit=self.z_line.error.unit,
-            description="Error on the redshift calculated from this emission line",
-        )
-        # Redshift offset calculated between the line redshift and the redshift from
-        # specpro
-        t["zoffset"] = Column(
-            [self.z_offset.value.value],
-            dtype="f",
-            unit=self.z_offset.value.unit,
-            description="Redshift offset between line and specpro redshift",
-        )
-        t["zoffset_err"] = Column(
-            [self.z_offset.error.value],
-            dtype="f",
-            unit=self.z_offset.error.unit,
-            description="Error on the redshift offset",
-        )
-
-        # Line fits
-        # Continuum around line
-        t["cont"] = Column(
-            [self.continuum.value.value],
-            dtype="f",
-            unit=self.continuum.value.unit,
-            description="Continuum around line, Gaussian fit",
-        )
-        t["cont_err"] = Column(
-            [self.continuum.error.value],
-            dtype="f",
-            unit=self.continuum.error.unit,
-            description="Error on continuum around line, Gaussian fit",
-        )
-        # Gaussian fit
-        t["wl"] = Column(
-            [self.wavelength.value.value],
-            dtype="f",
-            unit=self.wavelength.value.unit,
-            description="Restframe wavelength, Gaussian fit",
-        )
-        t["wl_err"] = Column(
-            [self.wavelength.error.value],
-            dtype="f",
-            unit=self.wavelength.error.unit,
-            description="Error on restframe wavelength, Gaussian fit",
-        )
-        t["height"] = Column(
-            [self.height.value.value],
-            dtype="f",
-            unit=self.height.value.unit,
-            description="Height, Gaussian fit",
-        )
-        t["height_err"] = Column(
-            [self.height.error.value],
-            dtype="f",
-            unit=self.height.error.unit,
-            description="Error on height, Gaussian fit",
-        )
-        t["sigma"] = Column(
-            [self.sigma.value.value],
-            dtype="f",
-            unit=self.sigma.value.unit,
-            description="Sigma, Gaussian fit",
-        )
-        t["sigma_err"] = Column(
-            [self.sigma.error.value],
-            dtype="f",
-            unit=self.sigma.error.unit,
-            description="Error on sigma, Gaussian fit",
-        )
-        t["amplitude"] = Column(
-            [self.amplitude.value.value],
-            dtype="f",
-            unit=self.amplitude.value.unit,
-            description="Amplitude, Gaussian fit",
-        )
-        t["amplitude_err"] = Column(
-            [self.amplitude.error.value],
-            dtype="f",
-            unit=self.amplitude.error.unit,
-            description="Error on amplitude, Gaussian fit",
-        )
-        # Flux
-        t["flux"] = Column(
-            [self.flux.value.value],
-            dtype="f",
-            unit=self.flux.value.unit,
-            description="Line flux, Gaussian fit",
-        )
-        t["flux_err"] = Column(
-            [self.flux.error.value],
-            dtype="f",
-            unit=self.flux.error.unit,
-            description="Error on line flux, Gaussian fit",
-        )
-        # Luminosity
-        t["luminosity"] = Column(
-            [self.luminosity.value.value],
-            dtype="f",
-            unit=self.luminosity.value.unit,
-            description="Line luminosity, Gaussian fit",
-        )
-        t["luminosity_err"] = Column(
-            [self.luminosity.error.value],
-            dtype="f",
-            unit=self.luminosity.error.unit,
-            description="Error on line luminosity, Gaussian fit",
-        )
-        # Equivalent width
-        t["EWrest"] = Column(
-            [self.ew_rest.value.value],
-            dtype="f",
-            unit=self.ew_rest.value.unit,
-            description="Restframe line equivalent width, Gaussian fit",
-        )
-        t["EWrest_err"] = Column(
-            [self.ew_rest.error.value],
-            dtype="f",
-            unit=self.ew_rest.error.unit,
-            description="Error on the restframe equivalent width, Gaussian fit",
-        )
-
-        # FWHM of the line
-        t["FWHM"] = Column(
-            [self.fwhm.value.value],
-            dtype="f",
-            unit=self.fwhm.value.unit,
-            description="Restframe FWHM, not deconvolved",
-        )
-        t["FWHM_err"] = Column(
-            [self.fwhm.error.value],
-            dtype="f",
-            unit=self.fwhm.error.unit,
-            description="Error on the restframe FWHM, not deconvolved",
-        )
-        # Deconvolved velocity fwhm, calculated if possible
-        t["v"] = Column(
-            [self.velocity_fwhm.value.value],
-            dtype="f",
-            unit=self.velocity_fwhm.value.unit,
-            description="Restframe, deconvolved velocity FWHM; 0 means line is unresolved",
-        )
-        t["v_err"] = Column(
-            [self.velocity_fwhm.error.value],
-            dtype="f",
-            unit=self.velocity_fwhm.error.unit,
-            description="Error on the restframe, deconvolved velocity FWHM; 99 means line is unresolved",
-        )
-
-        # Detection flag
-        t["detected"] = Column(
-            [True], dtype="bool", description="Detected or nondetected line"
-        )
-
-        # Coverage flag
-        t["covered"] = Column(
-            [True], dtype="bool", description="Does the spectrum cover the line?"
+        # Deconvolved velocity fwhm, undefined for lines narrower than the
+        # observed resolution at the restframe wavelength
+        excess = self.fwhm.value ** 2.0 - self.resolution ** 2.0
+        unresolved = excess < 0
+        eff_fwhm = np.sqrt(np.maximum(excess, 0.0 * excess.unit))
+        v = (const.c.to("km/s") * eff_fwhm / self.restwl).to_value(u.km / u.s)
+        e = (const.c.to("km/s") * self.fwhm.error / self.restwl).to_value(u.km / u.s)
+        return RandomVariable(
+            value=np.where(unresolved, np.nan, v) * u.km / u.s,
+            error=np.where(unresolved, np.nan, e) * u.km / u.s,
         )
 
-        return t
+    def as_columns(self) -> dict:
+        """
+        Measured properties of detected emission lines, by column of the output
+        table
+        Return:
+            dictionary of the column names and values
+        """
+        return {
+            # Source properties
+            "z": self.z,
+            # Redshift calculated from the line and its offset from the
+            # specpro redshift
+            "zline": self.z_line.value,
+            "zline_err": self.z_line.error,
+            "zoffset": self.z_offset.value,
+            "zoffset_err": self.z_offset.error,
+            # Continuum around line
+            "cont": self.continuum.value,
+            "cont_err": self.continuum.error,
+            # Gaussian fit
+            "wl": self.wavelength.value,
+            "wl_err": self.wavelength.error,
+            "height": self.height.value,
+            "height_err": self.height.error,
+            "sigma": self.sigma.value,
+            "sigma_err": self.sigma.error,
+            "amplitude": self.amplitude.value,
+            "amplitude_err": self.amplitude.error,
+            "flux": self.flux.value,
+            "flux_err": self.flux.error,
+            "luminosity": self.luminosity.value,
+            "luminosity_err": self.luminosity.error,
+            "EWrest": self.ew_rest.value,
+            "EWrest_err": self.ew_rest.error,
+            # FWHM of the line and the deconvolved velocity fwhm
+            "FWHM": self.fwhm.value,
+            "FWHM_err": self.fwhm.error,
+            "v": self.velocity_fwhm.value,
+            "v_err": self.velocity_fwhm.error,
+            "detected": True,
+            "covered": True,
+            "center": self.center_constraint,
+            "flag": self.flag,
+        }
 
 
 @dataclass
@@ -324,6 +191,8 @@ class NonDetection:
     restwl: float
     z: float
     cosmo: FlatLambdaCDM
+    center_constraint: Optional[str] = None
+    flag: Optional[str] = None
 
     @property
     def flux(self) -> Qty:
@@ -333,75 +202,29 @@ class NonDetection:
     @property
     def luminosity(self) -> Qty:
         # Line luminosity
-        ld = self.cosmo.luminosity_distance(self.z).to(10 ** 28 * u.cm)
+        ld = distance_table(self.cosmo)(self.z).to(10 ** 28 * u.cm)
         v = 4.0 * np.pi * ld ** 2 * self.flux
         return v
 
-    def as_fits_table(self, line: QTable) -> QTable:
-        """ 
-        Writes out the results for a nondetected emission line within a line fit 
-        (either stand alone or one that was part of a doublet, triplet etc), for
-        a particular source using astropy
-        Input:
-            self: emission line fit parameters
-            line: lab properties of the fitted emission line
-        Return: 
-            Fits table with all the lab and measured properties of a particular
-            emission line
+    def as_columns(self) -> dict:
         """
-        t = QTable()
-        # Vacuum/laboratory properties of the line
-        t = hstack([t, line])
-
-        t["z"] = Column(
-            [self.z], dtype="f", description="Source redshift, from specpro"
-        )
-
-        # Line fits
-        # Continuum around line
-        t["cont"] = Column(
-            [self.continuum.value.value],
-            dtype="f",
-            unit=self.continuum.value.unit,
-            description="Continuum around line, Gaussian fit",
-        )
-        t["cont_err"] = Column(
-            [self.continuum.error.value],
-            dtype="f",
-            unit=self.continuum.error.unit,
-            description="Error on continuum around line, Gaussian fit",
-        )
-        t["amplitude"] = Column(
-            [self.amplitude.value],
-            dtype="f",
-            unit=self.amplitude.unit,
-            description="Amplitude, Gaussian fit",
-        )
-        # Flux
-        t["flux"] = Column(
-            [self.flux.value],
-            dtype="f",
-            unit=self.flux.unit,
-            description="Line flux, Gaussian fit",
-        )
-        # Luminosity
-        t["luminosity"] = Column(
-            [self.luminosity.value],
-            dtype="f",
-            unit=self.luminosity.unit,
-            description="Line luminosity, Gaussian fit",
-        )
-
-        # Detection flag
-        t["detected"] = Column(
-            [False], dtype="bool", description="Detected or nondetected line"
-        )
-
-        # Coverage flag
-        t["covered"] = Column(
-            [True], dtype="bool", description="Does the spectrum cover the line?"
-        )
-        return t
+        Measured properties of nondetected emission lines, by column of the 
+        output table
+        Return:
+            dictionary of the column names and values
+        """
+        return {
+            "z": self.z,
+            "cont": self.continuum.value,
+            "cont_err": self.continuum.error,
+            "amplitude": self.amplitude,
+            "flux": self.flux,
+            "luminosity": self.luminosity,
+            "detected": False,
+            "covered": True,
+            "center": self.center_constraint,
+            "flag": self.flag,
+        }
 
 
 @dataclass
@@ -410,56 +233,390 @@ class NoCoverage:
     restwl: float
     z: float
 
-    def as_fits_table(self, line: QTable) -> QTable:
-        """ 
-        Writes out the results for an emission line within a multiple line fit 
-        for which there is no spectral coverage
+    def as_columns(self) -> dict:
+        """
+        Measured properties of emission lines without spectral coverage, by 
+        column of the output table
+        Return:
+            dictionary of the column names and values
+        """
+        return {
+            "z": self.z,
+            "cont": self.continuum.value,
+            "cont_err": self.continuum.error,
+            "detected": False,
+            "covered": False,
+        }
+
+
+@dataclass
+class Spectrum:
+    lines: List[Union[Line, NonDetection, NoCoverage]]
+    continuum: RandomVariable
+
+
+# Descriptions of the measured columns of the output table
+DESCRIPTIONS = {
+    "z": "Source redshift, from specpro",
+    "zline": "Redshift calculated from this emission line",
+    "zline_err": "Error on the redshift calculated from this emission line",
+    "zoffset": "Redshift offset between line and specpro redshift",
+    "zoffset_err": "Error on the redshift offset",
+    "cont": "Continuum around line, Gaussian fit",
+    "cont_err": "Error on continuum around line, Gaussian fit",
+    "wl": "Restframe wavelength, Gaussian fit",
+    "wl_err": "Error on restframe wavelength, Gaussian fit",
+    "height": "Height, Gaussian fit",
+    "height_err": "Error on height, Gaussian fit",
+    "sigma": "Sigma, Gaussian fit",
+    "sigma_err": "Error on sigma, Gaussian fit",
+    "amplitude": "Amplitude, Gaussian fit",
+    "amplitude_err": "Error on amplitude, Gaussian fit",
+    "flux": "Line flux, Gaussian fit",
+    "flux_err": "Error on line flux, Gaussian fit",
+    "luminosity": "Line luminosity, Gaussian fit",
+    "luminosity_err": "Error on line luminosity, Gaussian fit",
+    "EWrest": "Restframe line equivalent width, Gaussian fit",
+    "EWrest_err": "Error on the restframe equivalent width, Gaussian fit",
+    "FWHM": "Restframe FWHM, not deconvolved",
+    "FWHM_err": "Error on the restframe FWHM, not deconvolved",
+    "v": "Restframe, deconvolved velocity FWHM; NaN means line is unresolved",
+    "v_err": "Error on the restframe, deconvolved velocity FWHM; NaN means line is unresolved",
+    "detected": "Detected or nondetected line",
+    "covered": "Does the spectrum cover the line?",
+    "center": "Constraint on the line centers used for the fit",
+    "flag": "Limit reached while fitting the lines: max_nfev, group_timeout or source_timeout",
+}
+
+
+class LineTable:
+    """
+    Fits of the emission lines of a single source, accumulated field by field
+    in arrays allocated once for all the lines. When the table is built, each
+    kind of fit (Line, NonDetection, NoCoverage) is rebuilt once with arrays 
+    in its fields, so that the derived quantities are computed for all lines
+    at once. Columns are in the order in which the lines first fill them and 
+    are masked for the lines that do not have them.
+    """
+
+    def __init__(self, size):
+        """
         Input:
-            self: emission line fit parameters
+            size: maximum number of lines, e.g. the length of the line list
+        """
+        self.capacity = size
+        self.size = 0
+        self.kinds = []
+        self.cosmo = None
+        # Lab properties: column of the line list and values of each line
+        self.lab = {}
+        # Measured fields: plain values, units and labels of each line
+        self.values = {}
+        self.units = {}
+        self.labels = {}
+
+    def __len__(self):
+        return self.size
+
+    def add(self, line_fit, line):
+        """
+        Append the fit of an emission line
+        Input:
+            line_fit: Line, NonDetection or NoCoverage
             line: lab properties of the fitted emission line
-        Return: 
-            Fits table with all the lab and measured properties of a particular
-            emission line
         """
-        t = QTable()
-        # Vacuum/laboratory properties of the line
-        t = hstack([t, line])
+        if self.size == self.capacity:
+            raise IndexError(f"More than {self.capacity} lines in a LineTable")
+        i = self.size
+        for name in line.colnames:
+            self.lab.setdefault(name, (line.columns[name], []))[1].append(line[name])
+        for field in dataclasses.fields(line_fit):
+            value = getattr(line_fit, field.name)
+            if field.type is RandomVariable:
+                self.store(i, field.name, value.value)
+                self.store(i, f"{field.name}_err", value.error)
+            elif field.type is FlatLambdaCDM:
+                self.cosmo = value
+            elif field.type == Optional[str]:
+                if field.name not in self.labels:
+                    self.labels[field.name] = np.full(self.capacity, "", dtype=object)
+                self.labels[field.name][i] = value or ""
+            else:
+                self.store(i, field.name, value)
+        self.kinds.append(type(line_fit))
+        self.size += 1
 
-        t["z"] = Column(
-            [self.z], dtype="f", description="Source redshift, from specpro"
-        )
+    def store(self, i, name, value):
+        """
+        Store a measured field of line i as a plain number, in the units of the
+        first line that had the field
+        """
+        if name not in self.values:
+            self.values[name] = np.full(self.capacity, np.nan)
+        if isinstance(value, Qty):
+            value = value.to_value(self.units.setdefault(name, value.unit))
+        self.values[name][i] = value
 
-        # Line fits
-        # Continuum around line
-        t["cont"] = Column(
-            [self.continuum.value.value],
-            dtype="f",
-            unit=self.continuum.value.unit,
-            description="Continuum around line, Gaussian fit",
-        )
-        t["cont_err"] = Column(
-            [self.continuum.error.value],
-            dtype="f",
-            unit=self.continuum.error.unit,
-            description="Error on continuum around line, Gaussian fit",
+    def fields(self, name, rows):
+        """
+        A measured field of the given lines, as an array with units, if any
+        """
+        values = self.values[name][rows]
+        return values * self.units[name] if name in self.units else values
+
+    def fits(self, kind, rows):
+        """
+        The fits of the given lines, all of the same kind, as a single fit 
+        with arrays in its fields
+        """
+        values = {}
+        for field in dataclasses.fields(kind):
+            if field.type is RandomVariable:
+                values[field.name] = RandomVariable(
+                    value=self.fields(field.name, rows),
+                    error=self.fields(f"{field.name}_err", rows),
+                )
+            elif field.type is FlatLambdaCDM:
+                values[field.name] = self.cosmo
+            elif field.type == Optional[str]:
+                values[field.name] = self.labels[field.name][rows].astype(str)
+            else:
+                values[field.name] = self.fields(field.name, rows)
+        return kind(**values)
+
+    def to_table(self) -> Table:
+        """
+        Build the table with all the lab and measured properties of the lines
+        Return:
+            masked astropy Table, one row per line
+        """
+        if self.size == 0:
+            raise ValueError("No emission line fits in the LineTable")
+
+        # Lines of each kind, in the order in which the kinds first appear
+        rows = {}
+        for i, kind in enumerate(self.kinds):
+            rows.setdefault(kind, []).append(i)
+        measured = {}
+        for kind, indices in rows.items():
+            indices = np.array(indices)
+            for name, value in self.fits(kind, indices).as_columns().items():
+                measured.setdefault(name, []).append((indices, value))
+
+        # Vacuum/laboratory properties of the lines
+        columns = [
+            MaskedColumn(
+                [getattr(value, "value", value) for value in values],
+                name=name,
+                dtype=column.info.dtype,
+                unit=column.info.unit,
+                description=column.info.description,
+            )
+            for name, (column, values) in self.lab.items()
+        ]
+        # Measured properties, in single precision
+        for name, parts in measured.items():
+            unit = None
+            for _, value in parts:
+                unit = getattr(value, "unit", unit)
+            values = [np.asarray(getattr(value, "value", value)) for _, value in parts]
+            dtype = (
+                np.float32 if values[0].dtype.kind == "f" else np.result_type(*values)
+            )
+            data = np.zeros(self.size, dtype=dtype)
+            mask = np.ones(self.size, dtype=bool)
+            for (indices, _), value in zip(parts, values):
+                data[indices] = value
+                mask[indices] = False
+            columns.append(
+                MaskedColumn(
+                    data,
+                    name=name,
+                    mask=mask,
+                    unit=unit,
+                    description=DESCRIPTIONS[name],
+                )
+            )
+        return Table(columns, masked=True, copy=False)
+
+
+@dataclass
+class Units:
+    """
+    Units of the wavelengths and fluxes of a spectrum. The fitting works on 
+    plain arrays in these units, which are only attached again to the results.
+    """
+
+    wavelength: u.UnitBase
+    flux: u.UnitBase
+
+
+@dataclass
+class PlainSource:
+    """
+    The restframe spectrum of a source with its dispersion profile and, if 
+    requested, its global continuum, the catalog of lines, the sky bands and 
+    the lengths used for the fitting, as plain arrays and numbers in the units
+    of the spectrum. Units are stripped once per source, so that the masking, 
+    fitting and model selection do not pay for Quantity arithmetic.
+    """
+
+    units: Units
+    wl_rest: np.ndarray
+    grid: so.Grid
+    profile: so.DispersionProfile
+    flux: np.ndarray
+    stdev: np.ndarray
+    catalog: so.LineCatalog
+    sky_bands: Optional[tuple]
+    cont_width: float
+    mask_width: float
+    w: float
+    rest_spectral_resolution: float
+    continuum: Optional[np.ndarray]
+
+    @staticmethod
+    def from_tables(
+        spectrum,
+        line_list,
+        sky,
+        redshift,
+        cont_width,
+        mask_width,
+        w,
+        rest_spectral_resolution,
+        continuum="local",
+    ) -> "PlainSource":
+        units = Units(wavelength=spectrum["wl_rest"].unit, flux=spectrum["flux"].unit)
+        wl_rest = spectrum["wl_rest"].value
+        flux = spectrum["flux"].value
+        catalog = so.LineCatalog.from_wavelengths(
+            line_list["wavelength"].to_value(units.wavelength)
         )
-        # Detection flag
-        t["detected"] = Column(
-            [False], dtype="bool", description="Detected or nondetected line"
+        bands = so.sky_bands(sky, redshift, units.wavelength)
+        return PlainSource(
+            units=units,
+            wl_rest=wl_rest,
+            grid=so.Grid.from_wavelengths(wl_rest),
+            profile=so.DispersionProfile.from_wavelengths(wl_rest),
+            flux=flux,
+            stdev=spectrum["stdev"].to_value(units.flux),
+            catalog=catalog,
+            sky_bands=bands,
+            cont_width=cont_width.to_value(units.wavelength),
+            mask_width=mask_width.to_value(units.wavelength),
+            w=w.to_value(units.wavelength),
+            rest_spectral_resolution=rest_spectral_resolution.to_value(
+                units.wavelength
+            ),
+            continuum=so.global_continuum(
+                wl_rest,
+                flux,
+                catalog,
+                bands,
+                cont_width.to_value(units.wavelength),
+                mask_width.to_value(units.wavelength),
+            )
+            if continuum == "global"
+            else None,
         )
 
-        # Coverage flag
-        t["covered"] = Column(
-            [False], dtype="bool", description="Does the spectrum cover the line?"
-        )
 
-        return t
+class FitTimeout(Exception):
+    """
+    Raised when the fits of a group of lines run out of wall-clock time
+    """
 
 
 @dataclass
-class Spectrum:
-    lines: List[Union[Line, NonDetection, NoCoverage]]
-    continuum: RandomVariable
+class FitLimits:
+    """
+    Limits on the fits of a single group of lines: the maximum number of 
+    function evaluations of each fit and the wall-clock time (as given by 
+    time.monotonic) by which all fits must end. The first limit that is 
+    reached is recorded, to flag the results.
+    """
+
+    max_nfev: Optional[int] = None
+    deadline: Optional[float] = None
+    timeout: str = "group_timeout"
+    reached: Optional[str] = None
+    clock: Callable[[], float] = time.monotonic
+
+    @staticmethod
+    def for_group(max_nfev, group_timeout, source_deadline=None, clock=time.monotonic):
+        """
+        Limits for a group of lines whose fits start now
+        Input:
+            max_nfev: maximum number of function evaluations of each fit
+            group_timeout: wall-clock budget of the group, in seconds
+            source_deadline: time by which all fits of the source must end
+            clock: clock of the deadlines, time.monotonic or a SourceClock
+        Return:
+            FitLimits with the earliest of the two deadlines
+        """
+        limits = FitLimits(max_nfev, source_deadline, "source_timeout", clock=clock)
+        if group_timeout is not None:
+            deadline = clock() + group_timeout
+            if source_deadline is None or deadline < source_deadline:
+                limits.deadline, limits.timeout = deadline, "group_timeout"
+        return limits
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and self.clock() > self.deadline
+
+    def check_time(self):
+        """
+        Stop the fitting of the group once its time is up
+        """
+        if self.expired:
+            self.reached = self.timeout
+            raise FitTimeout(self.timeout)
+
+    def check_fit(self, model):
+        """
+        Record a fit that was stopped by the maximum number of function 
+        evaluations
+        """
+        if self.max_nfev is not None and model.nfev >= self.max_nfev:
+            self.reached = self.reached or "max_nfev"
+
+
+class SourceClock:
+    """
+    Wall-clock time spent on the fits of a single source, for sources whose
+    groups of lines are fit in batches with other sources. The clock starts at
+    0 and only runs while the source is fit on its own; the time of a batch is
+    charged in equal shares to the windows fit in it. The limits of a source
+    then do not depend on how many other sources are fit with it.
+    """
+
+    def __init__(self):
+        self.spent = 0.0
+        self.started = None
+
+    def __call__(self) -> float:
+        if self.started is None:
+            return self.spent
+        return self.spent + time.monotonic() - self.started
+
+    def charge(self, seconds):
+        """
+        Add the share of the source in the time of a batch
+        """
+        self.spent += seconds
+
+    @contextmanager
+    def running(self):
+        """
+        Run the clock while the source is fit on its own
+        """
+        self.started = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.spent, self.started = self(), None
 
 
 def gauss_function(x, h, x0, sigma):
@@ -476,21 +633,19 @@ def gauss_function(x, h, x0, sigma):
     return h * np.exp(-((x - x0) ** 2) / (2.0 * sigma ** 2.0))
 
 
-def upper_limit(y, x, SN_limit, rest_spectral_resolution):
+def upper_limit(y, pixel, SN_limit, rest_spectral_resolution):
     """
     In the case where we do not get a SN*sigma detection, we define a SN*sigma 
     upper limit as per the formula:
         SNlimit *sigma_RMS_channel* sqrt( channel_width * line_width )
     Input:
         y: spectrum in units of flux or such
-        x: wavelength
+        pixel: width of a pixel in the region of the spectrum probed; in units 
+               of Angstrom or such. This is pixel width/dispersion and not the
+               resolution
         SN_limit: signal to noise limit for detections
         rest_spectral_resolution: restframed FWHM of the instrument
     """
-    # Get width of a pixel in the region of the spectrum probed; in units of
-    # Angstrom or such. This is pixel width/dispersion and not the resolution
-    pixel = so.dispersion(x)
-
     # Takes SN limit into account
     upper_limit = (
         SN_limit * so.spectrum_rms(y) * np.sqrt(pixel * rest_spectral_resolution)
@@ -501,16 +656,18 @@ def upper_limit(y, x, SN_limit, rest_spectral_resolution):
 def is_good(model: ModelResult, SN_limit) -> bool:
     """
     Test whether the model provided a good fit: i.e. whether all the lines are 
-    detected. If the model has no error bars because of a poor fit or if the
-    amplitude of the Gaussian is measured at a significance lower than the 
-    indicated limit that would be flagged as a bad fit
+    detected. If the model has no error bars because of a poor fit, did not 
+    converge (e.g. it was stopped by max_nfev) or if the amplitude of the 
+    Gaussian is measured at a significance lower than the indicated limit that
+    would be flagged as a bad fit
     """
-    if model.result.errorbars == False:
+    if model.errorbars == False or model.success == False:
         return False
     fitparams = model.params
     return all(
-        RandomVariable.from_param(fitparams[f"g{i}_amplitude"]).significance > SN_limit
-        for i in range(len(model.components) - 1)
+        RandomVariable.from_param(fitparams[name]).significance > SN_limit
+        for name in fitparams
+        if name.endswith("_amplitude")
     )
 
 
@@ -523,6 +680,141 @@ def subsets(length):
         yield from itertools.combinations(range(length), n)
 
 
+def matched_filter_significance(
+    x,
+    y,
+    ystd,
+    wl_line,
+    center_constraint,
+    sigma_constraint,
+    cont_width,
+    w,
+    rest_spectral_resolution,
+):
+    """
+    Cheap estimate of the signal to noise of each line, without fitting: the
+    continuum-subtracted spectrum is filtered with Gaussians of the 
+    instrumental resolution (and of twice the resolution, if the sigma is free)
+    and the largest significance over all the centers allowed for a line is 
+    kept. For each filter, the significance is that of the best fitting 
+    amplitude, for a known center, sigma and continuum.
+    Input:
+        x: usually an array of wavelengths
+        y: usually an array of fluxes
+        ystd: errors on y, usually a stdev of the flux
+        wl_line: wavelengths of the lines to be fit
+        center_constraint: fix, constrain or let free the centers of the Gaussians
+        sigma_constraint: let free or fix the sigma of the Gaussians
+        cont_width: the amount left and right of the lines used for continuum
+                    estimation
+        w: region to be probed left and right of the starting wavelength solution
+           when fitting the Gaussian
+        rest_spectral_resolution: restframed FWHM of the instrument
+    Return:
+        array with the matched-filter significance of each line
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    weights = 1.0 / np.asarray(ystd, dtype=np.float64) ** 2
+    wl, lower, upper, _ = center_bounds(wl_line, center_constraint, cont_width, w)
+    *_, continuum = moment_guess(
+        x, y, wl, rest_spectral_resolution, lower, upper, sigma_constraint
+    )
+
+    # Filters centered on each line and on each pixel
+    centers = np.concatenate([wl, x])
+    sigma = so.fwhm_to_sigma(rest_spectral_resolution)
+    widths = (sigma,) if sigma_constraint == "fixed" else (sigma, 2 * sigma)
+    significance = np.max(
+        [
+            np.abs(signal) / np.sqrt(np.maximum(noise, 1e-300))
+            for signal, noise in (
+                gaussian_filter(x, [weights * (y - continuum), weights], width, wl)
+                for width in widths
+            )
+        ],
+        axis=0,
+    )
+
+    allowed = (centers[None, :] >= lower[:, None]) & (
+        centers[None, :] <= upper[:, None]
+    )
+    return np.max(np.where(allowed, significance[None, :], 0.0), axis=1)
+
+
+def gaussian_filter(x, values, sigma, wl):
+    """
+    Filter arrays defined on the pixels of a spectrum with a unit Gaussian, 
+    cut at 4 sigma: the first array is summed with the Gaussian as weights and
+    the second with the square of the Gaussian, for Gaussians centered on the 
+    given wavelengths and on each pixel. The pixels are placed on a regular
+    grid with the median spacing of x, so that gaps in the spectrum, e.g. 
+    around masked lines or sky bands, stay empty, and the sums are 
+    convolutions on that grid. Sums at wavelengths between the nodes of the 
+    grid are interpolated.
+    Input:
+        x: wavelengths of the pixels
+        values: the two arrays to filter, with the same length as x
+        sigma: sigma of the Gaussian
+        wl: wavelengths of the other centers of the Gaussians
+    Return:
+        the two filtered arrays, at wl and then at x
+    """
+    steps = np.diff(np.sort(x))
+    step = np.median(steps[steps > 0]) if np.any(steps > 0) else sigma
+    index = np.rint((x - np.min(x)) / step).astype(int)
+    grid = np.min(x) + step * np.arange(np.max(index) + 1)
+    half = int(np.ceil(4 * sigma / step))
+    kernel = nf.unit_gaussian(step * np.arange(-half, half + 1), 0.0, sigma)
+    filtered = []
+    for array, power in zip(values, (1, 2)):
+        binned = np.bincount(index, weights=array, minlength=len(grid))
+        total = np.convolve(binned, kernel ** power)[half : half + len(grid)]
+        filtered.append(np.concatenate([np.interp(wl, grid, total), total[index]]))
+    return filtered
+
+
+def prescreen_lines(
+    x,
+    y,
+    ystd,
+    wl_line,
+    center_constraint,
+    sigma_constraint,
+    cont_width,
+    w,
+    SN_limit,
+    rest_spectral_resolution,
+    prescreen,
+):
+    """
+    Select the lines that are worth fitting: those whose matched-filter 
+    signal to noise is at least SN_limit - prescreen. The others are clearly 
+    undetected and are directly given upper limits.
+    Input:
+        see matched_filter_significance
+        SN_limit: signal to noise limit for detections
+        prescreen: safety margin on the signal to noise; if None, all lines 
+                   are fit
+    Return:
+        tuple with the indices of the lines to fit
+    """
+    if prescreen is None:
+        return tuple(range(len(wl_line)))
+    significance = matched_filter_significance(
+        x,
+        y,
+        ystd,
+        wl_line,
+        center_constraint,
+        sigma_constraint,
+        cont_width,
+        w,
+        rest_spectral_resolution,
+    )
+    return tuple(int(i) for i in np.flatnonzero(significance >= SN_limit - prescreen))
+
+
 def model_selection(
     redshift,
     x,
@@ -536,6 +828,19 @@ def model_selection(
     SN_limit,
     rest_spectral_resolution,
     cosmo,
+    units,
+    pixel,
+    engine="lmfit",
+    selection="exhaustive",
+    sigma_constraint="free",
+    kinematics="independent",
+    ratios=None,
+    prescreen=None,
+    parallel=False,
+    coarse=None,
+    limits=None,
+    precision="double",
+    baseline=None,
 ) -> Spectrum:
     """
     Start with the model with the most components (constant + as many 
@@ -544,6 +849,8 @@ def model_selection(
     non-detected), the search removes that component and attempts to fit a model
     with fewer Gaussians until it finds a fit. For all non-detected lines, an
     upper limit is estimated.
+    All wavelengths, fluxes and lengths are plain arrays and numbers, in the
+    units of the spectrum; units are only attached to the resulting Spectrum.
     Input: 
         redshift: redshift of the source
         x: usually an array of wavelengths
@@ -554,108 +861,767 @@ def model_selection(
         center_constraint: fix, constrain or let free the centers of the Gaussians
                            when fitting
         verbose: print full lmfit output
-        sky: sky contaminated areas to mask. If None, nothing will be masked
         cont_width: the amount left and right of the lines used for continuum
                     estimation
-        mask_width: if another line B falls within the region selected for 
-                    fitting line A, how big of a wavelength region should be 
-                    covered for B
         w: region to be probed left and right of the starting wavelength solution
            when fitting the Gaussian
         SN_limit: signal to noise limit for detections
         rest_spectral_resolution: restframed FWHM of the instrument
         cosmo: cosmological parameters
+        units: Units of the wavelengths and fluxes
+        pixel: width of a pixel around the lines, from the dispersion profile
+               of the spectrum
+        engine: fitting engine, either "lmfit" or "native"
+        selection: strategy to search for the simplest good model, either 
+                   "exhaustive" or "backward"
+        sigma_constraint: let free or fix the sigma of the Gaussians to the 
+                          instrumental resolution when fitting
+        kinematics: "independent" or "tied"; tied lines share a single 
+                    velocity offset and velocity dispersion
+        ratios: fixed flux ratios, as returned by amplitude_ratios
+        prescreen: if set, lines with a matched-filter signal to noise below
+                   SN_limit - prescreen are not fit and get upper limits
+        parallel: fit all candidate models with the same number of lines at
+                  once; only used by the exhaustive search with the native 
+                  engine
+        coarse: if set, each model is first fit on the spectrum binned by this
+                factor, and the fit at full resolution starts from its 
+                parameters
+        limits: FitLimits of the group; when the group runs out of time, only
+                the continuum is fit and all lines get upper limits
+        precision: "double" or "single"; floating point precision of the data
+                   in the native solver
+        baseline: global continuum at x, already subtracted from y, or None.
+                  The fitted constant is then only a residual offset, bounded
+                  as in continuum_offset, and the baseline is added back to 
+                  the continuum of the lines.
     Return:
         Spectrum with continuum, detected lines and upper limits
     """
-    for wl_subset_indices in subsets(len(wl_line)):
-        wl_subset = wl_line[list(wl_subset_indices)]
-        model = fit_model(
+    # With the automatic center constraint, start with fixed centers and only
+    # move on to constrained and then free centers when the fit needs it
+    levels = ("fixed", "constrained", "free")
+    if center_constraint != "auto":
+        levels = (center_constraint,)
+    if limits is None:
+        limits = FitLimits()
+    offset = continuum_offset(y, baseline)
+    try:
+        for level in levels:
+            selected = select_model(
+                redshift,
+                x,
+                y,
+                ystd,
+                wl_line,
+                level,
+                verbose,
+                cont_width,
+                w,
+                SN_limit,
+                rest_spectral_resolution,
+                engine,
+                selection,
+                sigma_constraint,
+                kinematics,
+                ratios,
+                prescreen,
+                parallel,
+                coarse,
+                limits,
+                precision,
+                offset,
+            )
+            if level == levels[-1] or not needs_wider_center(
+                level,
+                selected,
+                x,
+                y,
+                ystd,
+                wl_line,
+                sigma_constraint,
+                cont_width,
+                w,
+                SN_limit,
+                rest_spectral_resolution,
+            ):
+                break
+            if verbose == True:
+                print(
+                    Fore.BLUE
+                    + f"Centers {level} do not describe lines {wl_line * units.wavelength}, try wider constraints"
+                )
+    except FitTimeout:
+        # Out of time: fall back to the continuum alone, which is linear and
+        # cheap to fit, and give upper limits for all lines
+        print(
+            Fore.YELLOW
+            + f"Warning: out of time when fitting lines {wl_line * units.wavelength}"
+        )
+        selected = (
+            (),
+            fit_model(
+                redshift,
+                x,
+                y,
+                ystd,
+                wl_line[[]],
+                level,
+                verbose,
+                cont_width,
+                w,
+                rest_spectral_resolution,
+                engine,
+                sigma_constraint=sigma_constraint,
+                precision=precision,
+                offset=offset,
+            ),
+        )
+    if selected is None:
+        return None
+    wl_subset_indices, model = selected
+
+    return build_spectrum(
+        redshift,
+        x,
+        y,
+        wl_line,
+        wl_subset_indices,
+        model,
+        verbose,
+        SN_limit,
+        rest_spectral_resolution,
+        cosmo,
+        units,
+        pixel,
+        level,
+        limits.reached,
+        baseline,
+    )
+
+
+def select_model(
+    redshift,
+    x,
+    y,
+    ystd,
+    wl_line,
+    center_constraint,
+    verbose,
+    cont_width,
+    w,
+    SN_limit,
+    rest_spectral_resolution,
+    engine,
+    selection,
+    sigma_constraint,
+    kinematics,
+    ratios,
+    prescreen,
+    parallel,
+    coarse,
+    limits,
+    precision,
+    offset,
+):
+    """
+    Find the simplest good model for a group of lines, for a single center
+    constraint
+    Input:
+        see model_selection; center_constraint cannot be "auto"
+    Return:
+        indices of the lines in the selected model and the model fit, or None
+        if no model is good
+    """
+    # Only fit the lines that are not clearly undetected
+    candidates = prescreen_lines(
+        x,
+        y,
+        ystd,
+        wl_line,
+        center_constraint,
+        sigma_constraint,
+        cont_width,
+        w,
+        SN_limit,
+        rest_spectral_resolution,
+        prescreen,
+    )
+    if verbose == True and len(candidates) < len(wl_line):
+        print(
+            Fore.BLUE
+            + f"Prescreen: not fitting undetected lines {wl_line[[i for i in range(len(wl_line)) if i not in candidates]]}"
+        )
+
+    search = backward_elimination if selection == "backward" else exhaustive_search
+    selected = search(
+        redshift,
+        x,
+        y,
+        ystd,
+        wl_line[list(candidates)],
+        center_constraint,
+        verbose,
+        cont_width,
+        w,
+        SN_limit,
+        rest_spectral_resolution,
+        engine,
+        sigma_constraint,
+        kinematics,
+        ratios,
+        parallel,
+        coarse,
+        limits,
+        precision,
+        offset,
+    )
+    if selected is None:
+        return None
+    wl_subset_indices, model = selected
+    return tuple(candidates[i] for i in wl_subset_indices), model
+
+
+def needs_wider_center(
+    center_constraint,
+    selected,
+    x,
+    y,
+    ystd,
+    wl_line,
+    sigma_constraint,
+    cont_width,
+    w,
+    SN_limit,
+    rest_spectral_resolution,
+):
+    """
+    Decide whether the model selected with a center constraint leaves signs 
+    of lines away from their expected position, so that the fit should be 
+    repeated with a wider constraint.
+    - fixed: a detected line is shifted, i.e. the residuals correlate
+      significantly with the derivative of its Gaussian with respect to the
+      center
+    - constrained: a detected line has its center at the edge of the range
+    - both: an undetected line has significant residual flux within the range
+      allowed for its center by the wider constraint. As the residuals are
+      searched over many positions, the limit on the signal to noise is raised
+      by the expected maximum of pure noise over the resolution elements in
+      the range.
+    Input:
+        center_constraint: constraint used for the selected model
+        selected: indices of the lines in the selected model and the model 
+                  fit, or None if no model is good
+        others: see model_selection
+    Return:
+        True if a wider center constraint should be tried
+    """
+    if selected is None:
+        return True
+    wl_subset_indices, model = selected
+    fitparams = model.params
+    centers = np.array(
+        [fitparams[f"g{i}_center"].value for i in range(len(wl_subset_indices))]
+    )
+
+    xv = np.asarray(x, dtype=np.float64)
+    weights = 1.0 / np.asarray(ystd, dtype=np.float64) ** 2
+    residual = np.asarray(y, dtype=np.float64) - model.eval(x=xv)
+
+    if center_constraint == "constrained":
+        offset = np.abs(centers - wl_line[list(wl_subset_indices)])
+        if np.any(offset >= 0.999 * w):
+            return True
+    else:
+        # Significance of the shift of each detected line, from the residuals
+        _, jacobian = nf.model_and_jacobian(
+            xv[None, :],
+            nf.pack_parameters(
+                [fitparams[f"g{i}_amplitude"].value for i in range(len(centers))],
+                centers,
+                [fitparams[f"g{i}_sigma"].value for i in range(len(centers))],
+                fitparams["c"].value,
+            ),
+        )
+        derivative = jacobian[0, 1:-1:3]
+        shift = np.abs(derivative @ (weights * residual)) / np.sqrt(
+            np.maximum(derivative ** 2 @ weights, 1e-300)
+        )
+        if np.any(shift > SN_limit):
+            return True
+
+    # Residual flux near the undetected lines
+    undetected = [i for i in range(len(wl_line)) if i not in wl_subset_indices]
+    if not undetected:
+        return False
+    wider = "constrained" if center_constraint == "fixed" else "free"
+    significance = matched_filter_significance(
+        x,
+        residual,
+        ystd,
+        wl_line[undetected],
+        wider,
+        sigma_constraint,
+        cont_width,
+        w,
+        rest_spectral_resolution,
+    )
+    width = w if wider == "constrained" else cont_width
+    trials = max(2 * width / rest_spectral_resolution, 1.0)
+    return bool(np.any(significance > SN_limit + np.sqrt(2 * np.log(trials))))
+
+
+def exhaustive_search(
+    redshift,
+    x,
+    y,
+    ystd,
+    wl_line,
+    center_constraint,
+    verbose,
+    cont_width,
+    w,
+    SN_limit,
+    rest_spectral_resolution,
+    engine,
+    sigma_constraint,
+    kinematics,
+    ratios,
+    parallel,
+    coarse,
+    limits,
+    precision,
+    offset,
+):
+    """
+    Go through all subsets of the lines, from the largest to the smallest, and
+    return the first one for which the model is good. 
+    Input:
+        see model_selection
+    Return:
+        indices of the lines in the selected model and the model fit, or None
+        if no model is good
+    """
+    # Either one subset at a time, or all subsets of the same size at once in
+    # a single batch of the native solver
+    batches = (
+        (list(group) for _, group in itertools.groupby(subsets(len(wl_line)), len))
+        if parallel and engine == "native"
+        else ([subset] for subset in subsets(len(wl_line)))
+    )
+    for candidates in batches:
+        limits.check_time()
+        models = fit_candidates(
             redshift,
             x,
             y,
             ystd,
-            wl_subset,
+            wl_line,
+            candidates,
             center_constraint,
             verbose,
             cont_width,
             w,
             rest_spectral_resolution,
+            engine,
+            sigma_constraint,
+            kinematics,
+            ratios,
+            coarse,
+            limits.max_nfev,
+            precision,
+            offset,
         )
-        if is_good(model, SN_limit):
-            break
-        else:
+        # Keep the first good model, in the same order as one by one
+        for wl_subset_indices, model in zip(candidates, models):
+            limits.check_fit(model)
+            if is_good(model, SN_limit):
+                return wl_subset_indices, model
             if verbose == True:
                 print(
                     Fore.BLUE
-                    + f"NonDetection when fitting set of lines {wl_subset}, try a simpler model"
+                    + f"NonDetection when fitting set of lines {wl_line[list(wl_subset_indices)]}, try a simpler model"
                 )
-    else:
-        return None
+    return None
+
+
+def fit_candidates(
+    redshift,
+    x,
+    y,
+    ystd,
+    wl_line,
+    candidates,
+    center_constraint,
+    verbose,
+    cont_width,
+    w,
+    rest_spectral_resolution,
+    engine,
+    sigma_constraint,
+    kinematics,
+    ratios,
+    coarse,
+    max_nfev,
+    precision,
+    offset,
+    calc_covar=True,
+    init=None,
+):
+    """
+    Fit the models made of several subsets of the lines of a group. When there
+    is more than one subset, the native solver fits them at once, as a single
+    batch; lmfit fits them one after the other.
+    Input:
+        wl_line: wavelengths of all the lines in the group
+        candidates: list of subsets, as tuples of indices into wl_line
+        calc_covar: whether to compute the uncertainties of the parameters
+        init: starting values of the parameters, for a single subset
+        others: see model_selection
+    Return:
+        list of model fits, one per subset
+    """
+
+    def fit(wl_subset_indices):
+        return fit_model(
+            redshift,
+            x,
+            y,
+            ystd,
+            wl_line[list(wl_subset_indices)],
+            center_constraint,
+            verbose,
+            cont_width,
+            w,
+            rest_spectral_resolution,
+            engine,
+            init=init,
+            calc_covar=calc_covar,
+            sigma_constraint=sigma_constraint,
+            kinematics=kinematics,
+            ratios=ratios,
+            coarse=coarse,
+            max_nfev=max_nfev,
+            precision=precision,
+            offset=offset,
+        )
+
+    if len(candidates) == 1:
+        return [fit(candidates[0])]
+
+    dtype = float_type(precision)
+    x = x.astype(dtype=dtype)
+    y = y.astype(dtype=dtype)
+    ystd = ystd.astype(dtype=dtype)
+    if engine == "native":
+        try:
+            models = nf.solve(
+                [
+                    native_problem(
+                        x,
+                        y,
+                        ystd,
+                        wl_line[list(wl_subset_indices)],
+                        center_constraint,
+                        cont_width,
+                        w,
+                        rest_spectral_resolution,
+                        sigma_constraint=sigma_constraint,
+                        kinematics=kinematics,
+                        ratios=ratios,
+                        coarse=coarse,
+                        precision=precision,
+                        offset=offset,
+                    )
+                    for wl_subset_indices in candidates
+                ],
+                max_nfev=max_nfev,
+                calc_covar=calc_covar,
+            )
+        except (ValueError, np.linalg.LinAlgError) as error:
+            no_model(error)
+        if verbose == True:
+            for model in models:
+                print(model.fit_report())
+        return models
+
+    return [fit(wl_subset_indices) for wl_subset_indices in candidates]
+
+
+def backward_elimination(
+    redshift,
+    x,
+    y,
+    ystd,
+    wl_line,
+    center_constraint,
+    verbose,
+    cont_width,
+    w,
+    SN_limit,
+    rest_spectral_resolution,
+    engine,
+    sigma_constraint,
+    kinematics,
+    ratios,
+    parallel,
+    coarse,
+    limits,
+    precision,
+    offset,
+):
+    """
+    Greedy search for a good model: start with all the lines and, as long as
+    the model is not good, drop its least significant line and fit the 
+    remaining lines again, starting from the parameters of the previous fit. 
+    This needs at most one fit per line, rather than one per subset of the 
+    lines, but it does not try all the subsets and may select a different 
+    model than exhaustive_search.
+    Input:
+        see model_selection; parallel is not used
+    Return:
+        indices of the lines in the selected model and the model fit, or None
+        if no model is good
+    """
+    wl_subset_indices = tuple(range(len(wl_line)))
+    init = None
+    while True:
+        limits.check_time()
+        wl_subset = wl_line[list(wl_subset_indices)]
+        (model,) = fit_candidates(
+            redshift,
+            x,
+            y,
+            ystd,
+            wl_line,
+            [wl_subset_indices],
+            center_constraint,
+            verbose,
+            cont_width,
+            w,
+            rest_spectral_resolution,
+            engine,
+            sigma_constraint,
+            kinematics,
+            ratios,
+            coarse,
+            limits.max_nfev,
+            precision,
+            offset,
+            init=init,
+        )
+        limits.check_fit(model)
+        if is_good(model, SN_limit):
+            return wl_subset_indices, model
+        if not wl_subset_indices:
+            return None
+        if verbose == True:
+            print(
+                Fore.BLUE
+                + f"NonDetection when fitting set of lines {wl_subset}, try a simpler model"
+            )
 
+        # Without uncertainties, e.g. for a fit that did not converge, rank
+        # the lines by a cheap estimate of their significance
+        if model.errorbars == True:
+            significance = [
+                RandomVariable.from_param(model.params[f"g{i}_amplitude"]).significance
+                for i in range(len(wl_subset_indices))
+            ]
+        else:
+            ties = tied_parameters(
+                wl_subset, center_constraint, sigma_constraint, kinematics, ratios
+            )
+            significance = screening_significance(model, x, ystd, ties)
+        drop = int(np.argmin(significance))
+        init = warm_start(model.params, len(wl_subset_indices), drop)
+        wl_subset_indices = wl_subset_indices[:drop] + wl_subset_indices[drop + 1 :]
+
+
+def warm_start(fitparams, n, drop=None):
+    """
+    Starting values for a fit of the lines of a previous fit, e.g. on binned
+    data, possibly without one of them
+    Input:
+        fitparams: parameters of the previous fit
+        n: number of Gaussians in the previous fit
+        drop: index of the Gaussian that is dropped, or None to keep all
+    Return:
+        dict with the starting value of each parameter, in the units of the 
+        data
+    """
+    init = {"c": fitparams["c"].value}
+    kept = [i for i in range(n) if i != drop]
+    for new, old in enumerate(kept):
+        for name in ("amplitude", "center", "sigma"):
+            init[f"g{new}_{name}"] = fitparams[f"g{old}_{name}"].value
+    return init
+
+
+def screening_significance(model, x, ystd, ties=None):
+    """
+    Cheap estimate of the significance of the amplitude of each Gaussian in a
+    model, which does not need the covariance matrix of the fit. The error on 
+    each free amplitude is computed as if all the other parameters were known,
+    so it is never larger than the full error: a line that fails this test 
+    would also fail the full one. Lines with an amplitude tied to another line
+    share its significance.
+    Input:
+        model: model fit (lmfit or native)
+        x: usually an array of wavelengths
+        ystd: errors on y, usually a stdev of the flux
+        ties: tied parameters of the model, as returned by tied_parameters
+    Return:
+        list with the significance of each Gaussian
+    """
+    fitparams = model.params
+    weights = 1.0 / np.asarray(ystd, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    n = sum(1 for name in fitparams if name.endswith("_amplitude"))
+    # Derivative of the model with respect to each free amplitude
+    reference = list(range(n))
+    derivative = {}
+    for i in range(n):
+        name, scale = (ties or {}).get(f"g{i}_amplitude", (f"g{i}_amplitude", 1.0))
+        reference[i] = int(name[1 : name.index("_")])
+        g = nf.unit_gaussian(
+            x, fitparams[f"g{i}_center"].value, fitparams[f"g{i}_sigma"].value
+        )
+        derivative[reference[i]] = derivative.get(reference[i], 0.0) + scale * g
+    significance = []
+    for i in range(n):
+        j = reference[i]
+        error = np.sqrt(model.redchi / np.sum((derivative[j] * weights) ** 2))
+        significance.append(abs(fitparams[f"g{j}_amplitude"].value / error))
+    return significance
+
+
+def build_spectrum(
+    redshift,
+    x,
+    y,
+    wl_line,
+    wl_subset_indices,
+    model,
+    verbose,
+    SN_limit,
+    rest_spectral_resolution,
+    cosmo,
+    units,
+    pixel,
+    center_constraint=None,
+    flag=None,
+    baseline=None,
+) -> Spectrum:
+    """
+    Turn the model selected for a group of lines into measurements: detected 
+    lines, upper limits for the nondetections and lines without coverage. The
+    wavelengths, fluxes and lengths are plain, in the units of the spectrum; 
+    this is where the units are attached again.
+    Input: 
+        redshift: redshift of the source
+        x: usually an array of wavelengths
+        y: usually an array of fluxes
+        wl_line: wavelengths of all the lines in the group
+        wl_subset_indices: indices of the lines that are part of the model
+        model: selected model fit (lmfit or native)
+        verbose: print notes on the lines without coverage
+        SN_limit: signal to noise limit for detections
+        rest_spectral_resolution: restframed FWHM of the instrument
+        cosmo: cosmological parameters
+        units: Units of the wavelengths and fluxes
+        pixel: width of a pixel around the lines
+        center_constraint: center constraint used for the model, recorded in
+                           the output
+        flag: limit reached while fitting the group, recorded in the output
+        baseline: global continuum at x, subtracted from y before the fit, or
+                  None
+    Return:
+        Spectrum with continuum, detected lines and upper limits
+    """
     # Calculate upper limit, by subtracting best fit model and then calculating
     # the upper limit from the rms noise on the residuals
-    residual = y.value - model.eval(x=x.value)
-    ul = upper_limit(residual, x.value, SN_limit, rest_spectral_resolution.value)
+    residual = y - model.eval(x=x)
+    ul = upper_limit(residual, pixel, SN_limit, rest_spectral_resolution)
+
+    # Lines with fewer pixels within the resolution than expected from the
+    # dispersion are not covered by the spectrum
+    no_coverage = [
+        np.sum(~so.mask_line(x, wl, 1.01 * rest_spectral_resolution,))
+        < rest_spectral_resolution // pixel
+        for wl in wl_line
+    ]
 
     # Print a note when the spectrum does not cover one of the lines to be fit
     if verbose == True:
         for i, wl in enumerate(wl_line):
-            if (i not in wl_subset_indices) and np.sum(
-                ~so.mask_line(x, wl_line[i], 1.01 * rest_spectral_resolution,)
-            ) < rest_spectral_resolution // so.dispersion(x):
-                print(Fore.BLUE + f"No spectral coverage on line {wl_line[i]}")
+            if (i not in wl_subset_indices) and no_coverage[i]:
+                print(
+                    Fore.BLUE
+                    + f"No spectral coverage on line {wl_line[i] * units.wavelength}"
+                )
             else:
                 continue
 
+    # Continuum at each line: the fitted constant, on top of the global
+    # continuum if it was subtracted before the fit
+    fitparams = model.params
+    continuum = RandomVariable.from_param(fitparams["c"])
+    line_continuum = [continuum] * len(wl_line)
+    if baseline is not None:
+        line_continuum = [continuum + b for b in np.interp(wl_line, x, baseline)]
+        continuum = continuum + np.median(baseline)
+
     # Add line measurements, nondetections and lines without coverage into a
     # Spectrum class format
-    fitparams = model.params
+    wl_unit, flux_unit = units.wavelength, units.flux
     return Spectrum(
-        continuum=RandomVariable.from_param(fitparams["c"]) * y.unit,
+        continuum=continuum * flux_unit,
         lines=[
             Line(
                 wavelength=RandomVariable.from_param(
                     fitparams[f"g{wl_subset_indices.index(i)}_center"]
                 )
-                * x.unit,
+                * wl_unit,
                 height=RandomVariable.from_param(
                     fitparams[f"g{wl_subset_indices.index(i)}_height"]
                 )
-                * y.unit,
+                * flux_unit,
                 sigma=RandomVariable.from_param(
                     fitparams[f"g{wl_subset_indices.index(i)}_sigma"]
                 )
-                * x.unit,
+                * wl_unit,
                 amplitude=RandomVariable.from_param(
                     fitparams[f"g{wl_subset_indices.index(i)}_amplitude"]
                 )
-                * x.unit
-                * y.unit,
+                * (wl_unit * flux_unit),
                 fwhm=RandomVariable.from_param(
                     fitparams[f"g{wl_subset_indices.index(i)}_fwhm"]
                 )
-                * x.unit,
+                * wl_unit,
                 z=redshift,
-                restwl=wl_line[i],
-                continuum=RandomVariable.from_param(fitparams["c"]) * y.unit,
+                restwl=wl_line[i] * wl_unit,
+                continuum=line_continuum[i] * flux_unit,
                 cosmo=cosmo,
-                resolution=rest_spectral_resolution,
+                resolution=rest_spectral_resolution * wl_unit,
+                center_constraint=center_constraint,
+                flag=flag,
             )
             if i in wl_subset_indices
             else NoCoverage(
                 z=redshift,
-                restwl=wl_line[i],
-                continuum=RandomVariable.from_param(fitparams["c"]) * y.unit,
+                restwl=wl_line[i] * wl_unit,
+                continuum=line_continuum[i] * flux_unit,
             )
-            if np.sum(~so.mask_line(x, wl_line[i], 1.01 * rest_spectral_resolution,))
-            < rest_spectral_resolution // so.dispersion(x)
+            if no_coverage[i]
             else NonDetection(
-                amplitude=ul * x.unit * y.unit,
+                amplitude=ul * (wl_unit * flux_unit),
                 z=redshift,
-                restwl=wl_line[i],
-                continuum=RandomVariable.from_param(fitparams["c"]) * y.unit,
+                restwl=wl_line[i] * wl_unit,
+                continuum=line_continuum[i] * flux_unit,
                 cosmo=cosmo,
+                center_constraint=center_constraint,
+                flag=flag,
             )
             for i in range(len(wl_line))
         ],
@@ -673,10 +1639,20 @@ def fit_model(
     cont_width,
     w,
     rest_spectral_resolution,
+    engine="lmfit",
+    init=None,
+    calc_covar=True,
+    sigma_constraint="free",
+    kinematics="independent",
+    ratios=None,
+    coarse=None,
+    max_nfev=None,
+    precision="double",
+    offset=None,
 ) -> ModelResult:
     """
     Fits a number of Gaussians plus a constant continuum to the given data with 
-    the package `lmfit'
+    the package `lmfit' or with the native Levenberg-Marquardt solver
     !!! Assumes the spectra are restframe !!!
     Input:
         redshift: redshift of the source
@@ -699,21 +1675,115 @@ def fit_model(
         SN_limit: signal to noise limit for detections
         rest_spectral_resolution: restframed FWHM of the instrument
         cosmo: cosmological parameters
+        engine: "lmfit" or "native"
+        init: optional starting values of the parameters, e.g. from a previous
+              fit, in the units of the data
+        calc_covar: whether to compute the uncertainties of the parameters
+        sigma_constraint: let free or fix the sigma of the Gaussians to the 
+                          instrumental resolution when fitting
+        kinematics: "independent" or "tied"; tied lines share a single 
+                    velocity offset and velocity dispersion
+        ratios: fixed flux ratios, as returned by amplitude_ratios
+        coarse: if set and no starting values are given, first fit the data 
+                binned by this factor and start from its parameters; the fits
+                share max_nfev
+        max_nfev: maximum number of function evaluations; a fit stopped by
+                  this limit has no error bars
+        precision: "double" or "single"; floating point precision of the data
+                   in the native solver. lmfit always works in double 
+                   precision.
+        offset: if set, bound on the absolute value of the continuum, in the 
+                units of the data, e.g. for the residual offset left by a 
+                global continuum
     Output:
         parameter fits of the Gaussian(s) + continuum
     """
+    dtype = float_type(precision)
+    x = x.astype(dtype=dtype)
+    y = y.astype(dtype=dtype)
+    ystd = ystd.astype(dtype=dtype)
+
+    # With fixed centers and sigmas, only the amplitudes and the continuum are
+    # free and the model is linear: the native solver then solves the normal
+    # equations directly, without iterating
+    if engine == "native":
+        try:
+            return fit_model_native(
+                x,
+                y,
+                ystd,
+                wl_line,
+                center_constraint,
+                verbose,
+                cont_width,
+                w,
+                rest_spectral_resolution,
+                init,
+                calc_covar,
+                sigma_constraint,
+                kinematics,
+                ratios,
+                coarse,
+                max_nfev,
+                precision,
+                offset,
+            )
+        except (ValueError, np.linalg.LinAlgError) as error:
+            no_model(error)
+
+    # lmfit evaluates the model and its numerical derivatives in double
+    # precision
     x = x.astype(dtype=np.float64)
     y = y.astype(dtype=np.float64)
     ystd = ystd.astype(dtype=np.float64)
+
+    # Fit a binned copy of the data first, which is cheaper per iteration, and
+    # only refine that solution on the full resolution data
+    spent_nfev = 0
+    seeded = False
+    if (
+        coarse
+        and coarse > 1
+        and init is None
+        and len(x) // coarse > 3 * len(wl_line) + 1
+    ):
+        # Same averaging as so.bin_spectrum, but in double precision
+        size = len(x) // coarse * coarse
+        rough = fit_model(
+            redshift,
+            so.average_(x[:size], coarse),
+            so.average_(y[:size], coarse),
+            so.average_err(ystd[:size], coarse),
+            wl_line,
+            center_constraint,
+            False,
+            cont_width,
+            w,
+            rest_spectral_resolution,
+            engine,
+            calc_covar=False,
+            sigma_constraint=sigma_constraint,
+            kinematics=kinematics,
+            ratios=ratios,
+            max_nfev=max_nfev,
+            offset=offset,
+        )
+        # Start from all the parameters of the binned fit; all fits share the
+        # budget of function evaluations
+        init = warm_start(rough.params, len(wl_line))
+        seeded = True
+        spent_nfev = rough.nfev
+        if max_nfev is not None:
+            max_nfev = max(max_nfev - spent_nfev, 1)
+
     # make a model that is a number of Gaussians + a constant:
     model = sum(
-        (GaussianModel(prefix=f"g{i}_") for i in range(len(wl_line.value))),
-        ConstantModel(),
+        (GaussianModel(prefix=f"g{i}_") for i in range(len(wl_line))), ConstantModel(),
     )
 
     # rescale the flux scale to get numbers comparable to the wavelength and
     # avoid numerical instabilities
-    flux_scale = 1.0 / np.std(y).value * cont_width.value
+    flux_scale = 1.0 / np.std(y) * cont_width
     y = y * flux_scale
     ystd = ystd * flux_scale
 
@@ -731,7 +1801,7 @@ def fit_model(
     elif center_constraint == "constrained":
         for i, wl in enumerate(wl_line):
             model.set_param_hint(
-                f"g{i}_center", value=wl.value, min=(wl - w).value, max=(wl + w).value,
+                f"g{i}_center", value=wl, min=wl - w, max=wl + w,
             )
 
     # If no fixing or constraining is done, then constrain the center to be
@@ -740,90 +1810,482 @@ def fit_model(
     else:
         for i, wl in enumerate(wl_line):
             model.set_param_hint(
-                f"g{i}_center",
-                value=wl.value,
-                min=(wl - cont_width).value,
-                max=(wl + cont_width).value,
+                f"g{i}_center", value=wl, min=wl - cont_width, max=wl + cont_width,
             )
 
-    # Constrain the FWHM, sigma, height and amplitude to reasonable values which
-    # depend of wavelength pixel size and the continuum
-    pixel = so.dispersion(x)
+    # Starting values from the local moments of the spectrum around each line
+    _, center_min, center_max, _ = center_bounds(
+        wl_line, center_constraint, cont_width, w
+    )
+    height, center, sigma, ctr = moment_guess(
+        x,
+        y,
+        wl_line,
+        rest_spectral_resolution,
+        center_min,
+        center_max,
+        sigma_constraint,
+    )
 
-    for i, wl in enumerate(wl_line.value):
-        # FWHM & sigma: average between minimum and maximum expected width
+    for i, wl in enumerate(wl_line):
+        # FWHM & sigma: from the second moment of the line, at least a quarter
+        # of the resolution
         model.set_param_hint(
             f"g{i}_fwhm",
-            value=rest_spectral_resolution.value,
-            min=rest_spectral_resolution.value / 4,
+            value=so.sigma_to_fwhm(sigma[i]),
+            min=rest_spectral_resolution / 4,
         )
         model.set_param_hint(
             f"g{i}_sigma",
-            value=so.fwhm_to_sigma(rest_spectral_resolution.value),
-            min=so.fwhm_to_sigma(rest_spectral_resolution.value / 4),
-        )
-        # Height & amplitude: maximum y value - median of continuum
-        model.set_param_hint(
-            f"g{i}_height", value=max(y.value, key=abs) - np.median(y).value
+            value=sigma[i],
+            min=so.fwhm_to_sigma(rest_spectral_resolution / 4),
+            vary=sigma_constraint != "fixed",
         )
+        # Height & amplitude: peak of the line above the continuum
+        model.set_param_hint(f"g{i}_height", value=height[i])
         model.set_param_hint(
-            f"g{i}_amplitude",
-            value=so.height_to_amplitude(
-                max(y.value, key=abs) - np.median(y).value,
-                so.fwhm_to_sigma(rest_spectral_resolution.value),
-            ),
+            f"g{i}_amplitude", value=so.height_to_amplitude(height[i], sigma[i]),
         )
 
-    # Set the continuum to the median of the selected range
-    ctr = np.median(y).value
+    # Set the continuum to the median of the pixels away from the lines
     params = model.make_params(
-        c=ctr, **{f"g{i}_center": wl for i, wl in enumerate(wl_line.value)}
+        c=ctr, **{f"g{i}_center": value for i, value in enumerate(center)}
     )
+    if offset:
+        params["c"].set(min=-offset * flux_scale, max=offset * flux_scale)
+
+    # Tie parameters to those of other lines. The bounds of a tied parameter
+    # move to the parameter it is tied to
+    for name, (leader, scale) in tied_parameters(
+        wl_line, center_constraint, sigma_constraint, kinematics, ratios
+    ).items():
+        low, high = sorted((params[name].min / scale, params[name].max / scale))
+        params[leader].set(
+            min=max(params[leader].min, low), max=min(params[leader].max, high)
+        )
+        params[name].set(expr=f"{leader} * {scale}", min=-np.inf, max=np.inf)
+
+    # Start from given values, e.g. a previous fit, with the flux rescaled;
+    # lmfit keeps them within the bounds. Gaussians of the binned fit that
+    # moved to another feature keep their usual starting values
+    start = params
+    if init is not None:
+        start = params.copy()
+        if seeded:
+            moved = nf.moved(
+                center, sigma, [init[f"g{i}_center"] for i in range(len(wl_line))]
+            )
+            init = {
+                name: value
+                for name, value in init.items()
+                if name == "c" or not moved[int(name[1 : name.index("_")])]
+            }
+        for name, value in init.items():
+            scale = flux_scale if name == "c" or name.endswith("_amplitude") else 1
+            if start[name].expr is None:
+                start[name].value = value * scale
 
     # perform a least squares fit with errors taken into account as i.e. 1/sigma
     try:
         result: ModelResult = model.fit(
-            y.value, params, x=x.value, weights=1.0 / ystd.value
+            y, start, x=x, weights=1.0 / ystd, calc_covar=calc_covar, max_nfev=max_nfev,
         )
-        if verbose == True:
-            print(result.fit_report())
-        try:
-            result.params["c"].value = result.params["c"].value / flux_scale
-        except:
-            pass
-        try:
-            result.params["c"].stderr = result.params["c"].stderr / flux_scale
-        except:
-            pass
-        for i, wl in enumerate(wl_line.value):
-            try:
-                result.params[f"g{i}_amplitude"].value = (
-                    result.params[f"g{i}_amplitude"].value / flux_scale
-                )
-            except:
-                pass
-            try:
-                result.params[f"g{i}_amplitude"].stderr = (
-                    result.params[f"g{i}_amplitude"].stderr / flux_scale
-                )
-            except:
-                pass
-            try:
-                result.params[f"g{i}_height"].value = (
-                    result.params[f"g{i}_height"].value / flux_scale
-                )
-            except:
-                pass
-            try:
-                result.params[f"g{i}_height"].stderr = (
-                    result.params[f"g{i}_height"].stderr / flux_scale
-                )
-            except:
-                pass
+        # The fit that starts from the binned fit is only kept if it converged
+        # below the chi-square of the usual starting values, which a direct fit
+        # can only improve on; otherwise it went astray and the data are fit
+        # again directly
+        if seeded and not (
+            result.success
+            and result.chisqr <= np.sum(((y - model.eval(params, x=x)) / ystd) ** 2)
+        ):
+            spent_nfev += result.nfev
+            result = model.fit(
+                y,
+                params,
+                x=x,
+                weights=1.0 / ystd,
+                calc_covar=calc_covar,
+                max_nfev=None if max_nfev is None else max(max_nfev - result.nfev, 1),
+            )
+    except (ValueError, np.linalg.LinAlgError) as error:
+        no_model(error)
+    result.nfev += spent_nfev
+    if verbose == True:
+        print(result.fit_report())
+
+    # Undo the rescaling of the fluxes; parameters without uncertainties have
+    # no stderr
+    for name in ["c"] + [
+        f"g{i}_{kind}" for i in range(len(wl_line)) for kind in ("amplitude", "height")
+    ]:
+        result.params[name].value = result.params[name].value / flux_scale
+        if result.params[name].stderr is not None:
+            result.params[name].stderr = result.params[name].stderr / flux_scale
+    return result
+
+
+def no_model(error):
+    """
+    Stop when a model cannot be fit at all, e.g. because of invalid data, in
+    the same way for both engines
+    Input:
+        error: exception raised by the fit
+    """
+    print(Fore.RED + f"No model could be fit: {error}")
+    sys.exit("Error!")
+
+
+def continuum_offset(y, baseline):
+    """
+    Bound on the constant fitted on top of a global continuum, which only 
+    absorbs a residual offset: three times the rms of the flux left after 
+    subtracting the global continuum
+    Input:
+        y: flux, with the global continuum already subtracted
+        baseline: global continuum, or None if the continuum is local
+    Output:
+        bound on the absolute value of the constant, or None if it is free
+    """
+    if baseline is None:
+        return None
+    return 3 * so.spectrum_rms(y)
+
+
+def float_type(precision):
+    """
+    Floating point type of the data in the fits, for the chosen precision
+    """
+    return np.float32 if precision == "single" else np.float64
+
+
+def center_bounds(wl_line, center_constraint, cont_width, w):
+    """
+    Starting values and bounds for the centers of the Gaussians, depending on
+    the center constraint
+    Input:
+        wl_line: wavelengths of the lines to be fit
+        center_constraint: fix, constrain or let free the centers of the Gaussians
+        cont_width: the amount left and right of the lines used for continuum
+                    estimation
+        w: region to be probed left and right of the starting wavelength 
+           solution when fitting the Gaussian
+    Return:
+        center, lower bound, upper bound and whether the center varies
+    """
+    center = np.atleast_1d(wl_line).astype(np.float64)
+    if center_constraint == "fixed":
+        return center, center, center, np.zeros_like(center, dtype=bool)
+    if center_constraint == "constrained":
+        width = w
+    else:
+        width = cont_width
+    return center, center - width, center + width, np.ones_like(center, dtype=bool)
+
+
+def moment_guess(
+    x, y, wl_line, rest_spectral_resolution, center_min, center_max, sigma_constraint
+):
+    """
+    Starting values for the Gaussians and the continuum, from the local moments
+    of the spectrum around each line, computed for all lines at once. The
+    continuum is the median of the pixels away from all lines; the height,
+    center and sigma of each Gaussian are the peak, centroid and second moment
+    of the continuum-subtracted flux within one resolution element of the line.
+    Input:
+        x: array of wavelengths, without units
+        y: array of fluxes, without units
+        wl_line: wavelengths of the lines to be fit, without units
+        rest_spectral_resolution: restframed FWHM of the instrument, without
+                                  units
+        center_min: lower bound on the center of each Gaussian
+        center_max: upper bound on the center of each Gaussian
+        sigma_constraint: let free or fix the sigma of the Gaussians to the
+                          instrumental resolution when fitting
+    Return:
+        height, center and sigma of each Gaussian and the continuum
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    wl_line = np.atleast_1d(np.asarray(wl_line, dtype=np.float64))
+    sigma_res = so.fwhm_to_sigma(rest_spectral_resolution)
+
+    # Pixels within one resolution element of each line, shape (lines, pixels)
+    local = np.abs(x[None, :] - wl_line[:, None]) < rest_spectral_resolution
+    line_free = ~local.any(axis=0)
+    continuum = np.median(y[line_free] if line_free.any() else y)
+
+    # Peak of the continuum-subtracted flux; lines without any pixels nearby
+    # start from the peak of the whole spectrum
+    flux = np.where(local, y - continuum, 0.0)
+    height = flux[np.arange(len(wl_line)), np.argmax(np.abs(flux), axis=1)]
+    height = np.where(local.any(axis=1), height, y[np.argmax(np.abs(y))] - np.median(y))
+
+    # Centroid and second moment of the flux on the same side of the continuum
+    # as the peak
+    weight = np.clip(np.sign(height)[:, None] * flux, 0.0, None)
+    total = np.sum(weight, axis=1)
+    measured = total > 0
+    total = np.where(measured, total, 1.0)
+    center = np.where(measured, weight @ x / total, wl_line)
+    variance = np.sum(weight * (x[None, :] - center[:, None]) ** 2, axis=1) / total
+    sigma = np.where(measured, np.sqrt(variance), sigma_res)
+
+    center = np.clip(center, center_min, center_max)
+    if sigma_constraint == "fixed":
+        sigma = np.full_like(sigma, sigma_res)
+    else:
+        sigma = np.clip(sigma, so.fwhm_to_sigma(rest_spectral_resolution / 4), None)
+    return height, center, sigma, continuum
+
+
+def amplitude_ratios(names, wl_line, ratios):
+    """
+    Select the fixed flux ratios between lines of the same group and identify
+    the lines by their wavelength, as the lines are known to the fitting
+    Input:
+        names: names of the lines of a group
+        wl_line: wavelengths of the lines of the group, as used in the fitting
+        ratios: fixed flux ratios, mapping the name of a line to the name of
+                its reference line and the ratio of their fluxes
+    Return:
+        dict mapping the wavelength of a line to the wavelength of its 
+        reference line and the ratio, for the lines of the group
+    """
+    if not ratios:
+        return {}
+    wavelengths = dict(zip(names, wl_line))
+    return {
+        wavelengths[line]: (wavelengths[reference], ratio)
+        for line, (reference, ratio) in ratios.items()
+        if line in wavelengths and reference in wavelengths
+    }
+
+
+def tied_parameters(wl_line, center_constraint, sigma_constraint, kinematics, ratios):
+    """
+    Find the parameters of the Gaussians that are tied to parameters of other
+    Gaussians. With tied kinematics, all lines share the velocity offset and 
+    the velocity dispersion of the first line, so their centers and sigmas 
+    scale with their rest wavelength. Lines with a fixed flux ratio to another
+    line that is fit at the same time have their amplitude tied to it.
+    Input:
+        wl_line: wavelengths of the lines to be fit
+        center_constraint: fix, constrain or let free the centers of the Gaussians
+        sigma_constraint: let free or fix the sigma of the Gaussians
+        kinematics: "independent" or "tied"
+        ratios: fixed flux ratios, as returned by amplitude_ratios
+    Return:
+        dict mapping the name of each tied parameter to the name of the 
+        parameter it is tied to and the factor between them
+    """
+    wl = np.atleast_1d(wl_line)
+    ties = {}
+    if kinematics == "tied":
+        for i in range(1, len(wl)):
+            if center_constraint != "fixed":
+                ties[f"g{i}_center"] = ("g0_center", float(wl[i] / wl[0]))
+            if sigma_constraint != "fixed":
+                ties[f"g{i}_sigma"] = ("g0_sigma", float(wl[i] / wl[0]))
+
+    # Follow chains of ratios up to a line with a free amplitude, ignoring
+    # ratios to lines that are not fit and cycles
+    position = {value: i for i, value in enumerate(wl)}
+    for i in range(len(wl)):
+        j, scale, chain = i, 1.0, [i]
+        while ratios and wl[j] in ratios and ratios[wl[j]][0] in position:
+            reference, ratio = ratios[wl[j]]
+            j, scale = position[reference], scale * ratio
+            if j in chain:
+                j = i
+                break
+            chain.append(j)
+        if j != i:
+            ties[f"g{i}_amplitude"] = (f"g{j}_amplitude", float(scale))
+    return ties
+
+
+def native_problem(
+    x,
+    y,
+    ystd,
+    wl_line,
+    center_constraint,
+    cont_width,
+    w,
+    rest_spectral_resolution,
+    init=None,
+    sigma_constraint="free",
+    kinematics="independent",
+    ratios=None,
+    coarse=None,
+    precision="double",
+    offset=None,
+) -> nf.Problem:
+    """
+    Set up the fit of a number of Gaussians plus a constant continuum for the
+    native solver. Uses the same starting values and bounds as the lmfit model
+    in fit_model.
+    !!! Assumes the spectra are restframe !!!
+    Input:
+        x: usually an array of wavelengths
+        y: usually an array of fluxes
+        ystd: errors on y, usually a stdev of the flux
+        wl_line: wavelengths of the lines to be fit
+        center_constraint: fix, constrain or let free the centers of the Gaussians
+                           when fitting
+        cont_width: the amount left and right of the lines used for continuum
+                    estimation
+        w: region to be probed left and right of the starting wavelength solution
+           when fitting the Gaussian
+        rest_spectral_resolution: restframed FWHM of the instrument
+        init: optional starting values of the parameters, in the units of the 
+              data
+        sigma_constraint: let free or fix the sigma of the Gaussians to the 
+                          instrumental resolution when fitting
+        kinematics: "independent" or "tied"; tied lines share a single 
+                    velocity offset and velocity dispersion
+        ratios: fixed flux ratios, as returned by amplitude_ratios
+        coarse: if set and no starting values are given, the solver first 
+                fits the data binned by this factor
+        precision: "double" or "single"; floating point precision of the data
+        offset: if set, bound on the absolute value of the continuum, in the 
+                units of the data
+    Output:
+        fitting problem for the native solver
+    """
+    # Same check as lmfit, which cannot fit invalid data either
+    if not (np.all(np.isfinite(y)) and np.all(ystd > 0)):
+        raise ValueError("NaN values detected in the data to be fit")
+
+    # rescale the flux scale to get numbers comparable to the wavelength and
+    # avoid numerical instabilities
+    flux_scale = 1.0 / np.std(y) * cont_width
+    dtype = float_type(precision)
+    yv = np.asarray(y, dtype=dtype) * dtype(flux_scale)
+    ystdv = np.asarray(ystd, dtype=dtype) * dtype(flux_scale)
+
+    n = len(wl_line)
+    center, center_min, center_max, center_vary = center_bounds(
+        wl_line, center_constraint, cont_width, w
+    )
+    sigma_min = so.fwhm_to_sigma(rest_spectral_resolution / 4)
+    height, center, sigma, continuum = moment_guess(
+        x,
+        yv,
+        wl_line,
+        rest_spectral_resolution,
+        center_min,
+        center_max,
+        sigma_constraint,
+    )
+    amplitude = so.height_to_amplitude(height, sigma)
+    ties = tied_parameters(
+        wl_line, center_constraint, sigma_constraint, kinematics, ratios
+    )
+    # Start from given values, e.g. a previous fit, with the flux rescaled
+    if init is not None:
+        amplitude = np.array([init[f"g{i}_amplitude"] for i in range(n)]) * flux_scale
+        center = np.array([init[f"g{i}_center"] for i in range(n)], dtype=np.float64)
+        sigma = np.array([init[f"g{i}_sigma"] for i in range(n)], dtype=np.float64)
+        continuum = init["c"] * flux_scale
+    bound = offset * flux_scale if offset else np.inf
+
+    return nf.Problem(
+        x=np.asarray(x, dtype=dtype),
+        y=yv,
+        weights=1.0 / ystdv,
+        p0=nf.pack_parameters(amplitude, center, sigma, continuum)[0],
+        lower=nf.pack_parameters(
+            np.full(n, -np.inf), center_min, np.full(n, sigma_min), -bound
+        )[0],
+        upper=nf.pack_parameters(
+            np.full(n, np.inf), center_max, np.full(n, np.inf), bound
+        )[0],
+        vary=nf.pack_parameters(
+            np.ones(n), center_vary, np.full(n, sigma_constraint != "fixed"), 1
+        )[0].astype(bool),
+        flux_scale=flux_scale,
+        tie=nf.tie_matrix(n, ties) if ties else None,
+        coarse=coarse if coarse and init is None else 1,
+    )
 
-    except:
-        print(Fore.RED + "No model could be fit")
-        sys.exit("Error!")
+
+def fit_model_native(
+    x,
+    y,
+    ystd,
+    wl_line,
+    center_constraint,
+    verbose,
+    cont_width,
+    w,
+    rest_spectral_resolution,
+    init=None,
+    calc_covar=True,
+    sigma_constraint="free",
+    kinematics="independent",
+    ratios=None,
+    coarse=None,
+    max_nfev=None,
+    precision="double",
+    offset=None,
+) -> nf.NativeResult:
+    """
+    Fits a number of Gaussians plus a constant continuum to the given data with 
+    the native, vectorized Levenberg-Marquardt solver. 
+    !!! Assumes the spectra are restframe !!!
+    Input:
+        x: usually an array of wavelengths
+        y: usually an array of fluxes
+        ystd: errors on y, usually a stdev of the flux
+        wl_line: wavelengths of the lines to be fit
+        center_constraint: fix, constrain or let free the centers of the Gaussians
+                           when fitting
+        verbose: print a fit report
+        cont_width: the amount left and right of the lines used for continuum
+                    estimation
+        w: region to be probed left and right of the starting wavelength solution
+           when fitting the Gaussian
+        rest_spectral_resolution: restframed FWHM of the instrument
+        init: optional starting values of the parameters, in the units of the 
+              data
+        calc_covar: whether to compute the uncertainties of the parameters
+        sigma_constraint: let free or fix the sigma of the Gaussians to the 
+                          instrumental resolution when fitting
+        kinematics: "independent" or "tied"; tied lines share a single 
+                    velocity offset and velocity dispersion
+        ratios: fixed flux ratios, as returned by amplitude_ratios
+        coarse: if set and no starting values are given, first fit the data 
+                binned by this factor and start from its parameters; the fits
+                share max_nfev
+        max_nfev: maximum number of function evaluations, counted as in lmfit
+        precision: "double" or "single"; floating point precision of the data
+                   in the native solver
+        offset: if set, bound on the absolute value of the continuum, in the 
+                units of the data
+    Output:
+        parameter fits of the Gaussian(s) + continuum
+    """
+    problem = native_problem(
+        x,
+        y,
+        ystd,
+        wl_line,
+        center_constraint,
+        cont_width,
+        w,
+        rest_spectral_resolution,
+        init,
+        sigma_constraint,
+        kinematics,
+        ratios,
+        coarse,
+        precision,
+        offset,
+    )
+    (result,) = nf.solve([problem], max_nfev=max_nfev, calc_covar=calc_covar)
+    if verbose == True:
+        print(result.fit_report())
     return result
 
 
@@ -841,6 +2303,19 @@ def fit_lines(
     SN_limit,
     rest_spectral_resolution,
     cosmo,
+    engine="lmfit",
+    selection="exhaustive",
+    sigma_constraint="free",
+    kinematics="independent",
+    ratios=None,
+    prescreen=None,
+    parallel=False,
+    coarse=None,
+    max_nfev=None,
+    group_timeout=None,
+    source_timeout=None,
+    precision="double",
+    continuum="local",
 ):
     """
     Head function that goes through the list of lines and fits all lines for a 
@@ -866,70 +2341,542 @@ def fit_lines(
         SN_limit: signal to noise limit for detections
         rest_spectral_resolution: restframed FWHM of the instrument
         cosmo: cosmological parameters
+        engine: fitting engine, either "lmfit" or "native"
+        selection: strategy to search for the simplest good model, either 
+                   "exhaustive" or "backward"
+        sigma_constraint: let free or fix the sigma of the Gaussians to the 
+                          instrumental resolution when fitting
+        kinematics: "independent" or "tied"; tied lines share a single 
+                    velocity offset and velocity dispersion
+        ratios: fixed flux ratios, mapping the name of a line to the name of
+                its reference line and the ratio of their fluxes
+        prescreen: if set, lines with a matched-filter signal to noise below
+                   SN_limit - prescreen are not fit and get upper limits
+        parallel: fit all candidate models with the same number of lines at
+                  once; only used by the exhaustive search with the native 
+                  engine
+        coarse: if set, each model is first fit on the spectrum binned by this
+                factor, and the fit at full resolution starts from its 
+                parameters
+        max_nfev: maximum number of function evaluations of each fit
+        group_timeout: wall-clock budget for the fits of a group of lines, in
+                       seconds
+        source_timeout: wall-clock budget for the fits of all the groups of 
+                        lines of the source, in seconds
+        precision: "double" or "single"; floating point precision of the data
+                   in the native solver
+        continuum: "local" or "global"; with "global", a smooth continuum of 
+                   the whole spectrum is subtracted before fitting the groups
     Output:
         Astropy table containing details of emission lines and the Gaussian fits 
         to them
     """
+    source = PlainSource.from_tables(
+        spectrum,
+        line_list,
+        sky,
+        target["Redshift"],
+        cont_width,
+        mask_width,
+        w,
+        rest_spectral_resolution,
+        continuum,
+    )
+    source_deadline = None
+    if source_timeout is not None:
+        source_deadline = time.monotonic() + source_timeout
+    for select_group in covered_groups(
+        source.catalog, line_groups, source.wl_rest, source.units
+    ):
+        spectrum_fit, window, mask_line = do_gaussian(
+            target["Redshift"],
+            source.catalog,
+            select_group,
+            source.grid,
+            source.profile,
+            source.flux,
+            source.stdev,
+            source.continuum,
+            center_constraint,
+            verbose,
+            source.sky_bands,
+            source.cont_width,
+            source.mask_width,
+            source.w,
+            SN_limit,
+            source.rest_spectral_resolution,
+            cosmo,
+            source.units,
+            engine,
+            selection,
+            sigma_constraint,
+            kinematics,
+            amplitude_ratios(
+                line_list["line"][select_group],
+                source.catalog.wavelengths[select_group],
+                ratios,
+            ),
+            prescreen,
+            parallel,
+            coarse,
+            FitLimits.for_group(max_nfev, group_timeout, source_deadline),
+            precision,
+        )
+        yield spectrum_fit, spectrum[window][mask_line], line_list[select_group]
+
+
+def covered_groups(catalog, line_groups, wl_rest, units):
+    """
+    Go through the groups of lines and select those that fall, at least 
+    partially, within the rest-frame spectral coverage of the source
+    Input:
+        catalog: so.LineCatalog of all the lines that will be fit
+        line_groups: Astropy list of lines that will be fit, connected into 
+                     groups based on proximity
+        wl_rest: plain restframe wavelengths of the spectrum
+        units: Units of the catalog and the spectrum
+    Output:
+        for each covered group, the indices of its lines in the catalog
+    """
+    wl_min, wl_max = np.amin(wl_rest), np.amax(wl_rest)
     for group in line_groups:
-        select_group = (line_list["wavelength"] > group.beginning) & (
-            line_list["wavelength"] < group.ending
+        select_group = catalog.between(
+            group.beginning.to_value(units.wavelength),
+            group.ending.to_value(units.wavelength),
+        )
+        wl_group = catalog.wavelengths[select_group]
+        if (wl_group < wl_min).all() | (wl_group > wl_max).all():
+            continue
+        yield select_group
+
+
+@dataclass
+class GroupWindow:
+    """
+    The spectrum of a single source extracted around a group of lines, together
+    with the fitting parameters of that source. Windows of the same group of
+    lines from many sources can be fit together. The fitting uses the plain 
+    arrays and lengths, in the units of the spectrum, with the global 
+    continuum (if any) already subtracted from the fluxes; the tables are kept
+    for the output.
+    """
+
+    redshift: float
+    spectrum_line: QTable
+    lines: QTable
+    x: np.ndarray
+    y: np.ndarray
+    ystd: np.ndarray
+    wl_line: np.ndarray
+    units: Units
+    pixel: float
+    baseline: Optional[np.ndarray]
+    center_constraint: str
+    cont_width: float
+    w: float
+    SN_limit: float
+    rest_spectral_resolution: float
+    cosmo: FlatLambdaCDM
+    engine: str
+    selection: str
+    sigma_constraint: str
+    kinematics: str
+    ratios: dict
+    prescreen: Optional[float]
+    parallel: bool
+    coarse: Optional[int]
+    max_nfev: Optional[int]
+    group_timeout: Optional[float]
+    source_timeout: Optional[float]
+    clock: SourceClock
+    precision: str
+
+    @property
+    def key(self):
+        # Windows with the same lines can be fit in the same batch
+        return tuple(self.lines["line"])
+
+    def limits(self) -> FitLimits:
+        """
+        Limits for the fits of the window, starting now on the clock of its 
+        source, which starts at 0 for the first window
+        """
+        return FitLimits.for_group(
+            self.max_nfev, self.group_timeout, self.source_timeout, self.clock
+        )
+
+
+def extract_windows(
+    target,
+    spectrum,
+    line_list,
+    line_groups,
+    center_constraint,
+    sky,
+    cont_width,
+    mask_width,
+    w,
+    SN_limit,
+    rest_spectral_resolution,
+    cosmo,
+    engine="lmfit",
+    selection="exhaustive",
+    sigma_constraint="free",
+    kinematics="independent",
+    ratios=None,
+    prescreen=None,
+    parallel=False,
+    coarse=None,
+    max_nfev=None,
+    group_timeout=None,
+    source_timeout=None,
+    precision="double",
+    continuum="local",
+) -> List[GroupWindow]:
+    """
+    Extract the spectrum around each group of lines covered by the spectrum of
+    a source, without fitting it
+    Input:
+        see fit_lines
+    Output:
+        list of GroupWindow, in the order of the line groups, sharing the 
+        SourceClock of the source
+    """
+    source = PlainSource.from_tables(
+        spectrum,
+        line_list,
+        sky,
+        target["Redshift"],
+        cont_width,
+        mask_width,
+        w,
+        rest_spectral_resolution,
+        continuum,
+    )
+    clock = SourceClock()
+    windows = []
+    for select_group in covered_groups(
+        source.catalog, line_groups, source.wl_rest, source.units
+    ):
+        window, mask_line = so.select_window(
+            source.grid,
+            source.catalog,
+            select_group,
+            source.sky_bands,
+            source.cont_width,
+            source.mask_width,
+        )
+        y = source.flux[window][mask_line]
+        baseline = None
+        if source.continuum is not None:
+            baseline = source.continuum[window][mask_line]
+            y = y - baseline
+        windows.append(
+            GroupWindow(
+                redshift=target["Redshift"],
+                spectrum_line=spectrum[window][mask_line],
+                lines=line_list[select_group],
+                x=source.wl_rest[window][mask_line],
+                y=y,
+                ystd=source.stdev[window][mask_line],
+                wl_line=source.catalog.wavelengths[select_group],
+                units=source.units,
+                pixel=source.profile.pixel(window, mask_line),
+                baseline=baseline,
+                center_constraint=center_constraint,
+                cont_width=source.cont_width,
+                w=source.w,
+                SN_limit=SN_limit,
+                rest_spectral_resolution=source.rest_spectral_resolution,
+                cosmo=cosmo,
+                engine=engine,
+                selection=selection,
+                sigma_constraint=sigma_constraint,
+                kinematics=kinematics,
+                ratios=amplitude_ratios(
+                    line_list["line"][select_group],
+                    source.catalog.wavelengths[select_group],
+                    ratios,
+                ),
+                prescreen=prescreen,
+                parallel=parallel,
+                coarse=coarse,
+                max_nfev=max_nfev,
+                group_timeout=group_timeout,
+                source_timeout=source_timeout,
+                clock=clock,
+                precision=precision,
+            )
         )
+    return windows
+
+
+def fit_windows(windows: List[GroupWindow], verbose) -> List[Spectrum]:
+    """
+    Fit many windows, usually coming from many sources. Windows of the same
+    group of lines that use the native engine, the exhaustive model search and
+    a fixed choice of center constraint are fit together, as a batch; all 
+    other windows are fit one by one. The time limits of each window are 
+    measured on the clock of its source, so they do not depend on the other
+    sources that are fit with it.
+    Input:
+        windows: list of extracted windows
+        verbose: print full fit output
+    Output:
+        list of Spectrum (or None, if no model could be fit), one per window
+    """
+    fits = [None] * len(windows)
+    limits = [None] * len(windows)
+    batches = {}
+    for k, window in enumerate(windows):
         if (
-            (line_list["wavelength"][select_group] < np.amin(spectrum["wl_rest"])).all()
-            == True
-        ) | (
-            (line_list["wavelength"][select_group] > np.amax(spectrum["wl_rest"])).all()
-            == True
+            window.engine == "native"
+            and window.selection == "exhaustive"
+            and window.center_constraint != "auto"
         ):
-            continue
+            # Windows where the prescreen leaves the same lines are fit
+            # together. As for a single source, the limits of the window start
+            # before the prescreen
+            with window.clock.running():
+                limits[k] = window.limits()
+                candidates = prescreen_lines(
+                    window.x,
+                    window.y,
+                    window.ystd,
+                    window.wl_line,
+                    window.center_constraint,
+                    window.sigma_constraint,
+                    window.cont_width,
+                    window.w,
+                    window.SN_limit,
+                    window.rest_spectral_resolution,
+                    window.prescreen,
+                )
+            batches.setdefault((window.key, candidates, window.max_nfev), []).append(k)
         else:
-            spectrum_fit, spectrum_line = do_gaussian(
-                line_list[select_group],
-                line_list[~select_group],
-                spectrum,
-                target,
-                center_constraint,
-                verbose,
-                sky,
-                cont_width,
-                mask_width,
-                w,
-                SN_limit,
-                rest_spectral_resolution,
-                cosmo,
-            )
-            yield spectrum_fit, spectrum_line, line_list[select_group]
+            with window.clock.running():
+                fits[k] = model_selection(
+                    window.redshift,
+                    window.x,
+                    window.y,
+                    window.ystd,
+                    window.wl_line,
+                    window.center_constraint,
+                    verbose,
+                    window.cont_width,
+                    window.w,
+                    window.SN_limit,
+                    window.rest_spectral_resolution,
+                    window.cosmo,
+                    window.units,
+                    window.pixel,
+                    window.engine,
+                    window.selection,
+                    window.sigma_constraint,
+                    window.kinematics,
+                    window.ratios,
+                    window.prescreen,
+                    window.parallel,
+                    window.coarse,
+                    window.limits(),
+                    window.precision,
+                    window.baseline,
+                )
+    for (_, candidates, _), indices in batches.items():
+        batch_fits = model_selection_batch(
+            [windows[k] for k in indices],
+            verbose,
+            candidates,
+            [limits[k] for k in indices],
+        )
+        for k, spectrum_fit in zip(indices, batch_fits):
+            fits[k] = spectrum_fit
+    return fits
+
+
+def model_selection_batch(
+    windows: List[GroupWindow], verbose, candidates=None, limits=None
+) -> List[Spectrum]:
+    """
+    Same model selection as in model_selection, but for the same group of 
+    lines in many sources at once. For each subset of lines, all sources that
+    do not yet have a good model are fit together with the native solver. The
+    subsets are tried in the same order as in model_selection, so every source 
+    gets the same model it would get when fit on its own. Sources that run out
+    of time are only fit with the continuum. Each window has its own limits,
+    and the time of each batched fit is charged in equal shares to the clocks
+    of the sources in it.
+    Input:
+        windows: windows of the same group of lines, from different sources,
+                 with the same maximum number of function evaluations
+        verbose: print full fit output
+        candidates: indices of the lines left by the prescreen, the same for 
+                    all windows; all lines if None
+        limits: FitLimits of each window, or None to start them now
+    Output:
+        list of Spectrum (or None, if no model could be fit), one per window
+    """
+    if candidates is None:
+        candidates = tuple(range(len(windows[0].wl_line)))
+    if limits is None:
+        limits = [window.limits() for window in windows]
+    selected = [None] * len(windows)
+    pending = list(range(len(windows)))
+    for subset in subsets(len(candidates)):
+        pending = [k for k in pending if not limits[k].expired]
+        if not pending:
+            break
+        wl_subset_indices = tuple(candidates[i] for i in subset)
+        start = time.monotonic()
+        try:
+            problems = [
+                native_problem(
+                    windows[k].x,
+                    windows[k].y,
+                    windows[k].ystd,
+                    windows[k].wl_line[list(wl_subset_indices)],
+                    windows[k].center_constraint,
+                    windows[k].cont_width,
+                    windows[k].w,
+                    windows[k].rest_spectral_resolution,
+                    sigma_constraint=windows[k].sigma_constraint,
+                    kinematics=windows[k].kinematics,
+                    ratios=windows[k].ratios,
+                    coarse=windows[k].coarse,
+                    precision=windows[k].precision,
+                    offset=continuum_offset(windows[k].y, windows[k].baseline),
+                )
+                for k in pending
+            ]
+            models = nf.solve(problems, max_nfev=windows[0].max_nfev)
+        except (ValueError, np.linalg.LinAlgError) as error:
+            no_model(error)
+        share = (time.monotonic() - start) / len(pending)
+        for k in pending:
+            windows[k].clock.charge(share)
+        still_pending = []
+        for k, model in zip(pending, models):
+            if verbose == True:
+                print(model.fit_report())
+            limits[k].check_fit(model)
+            if is_good(model, windows[k].SN_limit):
+                selected[k] = (wl_subset_indices, model)
+            else:
+                if verbose == True:
+                    print(
+                        Fore.BLUE
+                        + f"NonDetection when fitting set of lines {windows[k].wl_line[list(wl_subset_indices)]}, try a simpler model"
+                    )
+                still_pending.append(k)
+        pending = still_pending
+
+    # Out of time: fall back to the continuum alone and give upper limits for
+    # all lines
+    timed_out = [
+        k
+        for k, selection in enumerate(selected)
+        if selection is None and limits[k].expired
+    ]
+    problems = [
+        native_problem(
+            windows[k].x,
+            windows[k].y,
+            windows[k].ystd,
+            windows[k].wl_line[[]],
+            windows[k].center_constraint,
+            windows[k].cont_width,
+            windows[k].w,
+            windows[k].rest_spectral_resolution,
+            precision=windows[k].precision,
+            offset=continuum_offset(windows[k].y, windows[k].baseline),
+        )
+        for k in timed_out
+    ]
+    for k, model in zip(timed_out, nf.solve(problems)):
+        print(
+            Fore.YELLOW
+            + f"Warning: out of time when fitting lines {windows[k].wl_line * windows[k].units.wavelength}"
+        )
+        limits[k].reached = limits[k].timeout
+        selected[k] = ((), model)
+
+    return [
+        None
+        if selection is None
+        else build_spectrum(
+            window.redshift,
+            window.x,
+            window.y,
+            window.wl_line,
+            selection[0],
+            selection[1],
+            verbose,
+            window.SN_limit,
+            window.rest_spectral_resolution,
+            window.cosmo,
+            window.units,
+            window.pixel,
+            window.center_constraint,
+            limit.reached,
+            window.baseline,
+        )
+        for window, selection, limit in zip(windows, selected, limits)
+    ]
 
 
 def do_gaussian(
-    selected_lines,
-    other_lines,
-    spectrum,
-    target,
+    redshift,
+    catalog,
+    select_group,
+    grid,
+    profile,
+    y,
+    ystd,
+    continuum,
     center_constraint,
     verbose,
-    sky,
+    sky_bands,
     cont_width,
     mask_width,
     w,
     SN_limit,
     rest_spectral_resolution,
     cosmo,
+    units,
+    engine="lmfit",
+    selection="exhaustive",
+    sigma_constraint="free",
+    kinematics="independent",
+    ratios=None,
+    prescreen=None,
+    parallel=False,
+    coarse=None,
+    limits=None,
+    precision="double",
 ):
     """
     Selects the spectrum around an emission line of interest. Then fits a single
     Gaussian plus a constant continuum to the given data with the package `lmfit'
     !!! Assumes the spectrum is restframe !!!
+    All wavelengths, fluxes and lengths are plain arrays and numbers, in the 
+    units of the spectrum.
     Input:
-        selected_lines: lines to be fit jointly
-        other_lines: other lines in the catalog. Is used to mask other lines 
-                     that might contaminate the continuum estimation.
-        spectrum: fits table containing, the wavelength, flux and error of flux
-        target: fits row with properties of the source, esp. its redshift
+        redshift: redshift of the source
+        catalog: so.LineCatalog of all the lines. The other lines in the 
+                 catalog are masked, as they might contaminate the continuum
+                 estimation.
+        select_group: indices of the lines to be fit jointly in the catalog
+        grid: so.Grid of the restframe wavelengths of the spectrum
+        profile: so.DispersionProfile of the spectrum
+        y: fluxes of the spectrum
+        ystd: errors on the fluxes
+        continuum: global continuum of the spectrum, which is subtracted 
+                   before the fit, or None
         center_constraint: fix, constrain or let free the centers of the Gaussians
                            when fitting
         verbose: print full lmfit output
-        sky: sky contaminated areas to mask. If None, nothing will be masked
+        sky_bands: restframe sky bands to mask, as returned by so.sky_bands. If
+                   None, nothing will be masked
         cont_width: the amount left and right of the lines used for continuum
                     estimation
         mask_width: if another line B falls within the region selected for 
@@ -940,25 +2887,51 @@ def do_gaussian(
         SN_limit: signal to noise limit for detections
         rest_spectral_resolution: restframed FWHM of the instrument
         cosmo: cosmological parameters
+        units: Units of the wavelengths and fluxes
+        engine: fitting engine, either "lmfit" or "native"
+        selection: strategy to search for the simplest good model, either 
+                   "exhaustive" or "backward"
+        sigma_constraint: let free or fix the sigma of the Gaussians to the 
+                          instrumental resolution when fitting
+        kinematics: "independent" or "tied"; tied lines share a single 
+                    velocity offset and velocity dispersion
+        ratios: fixed flux ratios, as returned by amplitude_ratios
+        prescreen: if set, lines with a matched-filter signal to noise below
+                   SN_limit - prescreen are not fit and get upper limits
+        parallel: fit all candidate models with the same number of lines at
+                  once; only used by the exhaustive search with the native 
+                  engine
+        coarse: if set, each model is first fit on the spectrum binned by this
+                factor, and the fit at full resolution starts from its 
+                parameters
+        limits: FitLimits of the group
+        precision: "double" or "single"; floating point precision of the data
+                   in the native solver
     Output:
         spectrum_fit: parameters of the fit around the doublet
-        spectrum_line: extracted spectrum around the lines    
+        window: slice of the spectrum around the lines
+        mask_line: mask within the window that selects the spectrum used for
+                   the fit
     """
     # Mask the region around the line
-    mask_line = so.select_lines(
-        selected_lines, other_lines, spectrum, target, sky, cont_width, mask_width,
+    window, mask_line = so.select_window(
+        grid, catalog, select_group, sky_bands, cont_width, mask_width
     )
 
-    # Create a new variable that contains the spectrum around the line
-    spectrum_line = spectrum[mask_line]
+    # Subtract the global continuum, if any
+    y_line = y[window][mask_line]
+    baseline = None
+    if continuum is not None:
+        baseline = continuum[window][mask_line]
+        y_line = y_line - baseline
 
     # Fit the gaussian(s)
     spectrum_fit = model_selection(
-        target["Redshift"],
-        spectrum_line["wl_rest"],
-        spectrum_line["flux"],
-        spectrum_line["stdev"],
-        selected_lines["wavelength"],
+        redshift,
+        grid.wl[window][mask_line],
+        y_line,
+        ystd[window][mask_line],
+        catalog.wavelengths[select_group],
         center_constraint,
         verbose,
         cont_width,
@@ -966,6 +2939,19 @@ def do_gaussian(
         SN_limit,
         rest_spectral_resolution,
         cosmo,
+        units,
+        profile.pixel(window, mask_line),
+        engine,
+        selection,
+        sigma_constraint,
+        kinematics,
+        ratios,
+        prescreen,
+        parallel,
+        coarse,
+        limits,
+        precision,
+        baseline,
     )
 
-    return spectrum_fit, spectrum_line
+    return spectrum_fit, window, mask_line
@@ -0,0 +1,240 @@
+__author__ = "Andra Stroe"
+__version__ = "0.1"
+
+import numpy as np
+from colorama import Fore
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Normalisation of a unit-area Gaussian
+SQRT_2PI = np.sqrt(2.0 * np.pi)
+
+# Backend of the kernels in use, "numpy" or "numba"
+_backend = "numpy"
+# Result of the check of the numba kernels against the numpy code, None until
+# it runs
+_verified = None
+
+
+def check():
+    """
+    Check once whether the numba kernels can be used: numba must be installed
+    and the kernels must agree with the numpy code on a test problem. The
+    result is cached, so that worker processes started after the check share it.
+    Output:
+        True if the numba kernels can be used
+    """
+    global _verified
+    if _verified is None:
+        if numba is None:
+            print(Fore.YELLOW + "Warning: numba is not installed, using numpy")
+            _verified = False
+        else:
+            _verified = verify()
+            if not _verified:
+                print(
+                    Fore.YELLOW
+                    + "Warning: numba kernels disagree with numpy, using numpy"
+                )
+    return _verified
+
+
+def use(backend):
+    """
+    Select the backend of the fitting kernels at runtime. The numba kernels
+    are only used if they passed the check; otherwise the numpy code is used.
+    Input:
+        backend: "numpy" or "numba"
+    """
+    global _backend
+    if backend == "numba" and not check():
+        backend = "numpy"
+    _backend = backend
+
+
+def enabled():
+    """
+    Whether the numba kernels are in use
+    """
+    return _backend == "numba"
+
+
+def verify():
+    """
+    Compare the numba kernels with the numpy code on a random batch of
+    problems, in single and double precision. Must be called while the numpy
+    backend is in use.
+    Return:
+        True if all kernels agree within the precision of the data
+    """
+    import gleam.native_fitting as nf
+
+    rng = np.random.default_rng(0)
+    n, npix = 3, 200
+    p = nf.pack_parameters(
+        rng.uniform(0.5, 2, (2, n)),
+        rng.uniform(40, 60, (2, n)),
+        rng.uniform(1, 3, (2, n)),
+        rng.uniform(-1, 1, 2),
+    )
+    # Include pixels that fall exactly on the ends of the intervals
+    x = np.tile(np.linspace(0, 100, npix + 1), (2, 1))
+    y = rng.normal(0, 1, (2, npix + 1))
+    weights = rng.uniform(0.5, 2, (2, npix + 1))
+    lower, upper = np.array([10.0, 50.0]), np.array([20.0, 70.0])
+
+    ok = True
+    for dtype, rtol in ((np.float64, 1e-10), (np.float32, 1e-4)):
+        xt, yt, wt = x.astype(dtype), y.astype(dtype), weights.astype(dtype)
+        model, jacobian = model_and_jacobian(xt, p)
+        expected_model, expected_jacobian = nf.model_and_jacobian(xt, p)
+        atol = rtol * np.abs(expected_jacobian).max()
+        ok &= np.allclose(model, expected_model, rtol=rtol, atol=atol)
+        ok &= np.allclose(jacobian, expected_jacobian, rtol=rtol, atol=atol)
+        ok &= np.allclose(gaussian_model(xt, p), expected_model, rtol=rtol, atol=atol)
+        ok &= np.allclose(
+            weighted_residual(yt, model, wt),
+            (yt - expected_model) * wt,
+            rtol=rtol,
+            atol=atol,
+        )
+        ok &= np.array_equal(
+            outside_intervals(xt[0], lower, upper, closed=False),
+            ~np.any((xt[0][:, None] > lower) & (xt[0][:, None] < upper), axis=1),
+        )
+        ok &= np.array_equal(
+            outside_intervals(xt[0], lower, upper, closed=True),
+            ~np.any((xt[0][:, None] >= lower) & (xt[0][:, None] <= upper), axis=1),
+        )
+    return bool(ok)
+
+
+def gaussian_model(x, p):
+    """
+    Evaluate a sum of Gaussians plus a constant, for a batch of problems
+    Input:
+        x: positions, shape (B, N)
+        p: parameters, shape (B, 3n+1), in the layout of nf.pack_parameters
+    Output:
+        model: shape (B, N), in the floating point type of x
+    """
+    p = np.asarray(p, dtype=x.dtype)
+    model = np.empty(x.shape, dtype=x.dtype)
+    _gaussian_model(x, p, model)
+    return model
+
+
+def model_and_jacobian(x, p):
+    """
+    Evaluate a sum of Gaussians plus a constant and its derivatives with
+    respect to all parameters in a single pass over the pixels, for a batch
+    of problems
+    Input:
+        x: positions, shape (B, N)
+        p: parameters, shape (B, 3n+1), in the layout of nf.pack_parameters
+    Output:
+        model: shape (B, N)
+        jacobian: shape (B, 3n+1, N)
+    """
+    p = np.asarray(p, dtype=x.dtype)
+    model = np.empty(x.shape, dtype=x.dtype)
+    jacobian = np.empty((p.shape[0], p.shape[1], x.shape[1]), dtype=x.dtype)
+    _model_and_jacobian(x, p, model, jacobian)
+    return model, jacobian
+
+
+def weighted_residual(y, model, weights):
+    """
+    Residuals of the data from the model, in units of the errors:
+    (y - model) * weights, without intermediate arrays
+    """
+    residual = np.empty(y.shape, dtype=np.result_type(y, model, weights))
+    _weighted_residual(y, model, weights, residual)
+    return residual
+
+
+def outside_intervals(x, lower, upper, closed):
+    """
+    Mask of the positions that fall outside all the intervals (lower, upper).
+    The ends are compared in the floating point type of x, as numpy does.
+    Input:
+        x: positions, shape (N,)
+        lower, upper: ends of the intervals, shape (M,)
+        closed: whether the ends belong to the intervals
+    Output:
+        boolean mask, shape (N,)
+    """
+    x = np.ascontiguousarray(x)
+    mask = np.empty(x.shape, dtype=np.bool_)
+    _outside_intervals(
+        x,
+        np.ascontiguousarray(lower, dtype=x.dtype),
+        np.ascontiguousarray(upper, dtype=x.dtype),
+        closed,
+        mask,
+    )
+    return mask
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _gaussian_model(x, p, model):
+        nbatch, npix = x.shape
+        n = (p.shape[1] - 1) // 3
+        for b in range(nbatch):
+            for k in range(npix):
+                model[b, k] = p[b, -1]
+            for i in range(n):
+                amplitude = p[b, 3 * i]
+                center = p[b, 3 * i + 1]
+                sigma = p[b, 3 * i + 2]
+                norm = amplitude / (SQRT_2PI * sigma)
+                for k in range(npix):
+                    d = (x[b, k] - center) / sigma
+                    model[b, k] += norm * np.exp(-0.5 * d * d)
+
+    @numba.njit(cache=True)
+    def _model_and_jacobian(x, p, model, jacobian):
+        nbatch, npix = x.shape
+        n = (p.shape[1] - 1) // 3
+        for b in range(nbatch):
+            for k in range(npix):
+                model[b, k] = p[b, -1]
+                jacobian[b, -1, k] = 1.0
+            for i in range(n):
+                amplitude = p[b, 3 * i]
+                center = p[b, 3 * i + 1]
+                sigma = p[b, 3 * i + 2]
+                norm = 1.0 / (SQRT_2PI * sigma)
+                for k in range(npix):
+                    d = (x[b, k] - center) / sigma
+                    g = np.exp(-0.5 * d * d) * norm
+                    f = amplitude * g
+                    model[b, k] += f
+                    jacobian[b, 3 * i, k] = g
+                    jacobian[b, 3 * i + 1, k] = f * d / sigma
+                    jacobian[b, 3 * i + 2, k] = f * (d * d - 1.0) / sigma
+
+    @numba.njit(cache=True)
+    def _weighted_residual(y, model, weights, residual):
+        nbatch, npix = y.shape
+        for b in range(nbatch):
+            for k in range(npix):
+                residual[b, k] = (y[b, k] - model[b, k]) * weights[b, k]
+
+    @numba.njit(cache=True)
+    def _outside_intervals(x, lower, upper, closed, mask):
+        for k in range(x.shape[0]):
+            mask[k] = True
+            for j in range(lower.shape[0]):
+                if (
+                    (lower[j] <= x[k] <= upper[j])
+                    if closed
+                    else (lower[j] < x[k] < upper[j])
+                ):
+                    mask[k] = False
+                    break
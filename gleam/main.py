@@ -3,11 +3,13 @@ __version__ = "0.1"
 
 import os, sys
 from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
 
 import numpy as np
 import astropy
 from astropy import units as u
-from astropy.table import QTable, Table, Column
+from astropy.table import QTable, Table, Column, Row
 from astropy.io import fits
 from colorama import Fore
 from colorama import init
@@ -18,6 +20,8 @@ import gleam.read_files as rf
 import gleam.gaussian_fitting as gf
 import gleam.plot_gaussian as pg
 import gleam.spectra_operations as so
+import gleam.kernels as kernels
+from gleam.constants import Config
 
 
 @contextmanager
@@ -25,7 +29,7 @@ def fake():
     yield lambda *_: None
 
 
-def run_main(spectrum_file, target, inspect, plot, verbose, bin1, c):
+def run_main(spectrum_file, target, inspect, plot, verbose, bin1, c, groups=None):
     """
     For a target/galaxy, read the spectrum and perform the line fitting for each 
     line within the list of lines
@@ -37,10 +41,147 @@ def run_main(spectrum_file, target, inspect, plot, verbose, bin1, c):
         verbose: print full lmfit output
         bin1: number of adjacent spectral pixels to be binned
         c: full configuration file
+        groups: line groups covered by the spectrum, as planned by 
+                plan_coverage, or None to go through all the groups
     Output:
         fits of emission lines and plots for each fitted lines
     """
+    source = prepare_source(spectrum_file, target, bin1, c, groups)
+    config = source.config
 
+    fits = gf.fit_lines(
+        target,
+        source.spectrum,
+        source.line_list,
+        source.line_groups,
+        config.fitting.center,
+        verbose,
+        source.sky,
+        config.fitting.cont_width,
+        config.fitting.mask_width,
+        config.fitting.w,
+        config.fitting.SN_limit,
+        config.resolution / (1 + target["Redshift"]),
+        config.cosmology.cosmo,
+        config.fitting.engine,
+        config.fitting.selection,
+        config.fitting.sigma,
+        config.fitting.kinematics,
+        config.fitting.ratios,
+        config.fitting.prescreen,
+        config.fitting.parallel,
+        config.fitting.coarse,
+        config.fitting.max_nfev,
+        config.fitting.group_timeout,
+        config.fitting.source_timeout,
+        config.fitting.precision,
+        config.fitting.continuum,
+    )
+    save_results(source, fits, inspect, plot)
+
+
+def run_batch(sources, inspect, plot, verbose, bin1, c, groups=None):
+    """
+    For a batch of targets/galaxies, read all the spectra, extract the spectrum
+    around each group of lines and fit the same group of lines in all sources 
+    at once. The results are then written out for each source, exactly as in
+    run_main.
+    Input:
+        sources: list of (spectrum file, Astropy row with target properties)
+        inspect: if true, show the plots; otherwise write to disk
+        plot: plot figures to disk
+        verbose: print full fit output
+        bin1: number of adjacent spectral pixels to be binned
+        c: full configuration file
+        groups: for each source, the line groups covered by its spectrum, as 
+                planned by plan_coverage, or None to go through all the groups
+    Output:
+        fits of emission lines and plots for each fitted lines
+    """
+    if groups is None:
+        groups = [None] * len(sources)
+    prepared = [
+        prepare_source(spectrum_file, target, bin1, c, source_groups)
+        for (spectrum_file, target), source_groups in zip(sources, groups)
+    ]
+
+    # Extract the windows around each group of lines for all sources
+    windows = [
+        gf.extract_windows(
+            source.target,
+            source.spectrum,
+            source.line_list,
+            source.line_groups,
+            source.config.fitting.center,
+            source.sky,
+            source.config.fitting.cont_width,
+            source.config.fitting.mask_width,
+            source.config.fitting.w,
+            source.config.fitting.SN_limit,
+            source.config.resolution / (1 + source.target["Redshift"]),
+            source.config.cosmology.cosmo,
+            source.config.fitting.engine,
+            source.config.fitting.selection,
+            source.config.fitting.sigma,
+            source.config.fitting.kinematics,
+            source.config.fitting.ratios,
+            source.config.fitting.prescreen,
+            source.config.fitting.parallel,
+            source.config.fitting.coarse,
+            source.config.fitting.max_nfev,
+            source.config.fitting.group_timeout,
+            source.config.fitting.source_timeout,
+            source.config.fitting.precision,
+            source.config.fitting.continuum,
+        )
+        for source in prepared
+    ]
+
+    # Fit all windows together, then scatter the fits back to their sources
+    fits = iter(gf.fit_windows([w for ws in windows for w in ws], verbose))
+    for source, source_windows in zip(prepared, windows):
+        save_results(
+            source,
+            [
+                (next(fits), window.spectrum_line, window.lines)
+                for window in source_windows
+            ],
+            inspect,
+            plot,
+        )
+
+
+@dataclass
+class Source:
+    """
+    A spectrum read from disk, ready for fitting, together with its 
+    configuration, line list and sky bands.
+    """
+
+    data_path: str
+    target: Row
+    spectrum: QTable
+    config: Config
+    line_list: QTable
+    sky: Optional[so.SkyBands]
+    line_groups: list
+
+
+def prepare_source(spectrum_file, target, bin1, c, groups=None) -> Source:
+    """
+    Read the spectrum of a target/galaxy, bin or resample it, move it to the 
+    restframe and
+    gather the configuration, line list and sky bands used for the fitting
+    Input:
+        spectrum_file: target spectrum file
+        target: Astropy row with target properties 
+        bin1: number of adjacent spectral pixels to be binned
+        c: full configuration file
+        groups: line groups covered by the spectrum, as planned by 
+                plan_coverage, or None to keep all the groups
+    Output:
+        Source ready for fitting
+    """
     data_path = os.path.dirname(spectrum_file)
     print(
         f"Now working in {data_path} "
@@ -49,33 +190,149 @@ def run_main(spectrum_file, target, inspect, plot, verbose, bin1, c):
     )
 
     # Read spectrum for the current source from outside file
-    spectrum = QTable.read(spectrum_file)
+    spectrum = rf.read_spectrum(spectrum_file)
+
+    # Configuration for curret source
+    config = c(
+        target["Sample"], target["Setup"], target["Pointing"], target["SourceNumber"]
+    )
 
     if bin1 > 1:
         spectrum = so.bin_spectrum(spectrum, bin1)
 
+    # Resample onto the grid shared by all sources, if requested
+    spectrum = so.resample_spectrum(
+        spectrum, config.resample.grid, config.resample.step, target["Redshift"]
+    )
+
     # Given its redshift, calculate restframe spectrum
     spectrum = so.add_restframe(spectrum, target["Redshift"])
 
-    # Configuration for curret source
-    config = c(
-        target["Sample"], target["Setup"], target["Pointing"], target["SourceNumber"]
-    )
+    # Keep the spectrum in the floating point precision used for the fitting
+    spectrum = so.set_precision(spectrum, config.fitting.precision)
+
+    # Select the kernels used by the native solver. The check of the numba
+    # kernels runs once, before the sources are fit
+    kernels.use(config.fitting.kernels)
 
     # Read in line table
     line_list = config.line_list
 
-    # Read in file with sky bands
-    sky = config.sky_list
+    # Read in file with sky bands, compiled once for all sources
+    sky = config.sky_bands
 
     # Find groups of nearby lines in the input table that will be fit together
     line_groups = so.group_lines(line_list, config.fitting.tolerance/2.)
 
+    # Only keep the groups that the coverage plan found within the spectrum
+    if groups is not None:
+        line_groups = [
+            group for group, covered in zip(line_groups, groups) if covered
+        ]
+
+    return Source(
+        data_path=data_path,
+        target=target,
+        spectrum=spectrum,
+        config=config,
+        line_list=line_list,
+        sky=sky,
+        line_groups=line_groups,
+    )
+
+
+def plan_coverage(sources, c):
+    """
+    Plan which groups of lines fall, at least partially, within the restframe 
+    spectral coverage of each source, before any spectrum is read. Only the 
+    ranges of wavelengths of the spectra are read from disk, and the coverage
+    of all the sources that share a line list is computed at once. The ranges
+    extend to the outer edges of the pixels, so that binning or resampling 
+    the spectra can only remove groups from the plan, never add them.
+    Input:
+        sources: list of (spectrum file, Astropy row with target properties)
+        c: full configuration file
+    Output:
+        for each source, a boolean array of its covered line groups
+    """
+    # Sources that share a line list and grouping of the lines
+    shared = {}
+    for i, (spectrum_file, target) in enumerate(sources):
+        config = c(
+            target["Sample"],
+            target["Setup"],
+            target["Pointing"],
+            target["SourceNumber"],
+        )
+        key = (config.line_table, str(config.lines), str(config.fitting.tolerance))
+        if key not in shared:
+            shared[key] = (config, [])
+        shared[key][1].append(i)
+
+    plan = [None] * len(sources)
+    for config, indices in shared.values():
+        # Wavelengths of the first and last line of each group
+        line_list = config.line_list
+        unit = line_list["wavelength"].unit
+        catalog = so.LineCatalog.from_wavelengths(line_list["wavelength"].value)
+        line_groups = so.group_lines(line_list, config.fitting.tolerance / 2.0)
+        bounds = np.array(
+            [
+                (np.min(wl), np.max(wl)) if len(wl) else (np.inf, -np.inf)
+                for wl in (
+                    catalog.wavelengths[
+                        catalog.between(
+                            group.beginning.to_value(unit), group.ending.to_value(unit)
+                        )
+                    ]
+                    for group in line_groups
+                )
+            ]
+        ).reshape(-1, 2)
+
+        # Restframe range of wavelengths of each spectrum
+        ranges = np.array(
+            [
+                rf.read_spectral_range(sources[i][0]).to_value(unit)
+                / (1 + sources[i][1]["Redshift"])
+                for i in indices
+            ]
+        )
+
+        # A group is covered unless all its lines fall on the same side of the
+        # spectrum, as in gf.covered_groups
+        covered = (bounds[None, :, 1] >= ranges[:, 0, None]) & (
+            bounds[None, :, 0] <= ranges[:, 1, None]
+        )
+        for i, source_covered in zip(indices, covered):
+            plan[i] = source_covered
+    return plan
+
+
+def save_results(source, fits, inspect, plot):
+    """
+    Plot and write to disk the line fits of a single source
+    Input:
+        source: Source that was fit
+        fits: iterable of (spectrum fit, spectrum around the lines, lines) for
+              each group of lines
+        inspect: if true, show the plots; otherwise write to disk
+        plot: plot figures to disk
+    Output:
+        fits table of emission lines and plots for each fitted lines
+    """
+    data_path = source.data_path
+    target = source.target
+    spectrum = source.spectrum
+    config = source.config
+    line_list = source.line_list
+    sky = source.sky
+
     overview = (
         pg.overview_plot(
             target,
             data_path,
-            line_groups,
+            source.line_groups,
             spectrum,
             config.fitting.cont_width,
             config.resolution / (1 + target["Redshift"]),
@@ -85,23 +342,9 @@ def run_main(spectrum_file, target, inspect, plot, verbose, bin1, c):
         else fake()
     )
     with overview as plot_line:
-        tables = []
+        results = gf.LineTable(len(line_list))
         # Set the name to the exported plot in png format
-        for spectrum_fit, spectrum_line, lines in gf.fit_lines(
-            target,
-            spectrum,
-            line_list,
-            line_groups,
-            config.fitting.center,
-            verbose,
-            sky,
-            config.fitting.cont_width,
-            config.fitting.mask_width,
-            config.fitting.w,
-            config.fitting.SN_limit,
-            config.resolution / (1 + target["Redshift"]),
-            config.cosmology.cosmo,
-        ):
+        for spectrum_fit, spectrum_line, lines in fits:
             # Make a plot/fit a spectrum if the line in within the rest-frame
             # spectral coverage of the source
             if plot:
@@ -122,9 +365,7 @@ def run_main(spectrum_file, target, inspect, plot, verbose, bin1, c):
                 )
             if spectrum_fit is not None:
                 for (line_fit, line) in zip(spectrum_fit.lines, lines):
-                    tables.append(
-                        Table(line_fit.as_fits_table(line), masked=True, copy=False)
-                    )
+                    results.add(line_fit, line)
                 plot_line(
                     lines,
                     spectrum_fit,
@@ -133,8 +374,7 @@ def run_main(spectrum_file, target, inspect, plot, verbose, bin1, c):
                 )
 
     try:
-        outtable = astropy.table.vstack(tables)
-        outtable = Table(outtable, masked=True, copy=False)
+        outtable = results.to_table()
         outfile = "{}.fits".format(
             rf.naming_convention(
                 data_path,
@@ -0,0 +1,854 @@
+__author__ = "Andra Stroe"
+__version__ = "0.1"
+
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import gleam.spectra_operations as so
+import gleam.kernels as kernels
+
+# Normalisation of a unit-area Gaussian
+SQRT_2PI = np.sqrt(2.0 * np.pi)
+# Conversion between the sigma and the FWHM of a Gaussian
+SIGMA_TO_FWHM = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+
+@dataclass
+class Parameter:
+    """
+    Minimal stand-in for an lmfit parameter: the best fit value and its error.
+    """
+
+    value: float
+    stderr: Optional[float]
+
+
+@dataclass
+class Problem:
+    """
+    A single fitting problem: data, weights (1/error), starting parameters,
+    bounds and which parameters vary. The flux scale is the factor the data
+    were multiplied by before fitting and is undone in the results. Parameters
+    can be tied to others through the optional tie matrix (see tie_matrix).
+    With a coarse factor above one, the problem is first fit on its data binned
+    by that factor (see coarsen). The function evaluations already spent on the
+    problem, e.g. by that first fit, count towards the maximum number of
+    evaluations.
+    """
+
+    x: np.ndarray
+    y: np.ndarray
+    weights: np.ndarray
+    p0: np.ndarray
+    lower: np.ndarray
+    upper: np.ndarray
+    vary: np.ndarray
+    flux_scale: float = 1.0
+    tie: Optional[np.ndarray] = None
+    coarse: int = 1
+    nfev: int = 0
+
+
+@dataclass
+class BatchFit:
+    """
+    Results of fitting a batch of independent problems with the same number of
+    Gaussian components. Parameters are stored per problem in the order
+    (amplitude, center, sigma) for each Gaussian, followed by the constant.
+    """
+
+    params: np.ndarray
+    covariance: np.ndarray
+    errorbars: np.ndarray
+    success: np.ndarray
+    nfev: np.ndarray
+    chisqr: np.ndarray
+    ndata: np.ndarray
+    nvarys: np.ndarray
+
+    @property
+    def redchi(self):
+        return self.chisqr / np.maximum(self.ndata - self.nvarys, 1)
+
+
+@dataclass
+class NativeResult:
+    """
+    Result of a single native fit of a sum of Gaussians plus a constant. It
+    exposes the same parameter names as the equivalent lmfit composite model
+    (g{i}_amplitude, g{i}_center, g{i}_sigma, g{i}_height, g{i}_fwhm and c), so
+    that it can be used interchangeably with an lmfit ModelResult.
+    """
+
+    params: Dict[str, Parameter]
+    errorbars: bool
+    success: bool
+    nfev: int
+    chisqr: float
+    redchi: float
+    ndata: int
+    nvarys: int
+
+    @property
+    def ncomponents(self):
+        return sum(1 for name in self.params if name.endswith("_amplitude"))
+
+    @property
+    def aborted(self):
+        # Whether the fit was stopped by max_nfev before converging, as in lmfit
+        return not self.success
+
+    def eval(self, x):
+        """
+        Evaluate the best fit model (Gaussians + constant) at positions x
+        """
+        if kernels.enabled():
+            p = pack_parameters(
+                *(
+                    [self.params[f"g{i}_{name}"].value for i in range(self.ncomponents)]
+                    for name in ("amplitude", "center", "sigma")
+                ),
+                self.params["c"].value,
+            )
+            x = np.asarray(x, dtype=np.result_type(x, np.float32))
+            return kernels.gaussian_model(x.reshape(1, -1), p).reshape(np.shape(x))
+        model = np.full(
+            np.shape(x), self.params["c"].value, dtype=np.result_type(x, np.float32)
+        )
+        for i in range(self.ncomponents):
+            model = model + self.params[f"g{i}_amplitude"].value * unit_gaussian(
+                x, self.params[f"g{i}_center"].value, self.params[f"g{i}_sigma"].value
+            )
+        return model
+
+    def fit_report(self):
+        """
+        Short, human readable summary of the fit
+        """
+        report = [
+            "[[Native fit statistics]]",
+            f"    function evals   = {self.nfev}",
+            f"    data points      = {self.ndata}",
+            f"    variables        = {self.nvarys}",
+            f"    chi-square       = {self.chisqr:.7g}",
+            f"    reduced chi-square = {self.redchi:.7g}",
+            f"    converged        = {self.success}",
+            "[[Variables]]",
+        ]
+        for name, param in self.params.items():
+            error = "--" if param.stderr is None else f"{param.stderr:.7g}"
+            report.append(f"    {name}: {param.value:.7g} +/- {error}")
+        return "\n".join(report)
+
+    @staticmethod
+    def from_batch(batch: BatchFit, index: int, flux_scale: float = 1.0):
+        """
+        Extract a single problem out of a batch fit and undo the scaling of the
+        flux that was applied before fitting
+        Input:
+            batch: batch of fits
+            index: which problem in the batch to extract
+            flux_scale: multiplicative factor applied to the flux before fitting
+        Return:
+            NativeResult with parameters in the original flux units
+        """
+        p = batch.params[index]
+        errorbars = bool(batch.errorbars[index])
+        cov = batch.covariance[index] * batch.redchi[index]
+        var = np.diagonal(cov)
+        n = (len(p) - 1) // 3
+
+        def stderr(value):
+            return float(value) if errorbars else None
+
+        params = {}
+        for i in range(n):
+            a, m, s = 3 * i, 3 * i + 1, 3 * i + 2
+            amplitude, center, sigma = p[a], p[m], p[s]
+            height = amplitude / (max(sigma, 1e-15) * SQRT_2PI)
+            # Propagate the covariance of (amplitude, sigma) onto the height
+            dh_da = 1.0 / (max(sigma, 1e-15) * SQRT_2PI)
+            dh_ds = -height / max(sigma, 1e-15)
+            var_height = (
+                dh_da ** 2 * var[a]
+                + dh_ds ** 2 * var[s]
+                + 2 * dh_da * dh_ds * cov[a, s]
+            )
+            params[f"g{i}_amplitude"] = Parameter(
+                amplitude / flux_scale, stderr(np.sqrt(var[a]) / flux_scale)
+            )
+            params[f"g{i}_center"] = Parameter(center, stderr(np.sqrt(var[m])))
+            params[f"g{i}_sigma"] = Parameter(sigma, stderr(np.sqrt(var[s])))
+            params[f"g{i}_fwhm"] = Parameter(
+                SIGMA_TO_FWHM * sigma, stderr(SIGMA_TO_FWHM * np.sqrt(var[s]))
+            )
+            params[f"g{i}_height"] = Parameter(
+                height / flux_scale, stderr(np.sqrt(max(var_height, 0.0)) / flux_scale),
+            )
+        params["c"] = Parameter(
+            p[-1] / flux_scale, stderr(np.sqrt(var[-1]) / flux_scale)
+        )
+
+        return NativeResult(
+            params=params,
+            errorbars=errorbars,
+            success=bool(batch.success[index]),
+            nfev=int(batch.nfev[index]),
+            chisqr=float(batch.chisqr[index]),
+            redchi=float(batch.redchi[index]),
+            ndata=int(batch.ndata[index]),
+            nvarys=int(batch.nvarys[index]),
+        )
+
+
+def unit_gaussian(x, center, sigma):
+    """
+    Gaussian of unit area
+    Input:
+        x: positions where the Gaussian is evaluated
+        center: center of the Gaussian
+        sigma: sigma of the Gaussian
+    """
+    return np.exp(-((x - center) ** 2) / (2.0 * sigma ** 2)) / (SQRT_2PI * sigma)
+
+
+def model_and_jacobian(x, p):
+    """
+    Evaluate a sum of Gaussians plus a constant and its analytic derivatives
+    with respect to all the parameters, for a batch of problems at once. Both
+    are evaluated in the floating point type of x.
+    Input:
+        x: positions, shape (B, N)
+        p: parameters, shape (B, 3n+1), ordered as (amplitude, center, sigma)
+           for each Gaussian and the constant last
+    Output:
+        model: shape (B, N)
+        jacobian: shape (B, 3n+1, N)
+    """
+    if kernels.enabled():
+        return kernels.model_and_jacobian(x, p)
+    p = np.asarray(p, dtype=x.dtype)
+    amplitude = p[:, 0:-1:3, None]
+    center = p[:, 1:-1:3, None]
+    sigma = p[:, 2:-1:3, None]
+    d = (x[:, None, :] - center) / sigma
+    g = np.exp(-0.5 * d ** 2) / (SQRT_2PI * sigma)
+    f = amplitude * g
+
+    model = f.sum(axis=1) + p[:, -1, None]
+    jacobian = np.empty((p.shape[0], p.shape[1], x.shape[1]), dtype=x.dtype)
+    jacobian[:, 0:-1:3] = g
+    jacobian[:, 1:-1:3] = f * d / sigma
+    jacobian[:, 2:-1:3] = f * (d ** 2 - 1.0) / sigma
+    jacobian[:, -1] = 1.0
+    return model, jacobian
+
+
+def tied_model_and_jacobian(x, q, tie):
+    """
+    Evaluate a sum of Gaussians plus a constant, where the full set of 
+    parameters is p = tie @ q, and its derivatives with respect to q
+    Input:
+        x: positions, shape (B, N)
+        q: free (leading) parameters, shape (B, 3n+1); zero for tied ones
+        tie: tie matrices, shape (B, 3n+1, 3n+1), or None if nothing is tied
+    Output:
+        model: shape (B, N)
+        jacobian: shape (B, 3n+1, N)
+    """
+    if tie is None:
+        return model_and_jacobian(x, q)
+    model, jacobian = model_and_jacobian(x, np.einsum("bpq,bq->bp", tie, q))
+    return model, np.einsum("bpq,bpn->bqn", tie.astype(jacobian.dtype), jacobian)
+
+
+def tie_matrix(n, ties):
+    """
+    Matrix that expresses tied parameters as multiples of the parameters they
+    are tied to, in the (amplitude, center, sigma)*n + constant layout. The 
+    full set of parameters is p = tie @ q, where q only holds the leading 
+    parameters.
+    Input:
+        n: number of Gaussians
+        ties: dict mapping the name of a tied parameter (e.g. g1_center) to the
+              name of the parameter it is tied to and the factor between them
+    Return:
+        array of shape (3n+1, 3n+1)
+    """
+    offsets = {"amplitude": 0, "center": 1, "sigma": 2}
+
+    def index(name):
+        component, kind = name.split("_")
+        return 3 * int(component[1:]) + offsets[kind]
+
+    tie = np.eye(3 * n + 1)
+    for name, (leader, scale) in ties.items():
+        tie[index(name)] = 0.0
+        tie[index(name), index(leader)] = scale
+    return tie
+
+
+def _untie(tie, lower, upper, p0, vary):
+    """
+    Move bounds, starting values and free parameters from the full set of 
+    parameters to the leading ones. The bounds of a leading parameter are the
+    intersection of the bounds implied by all the parameters tied to it.
+    """
+    leader = np.diagonal(tie, axis1=1, axis2=2) != 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        low = np.where(
+            tie > 0,
+            lower[:, :, None] / tie,
+            np.where(tie < 0, upper[:, :, None] / tie, -np.inf),
+        )
+        high = np.where(
+            tie > 0,
+            upper[:, :, None] / tie,
+            np.where(tie < 0, lower[:, :, None] / tie, np.inf),
+        )
+    return (
+        low.max(axis=1),
+        high.min(axis=1),
+        np.where(leader, p0, 0.0),
+        vary & leader,
+    )
+
+
+def _retie(tie, q, covariance):
+    """
+    Expand the leading parameters and their covariance back to the full set of
+    parameters
+    """
+    if tie is None:
+        return q, covariance
+    return (
+        np.einsum("bpq,bq->bp", tie, q),
+        np.einsum("bpq,bqr,bsr->bps", tie, covariance, tie),
+    )
+
+
+def weighted_residual(y, model, weights):
+    """
+    Residuals of the data from the model, in units of the errors
+    """
+    if kernels.enabled():
+        return kernels.weighted_residual(y, model, weights)
+    return (y - model) * weights
+
+
+def _normal_equations(jacobian, residual, weights, vary):
+    """
+    Weighted normal equations J^T J and J^T r, restricted to the parameters
+    that are allowed to vary. Rows and columns of fixed parameters are zeroed.
+    They are always accumulated in double precision.
+    """
+    wj = jacobian * weights[:, None, :]
+    jtj = np.einsum("bpn,bqn->bpq", wj, wj, dtype=np.float64)
+    jtr = np.einsum("bpn,bn->bp", wj, residual, dtype=np.float64)
+    jtj = np.where(vary[:, :, None] & vary[:, None, :], jtj, 0.0)
+    jtr = np.where(vary, jtr, 0.0)
+    return jtj, jtr
+
+
+def _covariance(jtj, vary):
+    """
+    Invert J^T J over the varying parameters. Fixed parameters get zero
+    variance. Returns the covariance and whether it could be computed.
+    """
+    eye = np.eye(jtj.shape[-1], dtype=bool)[None]
+    a = np.where(eye & ~vary[:, :, None], 1.0, jtj)
+    cov = np.full_like(a, np.nan)
+    ok = np.zeros(len(a), dtype=bool)
+    for b in range(len(a)):
+        try:
+            cov[b] = np.linalg.inv(a[b])
+        except np.linalg.LinAlgError:
+            continue
+        cov[b] = np.where(vary[b, :, None] & vary[b, None, :], cov[b], 0.0)
+        diag = np.diagonal(cov[b])[vary[b]]
+        ok[b] = np.all(np.isfinite(cov[b])) and np.all(diag > 0)
+    return cov, ok
+
+
+def levenberg_marquardt(
+    x,
+    y,
+    weights,
+    p0,
+    lower,
+    upper,
+    vary,
+    max_nfev=None,
+    ftol=1.5e-8,
+    xtol=1.5e-8,
+    calc_covar=True,
+    tie=None,
+    nfev=None,
+) -> BatchFit:
+    """
+    Fit a batch of independent sums of Gaussians plus a constant with a
+    Levenberg-Marquardt solver using analytic derivatives. Bounds are enforced
+    by projecting each step back into the allowed box. Problems of different
+    lengths can be padded to a common length and the padding excluded by
+    setting the corresponding weights to zero. With single precision data, the
+    model and its derivatives are evaluated in single precision, while the 
+    parameters, chi-square and normal equations stay in double precision.
+    Input:
+        x: positions, shape (B, N)
+        y: data, shape (B, N)
+        weights: 1/error of the data, 0 for pixels to ignore, shape (B, N)
+        p0: starting parameters, shape (B, 3n+1)
+        lower, upper: bounds on the parameters, shape (B, 3n+1)
+        vary: which parameters are free, shape (B, 3n+1)
+        max_nfev: maximum number of function evaluations per problem, counted
+                  as in lmfit (see evaluation_cost)
+        ftol: relative tolerance on the reduction of chi-square
+        xtol: relative tolerance on the parameter step
+        calc_covar: whether to compute the covariance matrix; without it, the
+                    fits have no error bars
+        tie: tie matrices, shape (B, 3n+1, 3n+1), or None if nothing is tied;
+             the fit is then done over the leading parameters only
+        nfev: function evaluations already spent on each problem, which 
+              count towards max_nfev, shape (B,)
+    Return:
+        BatchFit with the best fit parameters and unscaled covariances
+    """
+    dtype = np.result_type(x, y, weights, np.float32)
+    x, y, weights = (np.atleast_2d(np.asarray(a, dtype=dtype)) for a in (x, y, weights))
+    p0, lower, upper = (
+        np.atleast_2d(np.asarray(a, dtype=np.float64)) for a in (p0, lower, upper)
+    )
+    vary = np.atleast_2d(np.asarray(vary, dtype=bool))
+    nbatch, npar = p0.shape
+    if max_nfev is None:
+        max_nfev = 2000 * (npar + 1)
+    if tie is not None:
+        tie = np.asarray(tie, dtype=np.float64).reshape(nbatch, npar, npar)
+        lower, upper, p0, vary = _untie(tie, lower, upper, p0, vary)
+
+    p = np.clip(p0, lower, upper)
+    model, jacobian = tied_model_and_jacobian(x, p, tie)
+    residual = weighted_residual(y, model, weights)
+    chisqr = np.sum(residual ** 2, axis=1, dtype=np.float64)
+    lam = np.full(nbatch, 1e-3)
+    # Each evaluation of the model and its derivatives counts as many function
+    # evaluations as lmfit needs for the same: one for the model and one per
+    # free parameter for the finite-difference derivatives
+    cost = evaluation_cost(vary)
+    nfev = cost + (0 if nfev is None else np.asarray(nfev))
+    active = np.ones(nbatch, dtype=bool)
+    success = np.zeros(nbatch, dtype=bool)
+    eye = np.eye(npar, dtype=bool)[None]
+
+    while active.any():
+        idx = np.flatnonzero(active)
+        jtj, jtr = _normal_equations(
+            jacobian[idx], residual[idx], weights[idx], vary[idx]
+        )
+
+        # Parameters sitting on a bound, with the gradient pushing them out of
+        # the allowed range, are held fixed for this step (active set)
+        free = vary[idx] & ~(
+            ((p[idx] <= lower[idx]) & (jtr < 0)) | ((p[idx] >= upper[idx]) & (jtr > 0))
+        )
+        jtj = np.where(free[:, :, None] & free[:, None, :], jtj, 0.0)
+        jtr = np.where(free, jtr, 0.0)
+
+        # Marquardt damping of the diagonal; fixed parameters get a unit
+        # diagonal so their step is exactly zero
+        diag = np.diagonal(jtj, axis1=1, axis2=2)
+        damping = np.where(free, lam[idx, None] * np.maximum(diag, 1e-30), 1.0)
+        a = jtj + eye * damping[:, :, None]
+        try:
+            step = np.linalg.solve(a, jtr[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.stack(
+                [np.linalg.lstsq(a[k], jtr[k], rcond=None)[0] for k in range(len(idx))]
+            )
+
+        p_new = np.clip(p[idx] + step, lower[idx], upper[idx])
+        model_new, jacobian_new = tied_model_and_jacobian(
+            x[idx], p_new, None if tie is None else tie[idx]
+        )
+        residual_new = weighted_residual(y[idx], model_new, weights[idx])
+        chisqr_new = np.sum(residual_new ** 2, axis=1, dtype=np.float64)
+        nfev[idx] += cost[idx]
+
+        better = np.isfinite(chisqr_new) & (chisqr_new < chisqr[idx])
+        reduction = (chisqr[idx] - chisqr_new) / np.maximum(chisqr_new, 1e-300)
+        dp = np.linalg.norm(p_new - p[idx], axis=1)
+        small_step = dp <= xtol * (np.linalg.norm(p[idx], axis=1) + xtol)
+
+        accept = idx[better]
+        p[accept] = p_new[better]
+        jacobian[accept] = jacobian_new[better]
+        residual[accept] = residual_new[better]
+        chisqr[accept] = chisqr_new[better]
+        lam[accept] = np.maximum(lam[accept] / 10.0, 1e-12)
+        lam[idx[~better]] *= 10.0
+
+        converged = (better & ((reduction <= ftol) | small_step)) | (
+            ~better & (lam[idx] > 1e16)
+        )
+        success[idx[converged]] = True
+        active[idx[converged]] = False
+        active[nfev >= max_nfev] = False
+
+    if calc_covar:
+        jtj, _ = _normal_equations(jacobian, residual, weights, vary)
+        covariance, errorbars = _covariance(jtj, vary)
+    else:
+        covariance = np.full((nbatch, npar, npar), np.nan)
+        errorbars = np.zeros(nbatch, dtype=bool)
+    ndata = np.sum(weights > 0, axis=1)
+    nvarys = np.sum(vary, axis=1)
+    errorbars &= ndata > nvarys
+    # As with lmfit, fits stopped by max_nfev before converging have no error
+    # bars, so that they are never taken as good fits
+    errorbars &= success
+    p, covariance = _retie(tie, p, covariance)
+
+    return BatchFit(
+        params=p,
+        covariance=covariance,
+        errorbars=errorbars,
+        success=success,
+        nfev=nfev,
+        chisqr=chisqr,
+        ndata=ndata,
+        nvarys=nvarys,
+    )
+
+
+def evaluation_cost(vary):
+    """
+    Number of function evaluations that lmfit needs to evaluate a model and 
+    its derivatives by finite differences: one for the model and one per free
+    parameter. The native solver counts each evaluation of the model with its
+    analytic derivatives as this many, so that max_nfev means the same for 
+    both engines.
+    Input:
+        vary: which parameters are free, shape (B, 3n+1)
+    Return:
+        array with the cost of each problem, shape (B,)
+    """
+    return 1 + np.sum(vary, axis=1)
+
+
+def is_linear(vary):
+    """
+    Whether only the amplitudes and the constant are free, in which case the 
+    model is linear in the free parameters
+    Input:
+        vary: which parameters are free, shape (B, 3n+1)
+    """
+    vary = np.atleast_2d(vary)
+    return not (vary[:, 1:-1:3].any() or vary[:, 2:-1:3].any())
+
+
+def unbounded(lower, upper, vary):
+    """
+    Whether none of the free parameters has a finite bound, so that the 
+    solution of the normal equations needs no clipping
+    Input:
+        lower, upper: bounds of the parameters, shape (B, 3n+1)
+        vary: which parameters are free, shape (B, 3n+1)
+    """
+    return not (np.isfinite(lower[vary]).any() or np.isfinite(upper[vary]).any())
+
+
+def linear_least_squares(
+    x, y, weights, p0, vary, calc_covar=True, tie=None
+) -> BatchFit:
+    """
+    Fit a batch of sums of Gaussians plus a constant where only the amplitudes
+    and the constant are free, by solving the weighted normal equations 
+    directly. The centers and sigmas are kept at their values in p0. As in
+    levenberg_marquardt, the data can be in single precision.
+    Input:
+        x: positions, shape (B, N)
+        y: data, shape (B, N)
+        weights: 1/error of the data, 0 for pixels to ignore, shape (B, N)
+        p0: parameters, shape (B, 3n+1); only the centers and sigmas are used
+        vary: which amplitudes and constants are free, shape (B, 3n+1)
+        calc_covar: whether to compute the covariance matrix
+        tie: tie matrices, shape (B, 3n+1, 3n+1), or None if nothing is tied
+    Return:
+        BatchFit with the best fit parameters and unscaled covariances
+    """
+    dtype = np.result_type(x, y, weights, np.float32)
+    x, y, weights = (np.atleast_2d(np.asarray(a, dtype=dtype)) for a in (x, y, weights))
+    p0 = np.atleast_2d(np.asarray(p0, dtype=np.float64))
+    vary = np.atleast_2d(np.asarray(vary, dtype=bool))
+    nbatch, npar = p0.shape
+    if tie is not None:
+        tie = np.asarray(tie, dtype=np.float64).reshape(nbatch, npar, npar)
+        _, _, p0, vary = _untie(tie, p0, p0, p0, vary)
+
+    # The Jacobian of a linear model does not depend on the linear parameters:
+    # a single Gauss-Newton step from zero amplitudes is the exact solution
+    p = np.where(vary, 0.0, p0)
+    model, jacobian = tied_model_and_jacobian(x, p, tie)
+    jtj, jtr = _normal_equations(
+        jacobian, weighted_residual(y, model, weights), weights, vary
+    )
+    a = np.where(np.eye(npar, dtype=bool)[None] & ~vary[:, :, None], 1.0, jtj)
+    try:
+        p = p + np.linalg.solve(a, jtr[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        p = p + np.stack(
+            [np.linalg.lstsq(a[b], jtr[b], rcond=None)[0] for b in range(nbatch)]
+        )
+
+    model, _ = tied_model_and_jacobian(x, p, tie)
+    chisqr = np.sum(weighted_residual(y, model, weights) ** 2, axis=1, dtype=np.float64)
+    if calc_covar:
+        covariance, errorbars = _covariance(jtj, vary)
+    else:
+        covariance = np.full((nbatch, npar, npar), np.nan)
+        errorbars = np.zeros(nbatch, dtype=bool)
+    ndata = np.sum(weights > 0, axis=1)
+    nvarys = np.sum(vary, axis=1)
+    errorbars &= ndata > nvarys
+    p, covariance = _retie(tie, p, covariance)
+
+    return BatchFit(
+        params=p,
+        covariance=covariance,
+        errorbars=errorbars,
+        success=np.ones(nbatch, dtype=bool),
+        nfev=evaluation_cost(vary),
+        chisqr=chisqr,
+        ndata=ndata,
+        nvarys=nvarys,
+    )
+
+
+def pack_parameters(amplitude, center, sigma, continuum):
+    """
+    Interleave per-component parameters into the (amplitude, center, sigma)*n +
+    constant layout used by the solver
+    Input:
+        amplitude, center, sigma: shape (B, n)
+        continuum: shape (B,)
+    Return:
+        array of shape (B, 3n+1)
+    """
+    amplitude, center, sigma = (np.atleast_2d(a) for a in (amplitude, center, sigma))
+    nbatch, n = amplitude.shape
+    p = np.empty((nbatch, 3 * n + 1))
+    p[:, 0:-1:3] = amplitude
+    p[:, 1:-1:3] = center
+    p[:, 2:-1:3] = sigma
+    p[:, -1] = np.broadcast_to(continuum, (nbatch,))
+    return p
+
+
+def stack_padded(rows):
+    """
+    Stack 1D arrays of different lengths into a 2D array of their common 
+    floating point type, padding each row with its last value
+    Input:
+        rows: list of 1D arrays
+    Return:
+        2D array of shape (len(rows), longest row) and the mask of real pixels
+    """
+    lengths = np.array([len(row) for row in rows])
+    out = np.empty((len(rows), lengths.max()), dtype=np.result_type(*rows))
+    for i, row in enumerate(rows):
+        out[i, : len(row)] = row
+        out[i, len(row) :] = row[-1]
+    mask = np.arange(out.shape[1])[None, :] < lengths[:, None]
+    return out, mask
+
+
+def coarsen(problem: Problem) -> Problem:
+    """
+    Copy of a problem with its data binned by its coarse factor, averaging 
+    adjacent pixels as in spectra_operations.bin_spectrum. Linear problems, 
+    which are solved without iterating, and problems that would be left with
+    too few pixels are returned as they are.
+    Input:
+        problem: fitting problem
+    Return:
+        binned fitting problem, or the problem itself
+    """
+    n = problem.coarse
+    size = len(problem.x) // n * n
+    if n <= 1 or is_linear(problem.vary) or size // n <= len(problem.p0):
+        return problem
+    return replace(
+        problem,
+        x=so.average_(problem.x[:size], n),
+        y=so.average_(problem.y[:size], n),
+        weights=1.0 / so.average_err(1.0 / problem.weights[:size], n),
+        coarse=1,
+    )
+
+
+def solve(
+    problems: List[Problem], max_nfev=None, calc_covar=True
+) -> List[NativeResult]:
+    """
+    Fit many problems with the same number of Gaussian components at once. The
+    data are padded into 2D arrays and the padding is masked out through zero
+    weights, so the whole batch goes through a single vectorized solver.
+    Problems with a coarse factor are first fit on binned data, which is 
+    cheaper per iteration, and the fit at full resolution starts from all the
+    parameters of that fit, within the bounds of the problem, except for the
+    Gaussians that moved to another feature (see moved). This fit is only
+    kept if it converged to a lower chi-square than that of the usual starting
+    values: a direct fit can only go lower than these, so a fit that ends 
+    above them went astray, and the problem is fit again directly. All the
+    fits of a problem share the budget of function evaluations.
+    Input:
+        problems: list of fitting problems
+        max_nfev: maximum number of function evaluations per problem
+        calc_covar: whether to compute the uncertainties of the parameters
+    Return:
+        list of NativeResult, one per problem, in the same order
+    """
+    if not problems:
+        return []
+    binned = {}
+    for i, problem in enumerate(problems):
+        coarse = coarsen(problem)
+        if coarse is not problem:
+            binned[i] = coarse
+    if not binned:
+        batch = fit_batch(problems, max_nfev, calc_covar)
+        return [
+            NativeResult.from_batch(batch, i, problem.flux_scale)
+            for i, problem in enumerate(problems)
+        ]
+
+    rough = fit_batch(list(binned.values()), max_nfev, calc_covar=False)
+    seeded = list(problems)
+    for i, p, nfev in zip(binned, rough.params, rough.nfev):
+        problem = problems[i]
+        stay = ~moved(problem.p0[1:-1:3], problem.p0[2:-1:3], p[1:-1:3])
+        seed = problem.vary & np.append(np.repeat(stay, 3), True)
+        p0 = np.clip(np.where(seed, p, problem.p0), problem.lower, problem.upper)
+        seeded[i] = replace(problem, p0=p0, coarse=1, nfev=int(nfev))
+    batch = fit_batch(seeded, max_nfev, calc_covar)
+    results = [
+        NativeResult.from_batch(batch, i, problem.flux_scale)
+        for i, problem in enumerate(problems)
+    ]
+
+    # Fit the problems whose seeded fit is not better than a direct start
+    # again, directly
+    start = start_chisqr([problems[i] for i in binned])
+    astray = [
+        i
+        for i, chisqr in zip(binned, start)
+        if not (batch.success[i] and batch.chisqr[i] <= chisqr)
+    ]
+    if astray:
+        direct = fit_batch(
+            [replace(problems[i], coarse=1, nfev=int(batch.nfev[i])) for i in astray],
+            max_nfev,
+            calc_covar,
+        )
+        for k, i in enumerate(astray):
+            results[i] = NativeResult.from_batch(direct, k, problems[i].flux_scale)
+    return results
+
+
+def moved(center, sigma, fitted):
+    """
+    Which Gaussians of a fit on binned data moved by more than twice their
+    starting sigma from where the fit at full resolution would start. They 
+    found another feature, e.g. a nearby line, and rather keep their usual 
+    starting values.
+    Input:
+        center: usual starting centers at full resolution
+        sigma: usual starting sigmas at full resolution
+        fitted: centers of the fit on binned data
+    Return:
+        boolean array with one entry per Gaussian
+    """
+    return np.abs(np.asarray(fitted) - center) > 2 * np.asarray(sigma)
+
+
+def stack_problems(problems: List[Problem]):
+    """
+    Stack the data and parameters of many problems with the same number of 
+    Gaussian components, padding the data and masking out the padding through
+    zero weights
+    Input:
+        problems: list of fitting problems
+    Return:
+        x, y, weights, p0, lower, upper, vary and tie matrices (or None), each
+        with the problems along the first axis
+    """
+    x, mask = stack_padded([problem.x for problem in problems])
+    y, _ = stack_padded([problem.y for problem in problems])
+    weights, _ = stack_padded([problem.weights for problem in problems])
+    weights = np.where(mask, weights, 0.0)
+
+    p0 = np.stack([problem.p0 for problem in problems])
+    vary = np.stack([problem.vary for problem in problems])
+    tie = None
+    if any(problem.tie is not None for problem in problems):
+        tie = np.stack(
+            [
+                np.eye(len(problem.p0)) if problem.tie is None else problem.tie
+                for problem in problems
+            ]
+        )
+    lower = np.stack([problem.lower for problem in problems])
+    upper = np.stack([problem.upper for problem in problems])
+    return x, y, weights, p0, lower, upper, vary, tie
+
+
+def start_chisqr(problems: List[Problem]) -> np.ndarray:
+    """
+    Chi-square of each problem at its starting parameters, where the solver 
+    starts from
+    Input:
+        problems: list of fitting problems
+    Return:
+        array with the chi-square of each problem
+    """
+    x, y, weights, p0, lower, upper, vary, tie = stack_problems(problems)
+    if tie is not None:
+        lower, upper, p0, vary = _untie(tie, lower, upper, p0, vary)
+    model, _ = tied_model_and_jacobian(x, np.clip(p0, lower, upper), tie)
+    residual = weighted_residual(y, model, weights)
+    return np.sum(residual ** 2, axis=1, dtype=np.float64)
+
+
+def fit_batch(problems: List[Problem], max_nfev=None, calc_covar=True) -> BatchFit:
+    """
+    Stack the data of many problems with the same number of Gaussian 
+    components and fit them with a single call to the vectorized solver
+    Input:
+        see solve
+    Return:
+        BatchFit, with the problems in the same order
+    """
+    x, y, weights, p0, lower, upper, vary, tie = stack_problems(problems)
+
+    # With fixed centers and widths the model is linear in the free parameters
+    # and is solved directly, without iterations, unless the solution could be
+    # out of bounds
+    if is_linear(vary) and unbounded(lower, upper, vary):
+        return linear_least_squares(
+            x, y, weights, p0, vary, calc_covar=calc_covar, tie=tie
+        )
+    return levenberg_marquardt(
+        x,
+        y,
+        weights,
+        p0,
+        lower,
+        upper,
+        vary,
+        max_nfev=max_nfev,
+        calc_covar=calc_covar,
+        tie=tie,
+        nfev=[problem.nfev for problem in problems],
+    )
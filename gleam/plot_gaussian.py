@@ -83,7 +83,7 @@ def overplot_sky(ax, z, sky):
     Input:
         ax: matplolib axis
         z: redshift of the source
-        sky: sky bands in QTable format
+        sky: so.SkyBands
     Output:
         ax: returns the new axis in case we want to overplot some more stuff on
              top
@@ -92,16 +92,16 @@ def overplot_sky(ax, z, sky):
         return
     [
         ax.fill_between(
-            [
-                so.restframe_wl(band["wavelength_min"], z),
-                so.restframe_wl(band["wavelength_max"], z),
-            ],
+            [wavelength_min, wavelength_max],
             ax.get_ylim()[0],
             ax.get_ylim()[1],
             facecolor="gray",
             alpha=0.3,
         )
-        for band in sky
+        for wavelength_min, wavelength_max in zip(
+            so.restframe_wl(sky.wavelength_min, z),
+            so.restframe_wl(sky.wavelength_max, z),
+        )
     ]
 
 
@@ -421,7 +421,7 @@ def plot_gaussian_fit(wl, spectrum_fit, ax, rest_spectral_resolution):
                 line_fit.wavelength.value,
                 line_fit.sigma.value,
             )
-            fit_flux = gauss_part + spectrum_fit.continuum.value
+            fit_flux = gauss_part + line_fit.continuum.value
             ax.plot(wl, fit_flux)
         # Plot upper limits
         if isinstance(line_fit, gf.NonDetection) & (
@@ -431,7 +431,7 @@ def plot_gaussian_fit(wl, spectrum_fit, ax, rest_spectral_resolution):
             gauss_part = gf.gauss_function(
                 wl, so.amplitude_to_height(line_fit.amplitude, s), line_fit.restwl, s
             )
-            fit_flux = gauss_part + spectrum_fit.continuum.value
+            fit_flux = gauss_part + line_fit.continuum.value
             ax.plot(wl, fit_flux, linestyle="--")
 
 
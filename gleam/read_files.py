@@ -1,12 +1,16 @@
 __author__ = "Andra Stroe"
 __version__ = "0.1"
 
+import os
 import glob
 import sys
+import functools
+from fnmatch import fnmatch
+from dataclasses import dataclass
 
 import numpy as np
 from astropy.io import fits
-from astropy.table import QTable, Column
+from astropy.table import QTable, Column, vstack
 from astropy import units as u
 from colorama import Fore
 
@@ -46,3 +50,307 @@ def naming_convention(data_path, sample, source_number, setup, pointing, mod):
     return (
         f"{data_path}/{mod}.{sample}.{setup}.{pointing}.{source_number.astype(int):03d}"
     )
+
+
+def read_spectral_range(spectrum_file):
+    """
+    Read the range of wavelengths covered by a 1d spectrum, between the outer 
+    edges of its lowest and highest pixels, without reading the spectrum 
+    itself. Only the header is read if it records the lowest and highest 
+    wavelengths (TDMIN and TDMAX); otherwise the lowest and highest 
+    wavelengths and their neighbours are found in the memory mapped 
+    wavelengths. The wavelengths need not be sorted, e.g. for spectra of 
+    several arms that are concatenated.
+    Input:
+        spectrum_file: target spectrum file or PackedSpectrum
+    Return:
+        Quantity with the lowest and highest wavelengths covered; the range is
+        empty (from inf to -inf) for spectra with fewer than two pixels
+    """
+    if isinstance(spectrum_file, PackedSpectrum):
+        wl = open_pack(spectrum_file.pack).read(spectrum_file.key)["wl"]
+        return wavelength_range(wl.value) * wl.unit
+    with fits.open(spectrum_file, memmap=True) as hdul:
+        table = first_table(hdul)
+        unit = u.Unit(table.columns["wl"].unit)
+        index = table.columns.names.index("wl") + 1
+        low = table.header.get(f"TDMIN{index}")
+        high = table.header.get(f"TDMAX{index}")
+        npix = table.header["NAXIS2"]
+        if low is not None and high is not None and npix > 1:
+            # Without the pixels, the outer pixels are half the average width
+            half = (high - low) / (npix - 1) / 2.0
+            return np.array([low - half, high + half]) * unit
+        return wavelength_range(table.data["wl"]) * unit
+
+
+def wavelength_range(wl):
+    """
+    Range between the outer edges of the lowest and highest pixels, each as
+    wide as the distance to its closest neighbour in the array
+    Input:
+        wl: plain array of wavelengths, not necessarily sorted
+    Return:
+        array with the lowest and highest wavelengths covered, or from inf to
+        -inf for fewer than two pixels
+    """
+    if len(wl) < 2:
+        return np.array([np.inf, -np.inf])
+
+    def width(i):
+        neighbours = wl[max(i - 1, 0) : i + 2].astype(float)
+        distance = np.abs(neighbours - float(wl[i]))
+        distance = distance[distance > 0]
+        return np.min(distance) if len(distance) else 0.0
+
+    lowest, highest = int(np.argmin(wl)), int(np.argmax(wl))
+    return np.array(
+        [wl[lowest] - width(lowest) / 2.0, wl[highest] + width(highest) / 2.0],
+        dtype=float,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def parse_unit(unit):
+    """
+    Parse the unit of a FITS table column, once per process for each unit
+    """
+    return u.Unit(unit, format="fits", parse_strict="silent")
+
+
+def read_spectrum(spectrum_file):
+    """
+    Read a 1d spectrum with wl, flux and stdev columns. The binary table is 
+    memory mapped and its columns are wrapped as Quantities that are views of
+    the mapped data, without copies, so that the pages of the file are shared
+    by all the workers that read it. Tables that cannot be mapped as they are,
+    e.g. with scaled, multidimensional, unitless or invalid (NaN) columns, are
+    read with QTable.read instead.
+    Input:
+        spectrum_file: target spectrum file or PackedSpectrum
+    Return:
+        QTable with the spectrum
+    """
+    if isinstance(spectrum_file, PackedSpectrum):
+        return open_pack(spectrum_file.pack).read(spectrum_file.key)
+    with fits.open(spectrum_file, memmap=True) as hdul:
+        columns = mapped_columns(first_table(hdul))
+    if columns is None:
+        return QTable.read(spectrum_file)
+    return QTable(columns, copy=False)
+
+
+def first_table(hdul):
+    """
+    First table HDU of a FITS file, as read by QTable.read, or None
+    """
+    return next(
+        (hdu for hdu in hdul if isinstance(hdu, (fits.TableHDU, fits.BinTableHDU))),
+        None,
+    )
+
+
+def mapped_columns(table):
+    """
+    Wrap the columns of a memory mapped binary table as Quantities
+    Input:
+        table: first table HDU of a spectrum file or block of a pack, or None
+    Return:
+        dictionary of the columns, or None if the table is not a spectrum of 
+        plain floating point columns with units
+    """
+    if not isinstance(table, fits.BinTableHDU) or table.data is None:
+        return None
+    columns = {}
+    for column in table.columns:
+        data = table.data[column.name]
+        if (
+            data.dtype.kind != "f"
+            or data.ndim != 1
+            or column.bscale is not None
+            or column.bzero is not None
+            or not column.unit
+        ):
+            return None
+        unit = parse_unit(column.unit)
+        if isinstance(unit, u.UnrecognizedUnit) or np.isnan(data).any():
+            return None
+        columns[column.name] = u.Quantity(data, unit, copy=False)
+    if not {"wl", "flux", "stdev"} <= columns.keys():
+        return None
+    return columns
+
+
+@dataclass(frozen=True)
+class PackedSpectrum:
+    """
+    A spectrum stored in a pack, which stands in for the path of its original
+    file: the results are written next to the original file.
+    """
+
+    pack: str
+    key: str
+    path: str
+
+    def __fspath__(self):
+        return self.path
+
+
+@dataclass
+class SpectrumPack:
+    """
+    The spectra of a project packed into a single FITS file by `gleam pack`. 
+    The file holds blocks of spectra, each a binary table (SPECTRA) in which 
+    the spectra are concatenated, followed by an index (INDEX) with the 
+    properties of their targets, the paths of their original files, relative 
+    to the pack, and the rows at which they start and stop. New blocks are 
+    appended to the end of the file, without rewriting the blocks before. The
+    blocks are memory mapped, so that the spectra are read as views.
+    """
+
+    path: str
+    blocks: list
+    index: QTable
+    rows: dict
+
+    @staticmethod
+    def open(pack_file) -> "SpectrumPack":
+        blocks, indices = [], []
+        with fits.open(pack_file, memmap=True) as hdul:
+            for hdu in hdul:
+                if hdu.name == "SPECTRA":
+                    blocks.append(mapped_columns(hdu))
+                elif hdu.name == "INDEX":
+                    index = QTable.read(hdu)
+                    index["block"] = len(blocks) - 1
+                    indices.append(index)
+        index = vstack(indices)
+        return SpectrumPack(
+            path=pack_file,
+            blocks=blocks,
+            index=index,
+            rows={key: i for i, key in enumerate(index["key"])},
+        )
+
+    def read(self, key) -> QTable:
+        """
+        Read the spectrum of a source, as views of the packed columns
+        Input:
+            key: Sample.Setup.Pointing.SourceNumber key of the source
+        Return:
+            QTable with the spectrum
+        """
+        row = self.index[self.rows[key]]
+        block = self.blocks[row["block"]]
+        start, stop = row["start"], row["stop"]
+        return QTable(
+            {name: column[start:stop] for name, column in block.items()}, copy=False
+        )
+
+    def sources(self, spectra=None):
+        """
+        The packed spectra with the properties of their targets, in the order 
+        of the paths of their original files
+        Input:
+            spectra: filter for the paths of the original files, or None
+        Return:
+            list of (PackedSpectrum, Astropy row with target properties)
+        """
+        directory = os.path.dirname(self.path)
+        sources = []
+        for i in np.argsort(self.index["path"], kind="stable"):
+            path = os.path.normpath(os.path.join(directory, self.index["path"][i]))
+            if spectra is not None and not fnmatch(path, os.path.normpath(spectra)):
+                continue
+            # A single row table per source, so that each source is sent to the
+            # workers without the rest of the index
+            target = self.index[i : i + 1][0]
+            sources.append((PackedSpectrum(self.path, target["key"], path), target))
+        return sources
+
+
+@functools.lru_cache(maxsize=None)
+def open_pack(pack_file) -> SpectrumPack:
+    """
+    Open a pack of spectra, once per process
+    """
+    return SpectrumPack.open(pack_file)
+
+
+def pack_spectra(sources, pack_file):
+    """
+    Pack spectra, with the properties of their targets, into a single file. If
+    the pack exists, the spectra of sources that are not yet in the pack are 
+    appended to it as new blocks. Spectra with the same columns and units go 
+    in the same block; spectra that cannot be memory mapped as they are (see
+    read_spectrum) are left out of the pack.
+    Input:
+        sources: list of (spectrum file, Astropy row with target properties),
+                 with the target rows from a single Targets table
+        pack_file: path of the pack
+    Return:
+        number of spectra added to the pack
+    """
+    packed = set()
+    if os.path.exists(pack_file):
+        packed = set(SpectrumPack.open(pack_file).rows)
+    directory = os.path.dirname(os.path.abspath(pack_file))
+
+    # Read the new spectra, grouped by the layout of their columns
+    blocks = {}
+    for spectrum_file, target in sources:
+        if target["key"] in packed:
+            continue
+        with fits.open(spectrum_file, memmap=True) as hdul:
+            table = first_table(hdul)
+            columns = mapped_columns(table)
+            if columns is not None:
+                layout = tuple((c.name, c.format, c.unit) for c in table.columns)
+                columns = {
+                    name: np.array(column.value) for name, column in columns.items()
+                }
+        if columns is None:
+            print(
+                Fore.YELLOW
+                + f"Warning: cannot pack {spectrum_file}, it is left out of the pack."
+            )
+            continue
+        packed.add(target["key"])
+        path = os.path.relpath(os.path.abspath(spectrum_file), directory)
+        blocks.setdefault(layout, []).append((path, target, columns))
+
+    hdus = []
+    for layout, spectra in blocks.items():
+        # Spectra concatenated, column by column
+        stop = np.cumsum([len(columns["wl"]) for _, _, columns in spectra])
+        hdus.append(
+            fits.BinTableHDU.from_columns(
+                [
+                    fits.Column(
+                        name=name,
+                        format=format,
+                        unit=unit,
+                        array=np.concatenate([c[name] for _, _, c in spectra]),
+                    )
+                    for name, format, unit in layout
+                ],
+                name="SPECTRA",
+            )
+        )
+        # Index of the spectra, with the properties of their targets
+        targets = spectra[0][1].table
+        index = QTable(targets[[target.index for _, target, _ in spectra]])
+        index.remove_indices("key")
+        index["path"] = [path for path, _, _ in spectra]
+        index["start"] = np.concatenate([[0], stop[:-1]])
+        index["stop"] = stop
+        hdus.append(fits.table_to_hdu(index))
+        hdus[-1].name = "INDEX"
+
+    if hdus and os.path.exists(pack_file):
+        with fits.open(pack_file, mode="append") as hdul:
+            for hdu in hdus:
+                hdul.append(hdu)
+    elif hdus:
+        fits.HDUList([fits.PrimaryHDU(), *hdus]).writeto(pack_file)
+    return sum(len(spectra) for spectra in blocks.values())
@@ -6,15 +6,17 @@ import os, sys
 from dataclasses import dataclass
 from typing import List
 import functools
-import operator
 
 import numpy as np
+from scipy import ndimage
 from astropy import units as u
 from astropy import constants as const
 from astropy.table import QTable, Column
 from colorama import Fore
 from colorama import init
 
+import gleam.kernels as kernels
+
 init(autoreset=True)
 
 
@@ -73,30 +75,199 @@ def amplitude_to_height(amplitude, sigma):
 
 def bin_spectrum(spectrum, n=2):
     """
-    Bin the spectrum by averaging n number of adjacent cells together
+    Bin the spectrum by averaging n number of adjacent cells together; the 
+    cells left after the last full bin are dropped
     Input:
         spectrum: astropy spectrum, where: x axis, usually wavelength; y axis, 
                   usually flux; yerr axis, usually stdev on flux
     Output:
-        binned spectrum
+        binned spectrum, in single precision
     """
-    tsize = len(spectrum) // n * n
-    spectrum = spectrum[:tsize]
-    t = QTable()
+    spectrum = sort_by_wavelength(spectrum)
+    edges = pixel_edges(spectrum["wl"].value)
+    return resample(spectrum, edges[: len(edges) - len(spectrum) % n : n], "f")
+
+
+def sort_by_wavelength(spectrum):
+    """
+    Put the pixels of a spectrum in order of increasing wavelength, if they are
+    not already
+    """
+    wl = spectrum["wl"].value
+    if np.all(wl[1:] >= wl[:-1]):
+        return spectrum
+    return spectrum[np.argsort(wl, kind="stable")]
+
 
-    t["wl"] = Column(
-        average_(spectrum["wl"], n), unit=spectrum["wl"].unit, dtype="f"
-    )  # Ang
-    t["flux"] = Column(
-        average_(spectrum["flux"], n), unit=spectrum["flux"].unit, dtype="f"
-    )  # Ang
-    t["stdev"] = Column(
-        average_err(spectrum["stdev"], n), unit=spectrum["flux"].unit, dtype="f"
+def pixel_edges(wl):
+    """
+    Edges of the pixels of a sorted wavelength grid, halfway between adjacent
+    pixels; the first and last pixels are taken to be symmetric around their 
+    center
+    Input:
+        wl: plain array of strictly increasing wavelengths, with at least two
+            pixels
+    Output:
+        plain array of len(wl) + 1 edges
+    """
+    if np.any(wl[1:] <= wl[:-1]):
+        raise ValueError(
+            "The wavelengths of the spectrum must be strictly increasing to "
+            "find the edges of its pixels"
+        )
+    middle = (wl[1:] + wl[:-1]) / 2.0
+    return np.concatenate(
+        [[2.0 * wl[0] - middle[0]], middle, [2.0 * wl[-1] - middle[-1]]]
     )
 
+
+def rebin(edges, flux, stdev, new_edges):
+    """
+    Flux-conserving resampling of a spectrum onto new pixels: the flux of each
+    new pixel is the average flux density over the old pixels it covers, 
+    weighted by their overlap, and the errors are propagated accordingly. New
+    pixels that are not fully covered by the spectrum are dropped.
+    Input:
+        edges: plain array with the edges of the pixels of the spectrum
+        flux: flux density of each pixel
+        stdev: error on the flux of each pixel
+        new_edges: sorted plain array with the edges of the new pixels
+    Output:
+        wavelength, flux and error of each new pixel, in double precision
+    """
+    new_edges = new_edges[(new_edges >= edges[0]) & (new_edges <= edges[-1])]
+    if len(new_edges) < 2:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    flux = np.asarray(flux, dtype=np.float64)
+    stdev = np.asarray(stdev, dtype=np.float64)
+    width = np.diff(edges)
+    new_width = np.diff(new_edges)
+
+    # Each new pixel covers part of the old pixels at its ends and all the old
+    # pixels in between. The sums are taken per new pixel, rather than as
+    # differences of cumulative sums, so that a pixel with a non-finite flux
+    # or error only affects the new pixels that overlap it
+    pixel = np.clip(np.searchsorted(edges, new_edges, "right") - 1, 0, len(flux) - 1)
+    first, last = pixel[:-1], pixel[1:]
+    lower, upper = new_edges[:-1], new_edges[1:]
+    head = np.where(first == last, upper - lower, edges[first + 1] - lower)
+    tail = np.where(first == last, 0.0, upper - edges[last])
+
+    def overlap(values, index, length):
+        return np.multiply(
+            values[index], length, out=np.zeros(len(length)), where=length > 0
+        )
+
+    new_flux = (
+        overlap(flux, first, head)
+        + range_sums(flux * width, first + 1, last)
+        + overlap(flux, last, tail)
+    ) / new_width
+
+    # Variances add with the square of the overlap
+    variance = stdev ** 2
+    new_variance = (
+        overlap(variance, first, head ** 2)
+        + range_sums(variance * width ** 2, first + 1, last)
+        + overlap(variance, last, tail ** 2)
+    )
+    return (lower + upper) / 2.0, new_flux, np.sqrt(new_variance) / new_width
+
+
+def range_sums(values, start, stop):
+    """
+    Sums of values over the index ranges [start, stop), zero for empty ranges
+    Input:
+        values: plain array
+        start, stop: arrays of indices into values, with stop <= len(values)
+    Output:
+        plain array with the sum over each range
+    """
+    sums = np.add.reduceat(np.append(values, 0.0), np.ravel([start, stop], "F"))
+    return np.where(stop > start, sums[::2], 0.0)
+
+
+def resample(spectrum, new_edges, dtype=None):
+    """
+    Flux-conserving resampling of a spectrum onto new pixels, see rebin
+    Input:
+        spectrum: astropy spectrum with wl, flux and stdev columns
+        new_edges: plain array with the edges of the new pixels, in the unit of
+                   the wavelengths
+        dtype: floating point type of the resampled spectrum; that of the 
+               fluxes if None
+    Output:
+        resampled spectrum
+    """
+    spectrum = sort_by_wavelength(spectrum)
+    wl, flux, stdev = rebin(
+        pixel_edges(spectrum["wl"].value),
+        spectrum["flux"].value,
+        spectrum["stdev"].to_value(spectrum["flux"].unit),
+        new_edges,
+    )
+    if dtype is None:
+        dtype = spectrum["flux"].dtype
+    t = QTable()
+    t["wl"] = Column(wl, unit=spectrum["wl"].unit, dtype=dtype)
+    t["flux"] = Column(flux, unit=spectrum["flux"].unit, dtype=dtype)
+    t["stdev"] = Column(stdev, unit=spectrum["flux"].unit, dtype=dtype)
     return t
 
 
+def grid_edges(wl_min, wl_max, grid, step, z, unit):
+    """
+    Edges of the pixels of a grid shared by all sources, covering the range
+    from wl_min to wl_max. Log-linear grids are anchored at a wavelength of 1
+    in the given unit and restframe grids at 0, so that the pixels of all 
+    sources line up.
+    Input:
+        wl_min, wl_max: observed range to cover, in the given unit
+        grid: "log", "velocity" or "rest"
+        step: width of the pixels: in dex for "log", as an Astropy velocity for
+              "velocity" and as an Astropy restframe length for "rest"
+        z: redshift of the source
+        unit: wavelength unit of the spectrum
+    Output:
+        plain array with the observed edges of the pixels
+    """
+    if step is None:
+        raise ValueError(f"A step is needed to resample onto a {grid} grid")
+    if grid == "rest":
+        step = u.Quantity(step).to_value(unit) * (1 + z)
+        return np.arange(np.floor(wl_min / step), np.ceil(wl_max / step) + 1) * step
+    if grid == "log":
+        step = float(step) * np.log(10.0)
+    else:
+        step = (u.Quantity(step) / const.c).to_value(u.dimensionless_unscaled)
+    return np.exp(
+        np.arange(np.floor(np.log(wl_min) / step), np.ceil(np.log(wl_max) / step) + 1)
+        * step
+    )
+
+
+def resample_spectrum(spectrum, grid, step, z):
+    """
+    Resample the spectrum of a source onto a grid shared by all sources, see 
+    grid_edges
+    Input:
+        spectrum: astropy spectrum with wl, flux and stdev columns
+        grid: "none", "log", "velocity" or "rest"; with "none", the spectrum is
+              left as it is
+        step: width of the pixels of the grid
+        z: redshift of the source
+    Output:
+        resampled spectrum
+    """
+    if grid == "none":
+        return spectrum
+    spectrum = sort_by_wavelength(spectrum)
+    edges = pixel_edges(spectrum["wl"].value)
+    return resample(
+        spectrum, grid_edges(edges[0], edges[-1], grid, step, z, spectrum["wl"].unit),
+    )
+
+
 def reject_outliers(data, m=2):
     """
     Rejects outliers at a certain number of sigma away from the mean
@@ -122,16 +293,53 @@ def dispersion(wl):
         
     ! Writes warning if the spectrum in non uniform
     """
+    return DispersionProfile.from_wavelengths(wl).minimum
 
-    diff = wl[1:] - wl[0:-1]
-    diff, mask = reject_outliers(diff, 3)
-    average = np.mean(diff)
-    stdev = np.std(diff)
-    minimum = np.min(diff)
 
-    if stdev / average > 10 ** -3:
-        print(Fore.YELLOW + "Warning: non-constant dispersion")
-    return minimum
+@dataclass
+class DispersionProfile:
+    """
+    Dispersion (wavelength width per pixel) of a 1D spectrum. The uniformity
+    of the dispersion is checked once per spectrum, so that the width of a
+    pixel in a region of the spectrum only needs the pixels of that region.
+    """
+
+    wl: np.ndarray
+    minimum: float
+
+    @staticmethod
+    def from_wavelengths(wl) -> "DispersionProfile":
+        """
+        Minimum spacing between adjacent pixels, with outliers (e.g. gaps in
+        the spectrum) rejected
+        ! Writes warning if the spectrum in non uniform
+        """
+        diff = wl[1:] - wl[0:-1]
+        valid, _ = reject_outliers(diff, 3)
+        average = np.mean(valid)
+        stdev = np.std(valid)
+        minimum = np.min(valid)
+
+        if stdev / average > 10 ** -3:
+            print(Fore.YELLOW + "Warning: non-constant dispersion")
+        return DispersionProfile(wl=wl, minimum=minimum)
+
+    def pixel(self, window, mask):
+        """
+        Minimum width of a pixel in a region of the spectrum, as dispersion
+        computes it from the selected pixels of the region, but without the
+        warning
+        Input:
+            window: slice of the spectrum
+            mask: mask within the window, as returned by select_window
+        Output:
+            dispersion: single minimum value for dispersion in the region
+        """
+        wl = self.wl[window][mask]
+        if len(wl) < 2:
+            return self.minimum
+        valid, _ = reject_outliers(wl[1:] - wl[0:-1], 3)
+        return np.min(valid)
 
 
 def mask_line(wl, wl_ref, mask_width):
@@ -167,7 +375,7 @@ def mask_atmosphere(wl, z, sky):
     Input:
         wl: rest-frame wavelength spectrum
         z: redshift of the source; used to restframe the sky lines
-        sky: sky bands in QTable format
+        sky: SkyBands
     Output:
         mask: mask to be applied to the spectrum such that the spectrum now has 
               the absorption features masked
@@ -177,17 +385,122 @@ def mask_atmosphere(wl, z, sky):
     if sky is None:
         return np.ones_like(wl.value).astype(bool)
     # mask areas of absorption due to sky
-    absorption = functools.reduce(
-        operator.or_,
-        (
-            (wl > restframe_wl(band["wavelength_min"], z))
-            & (wl < restframe_wl(band["wavelength_max"], z))
-            for band in sky
-        ),
+    return outside_bands(wl.value, *sky_bands(sky, z, wl.unit))
+
+
+@dataclass
+class SkyBands:
+    """
+    Sky bands compiled into sorted, disjoint intervals in the observed frame. 
+    Overlapping bands of the catalog are merged, so that the bands containing 
+    a wavelength can be found by bisection.
+    """
+
+    wavelength_min: u.Quantity
+    wavelength_max: u.Quantity
+
+    @staticmethod
+    def from_table(sky) -> "SkyBands":
+        """
+        Compile a sky table with the columns wavelength_min and wavelength_max
+        """
+        unit = sky["wavelength_min"].unit
+        lower = sky["wavelength_min"].to_value(unit)
+        upper = sky["wavelength_max"].to_value(unit)
+        # Empty bands do not mask anything
+        keep = upper > lower
+        order = np.argsort(lower[keep], kind="stable")
+        lower, upper = lower[keep][order], upper[keep][order]
+        if len(lower) == 0:
+            return SkyBands(wavelength_min=lower * unit, wavelength_max=upper * unit)
+        # A band starts a new interval if it starts after all previous bands
+        # end; the open intervals of touching bands are not merged
+        reach = np.maximum.accumulate(upper)
+        start = np.flatnonzero(np.concatenate([[True], lower[1:] >= reach[:-1]]))
+        return SkyBands(
+            wavelength_min=lower[start] * unit,
+            wavelength_max=np.maximum.reduceat(upper, start) * unit,
+        )
+
+    def __len__(self):
+        return len(self.wavelength_min)
+
+
+@functools.lru_cache(maxsize=None)
+def read_sky(sky_file):
+    """
+    Read and compile a sky catalog; every catalog is only read once
+    Input:
+        sky_file: fits table with the sky bands
+    Output:
+        SkyBands
+    """
+    return SkyBands.from_table(QTable.read(sky_file))
+
+
+def sky_bands(sky, z, unit):
+    """
+    Restframe the sky absorption bands of a source and strip their units
+    Input:
+        sky: SkyBands, or None
+        z: redshift of the source; used to restframe the sky lines
+        unit: wavelength unit of the spectrum
+    Output:
+        plain arrays with the lower and upper ends of the bands, in the given
+        unit and still sorted and disjoint, or None if there are no sky bands
+    """
+    if sky is None:
+        return None
+    return (
+        restframe_wl(sky.wavelength_min, z).to_value(unit),
+        restframe_wl(sky.wavelength_max, z).to_value(unit),
     )
 
-    without_absorption = ~absorption
-    return without_absorption
+
+def outside_bands(x, lower, upper):
+    """
+    Mask the positions that fall within any of a set of sorted, disjoint open
+    intervals, such as the sky bands, with one bisection per position
+    Input:
+        x: plain array of positions, e.g. wavelengths
+        lower: sorted plain array with the lower ends of the intervals
+        upper: plain array with the upper ends of the intervals
+    Output:
+        mask that is True for the positions outside all intervals
+    """
+    if len(lower) == 0:
+        return np.full(np.shape(x), True)
+    # Compare in the floating point type of x
+    lower = np.asarray(lower, dtype=x.dtype)
+    upper = np.asarray(upper, dtype=x.dtype)
+    # Last interval that starts before each position
+    last = np.searchsorted(lower, x, "left") - 1
+    return (last < 0) | (x >= upper[np.maximum(last, 0)])
+
+
+def outside_intervals(x, lower, upper, closed=False):
+    """
+    Mask the positions that fall within any of a set of intervals
+    Input:
+        x: plain array of positions, e.g. wavelengths
+        lower: plain array with the lower ends of the intervals
+        upper: plain array with the upper ends of the intervals
+        closed: whether the ends belong to the intervals
+    Output:
+        mask that is True for the positions outside all intervals
+    """
+    # Compare in the floating point type of x
+    lower = np.asarray(lower, dtype=x.dtype)
+    upper = np.asarray(upper, dtype=x.dtype)
+    if kernels.enabled():
+        return kernels.outside_intervals(x, lower, upper, closed)
+    mask = np.full(np.shape(x), True)
+    for low, high in zip(lower, upper):
+        if closed:
+            mask &= (x < low) | (x > high)
+        else:
+            mask &= (x <= low) | (x >= high)
+    return mask
 
 
 def restframe_wl(x, z):
@@ -215,6 +528,24 @@ def add_restframe(spectrum, z):
     return spectrum
 
 
+def set_precision(spectrum, precision):
+    """
+    Store the wavelengths, fluxes and errors of the spectrum in single 
+    precision, if requested, so that all the windows extracted from it stay in
+    single precision
+    Input:
+        spectrum: Astropy table containing the 1d spectrum of a source
+        precision: "double" or "single"; with "double", the spectrum is left 
+                   as it is
+    Output:
+        spectrum in the requested precision
+    """
+    if precision == "single":
+        for column in ["wl", "flux", "stdev", "wl_rest"]:
+            spectrum[column] = spectrum[column].astype(np.float32)
+    return spectrum
+
+
 def select_singleline(wl_rest, line, cont_width):
     """
     Select the region around an emission line
@@ -234,51 +565,256 @@ def select_singleline(wl_rest, line, cont_width):
     return mask
 
 
-def select_lines(
-    selected_lines, other_lines, spectrum, target_info, sky, cont_width, mask_width,
-):
+def select_lines(wl_selected, wl_other, wl_rest, bands, cont_width, mask_width):
     """
     Masks the spectrum in the vicinity of the line of interest. It should leave 
     unmasked the actual line and lots of continuum, but mask other neighboring 
     lines we want to fit, that might contaminate the continuum estimation
+    !!! Assumes the spectrum is restframed; all inputs are plain arrays and 
+    numbers, in the wavelength unit of the spectrum !!!
     Input: 
-        selected_lines: table of all the lines to be fit
-        other_lines: the other lines in the table that will be masked
-        spectrum: 1d spectrum, error and wavelength, as read in by 
-                  read_files.read_spectrum with extra column for the restframe 
-                  wavelength
-        target: ancillary information on the source, such as RA, DEC or redshift
-                as produced by read_files.read_lof()
+        wl_selected: wavelengths of all the lines to be fit
+        wl_other: wavelengths of the other lines in the table that will be 
+                  masked
+        wl_rest: restframe wavelengths of the spectrum
+        bands: restframe sky bands to mask, as returned by sky_bands, or None
         cont_width: amount of wavelength coverage on each side of the line that
                     will be taken into account
+        mask_width: width of the region masked around each of the other lines
     Output:
         wl_masked: masked wavelength coverage, with only the line of interest 
                    and the continuum; all other lines masked
     """
-    z_ref = target_info["Redshift"]
-    wl_rest = spectrum["wl_rest"]
-    flux = spectrum["flux"]
-    # Restframe resolution
-    res_rest = dispersion(wl_rest)
     # mask all lines, but the line we are interested in
-    masked_otherlines = np.full(np.shape(wl_rest), True)
-    for line in map(QTable, other_lines):
-        mask = mask_line(wl_rest, line["wavelength"], mask_width)
-        masked_otherlines = masked_otherlines & mask
+    masked_otherlines = outside_intervals(
+        wl_rest, wl_other - mask_width / 2.0, wl_other + mask_width / 2.0, closed=True
+    )
 
     # select the lines of interest
-    select_lines = np.full(np.shape(wl_rest), False)
-    for line in map(QTable, selected_lines):
-        mask = select_singleline(wl_rest, line["wavelength"], cont_width)
-        select_lines = select_lines | mask
+    select_lines = ~outside_intervals(
+        wl_rest, wl_selected - cont_width, wl_selected + cont_width
+    )
 
     # mask the atmospheric lines, if masking them is enabled
-    masked_atm = mask_atmosphere(wl_rest, z_ref, sky)
+    masked_atm = np.full(np.shape(wl_rest), True)
+    if bands is not None:
+        masked_atm = outside_bands(wl_rest, *bands)
     masked_all = masked_atm & masked_otherlines & select_lines
 
     return masked_all
 
 
+@dataclass
+class Grid:
+    """
+    Wavelength grid of a spectrum, used to find the pixels within a range of
+    wavelengths without scanning the whole spectrum. Pixels of linear and 
+    log-linear grids are located by index arithmetic, those of other sorted
+    grids by bisection. Unsorted grids can only be masked pixel by pixel.
+    """
+
+    wl: np.ndarray
+    kind: str
+    start: float = 0.0
+    step: float = 1.0
+
+    @staticmethod
+    def from_wavelengths(wl) -> "Grid":
+        """
+        Detect the kind of grid of a plain array of wavelengths
+        """
+        n = len(wl)
+        if n < 2 or np.any(wl[1:] < wl[:-1]):
+            return Grid(wl=wl, kind="unsorted")
+        position = np.asarray(wl, dtype=np.float64)
+        for kind in ("linear", "log"):
+            if kind == "log":
+                if wl[0] <= 0:
+                    break
+                position = np.log(position)
+            step = (position[-1] - position[0]) / (n - 1)
+            expected = position[0] + step * np.arange(n)
+            if step > 0 and np.max(np.abs(position - expected)) < 0.25 * step:
+                return Grid(wl=wl, kind=kind, start=position[0], step=step)
+        return Grid(wl=wl, kind="sorted")
+
+    def index(self, values, side="left"):
+        """
+        Indices where the values would be inserted to keep the grid sorted, as
+        returned by np.searchsorted. The values are compared in the floating
+        point type of the grid.
+        """
+        values = np.asarray(values, dtype=self.wl.dtype)
+        n = len(self.wl)
+        if self.kind == "sorted" or (self.kind == "log" and np.any(values <= 0)):
+            return np.searchsorted(self.wl, values, side)
+        position = np.asarray(values, dtype=np.float64)
+        if self.kind == "log":
+            position = np.log(position)
+        guess = np.clip(np.ceil((position - self.start) / self.step), 0, n)
+        index = guess.astype(int)
+
+        # Pixels before the values: wl < value for "left", wl <= value for
+        # "right"
+        before = np.less if side == "left" else np.less_equal
+        for _ in range(2):
+            index -= (index > 0) & ~before(self.wl[np.maximum(index - 1, 0)], values)
+            index += (index < n) & before(self.wl[np.minimum(index, n - 1)], values)
+        found = ((index == 0) | before(self.wl[np.maximum(index - 1, 0)], values)) & (
+            (index == n) | ~before(self.wl[np.minimum(index, n - 1)], values)
+        )
+        if not np.all(found):
+            return np.searchsorted(self.wl, values, side)
+        return index
+
+
+@dataclass
+class LineCatalog:
+    """
+    Wavelengths of all the lines of a catalog, as a plain array, sorted once so
+    that the lines within a range of wavelengths can be found by bisection
+    """
+
+    wavelengths: np.ndarray
+    order: np.ndarray
+    sorted_wavelengths: np.ndarray
+
+    @staticmethod
+    def from_wavelengths(wavelengths) -> "LineCatalog":
+        order = np.argsort(wavelengths, kind="stable")
+        return LineCatalog(
+            wavelengths=wavelengths, order=order, sorted_wavelengths=wavelengths[order]
+        )
+
+    def between(self, lower, upper, closed=False):
+        """
+        Indices of the lines with wavelengths between lower and upper, in the 
+        order of the catalog
+        Input:
+            lower, upper: ends of the range of wavelengths
+            closed: whether the ends belong to the range
+        Output:
+            array of indices into the catalog
+        """
+        start = np.searchsorted(
+            self.sorted_wavelengths, lower, "left" if closed else "right"
+        )
+        stop = np.searchsorted(
+            self.sorted_wavelengths, upper, "right" if closed else "left"
+        )
+        return np.sort(self.order[start : max(start, stop)])
+
+
+def select_window(grid, catalog, group, bands, cont_width, mask_width):
+    """
+    Same selection as select_lines, for a sorted spectrum, but at a cost that
+    depends on the size of the selected region rather than on the length of
+    the spectrum or on the size of the line catalog: the region around the 
+    lines of interest is found by bisection, and only the other lines and the
+    sky bands that overlap it are masked.
+    !!! Assumes the spectrum is restframed; all inputs are plain arrays and 
+    numbers, in the wavelength unit of the spectrum !!!
+    Input: 
+        grid: Grid of the restframe wavelengths of the spectrum
+        catalog: LineCatalog of all the lines
+        group: indices of the lines of interest in the catalog; all other 
+               lines of the catalog are masked
+        bands: restframe sky bands to mask, as returned by sky_bands, or None
+        cont_width: amount of wavelength coverage on each side of the line that
+                    will be taken into account
+        mask_width: width of the region masked around each of the other lines
+    Output:
+        window: slice of the spectrum around the lines of interest
+        mask: mask within the window, with all other lines and the sky bands
+              masked
+    """
+    wl_selected = catalog.wavelengths[group]
+    if grid.kind == "unsorted":
+        return (
+            slice(0, len(grid.wl)),
+            select_lines(
+                wl_selected,
+                np.delete(catalog.wavelengths, group),
+                grid.wl,
+                bands,
+                cont_width,
+                mask_width,
+            ),
+        )
+
+    # select the lines of interest
+    start = grid.index(wl_selected - cont_width, "right")
+    stop = grid.index(wl_selected + cont_width, "left")
+    window = slice(int(np.min(start)), int(max(np.max(stop), np.min(start))))
+    wl = grid.wl[window]
+    if len(wl) == 0:
+        return window, np.full(0, True)
+    mask = np.full(len(wl), True)
+    if len(wl_selected) > 1:
+        mask = ~outside_intervals(
+            wl, wl_selected - cont_width, wl_selected + cont_width
+        )
+
+    # mask all lines, but the line we are interested in. Only the lines near
+    # the window are considered; the search range is slightly wider than the
+    # window, so that no line is lost to rounding
+    pad = mask_width / 2.0 + 1e-6 * max(abs(wl[0]), abs(wl[-1]))
+    near = np.setdiff1d(catalog.between(wl[0] - pad, wl[-1] + pad, closed=True), group)
+    wl_other = catalog.wavelengths[near]
+    lower = np.asarray(wl_other - mask_width / 2.0, dtype=wl.dtype)
+    upper = np.asarray(wl_other + mask_width / 2.0, dtype=wl.dtype)
+    overlap = (upper >= wl[0]) & (lower <= wl[-1])
+    if np.any(overlap):
+        mask &= outside_intervals(wl, lower[overlap], upper[overlap], closed=True)
+
+    # mask the atmospheric lines, if masking them is enabled
+    if bands is not None:
+        mask &= outside_bands(wl, *bands)
+    return window, mask
+
+
+def global_continuum(wl, flux, catalog, bands, cont_width, mask_width):
+    """
+    Smooth continuum of the whole spectrum, estimated once per source: a 
+    running median of the flux of the pixels away from all lines and sky 
+    bands, over windows spanning about cont_width, interpolated linearly 
+    across the masked pixels. The running median costs O(N log w) for N 
+    pixels and windows of w pixels.
+    !!! Assumes the spectrum is restframed; all inputs are plain arrays and 
+    numbers, in the wavelength unit of the spectrum !!!
+    Input:
+        wl: restframe wavelengths of the spectrum
+        flux: fluxes of the spectrum
+        catalog: LineCatalog of all the lines, which are masked
+        bands: restframe sky bands to mask, as returned by sky_bands, or None
+        cont_width: wavelength span of the running median
+        mask_width: width of the region masked around each line
+    Output:
+        continuum at each pixel, in the floating point type of the flux; zero 
+        if no pixel is free of lines and sky
+    """
+    # The regions around the lines all have the same width, so that their
+    # upper ends are sorted as well and they can be masked by bisection
+    lines = catalog.sorted_wavelengths
+    free = outside_bands(wl, lines - mask_width / 2.0, lines + mask_width / 2.0)
+    if bands is not None:
+        free &= outside_bands(wl, *bands)
+    if not np.any(free):
+        return np.zeros_like(flux)
+    order = np.argsort(wl[free], kind="stable")
+    wl_free, flux_free = wl[free][order], flux[free][order]
+
+    # Number of free pixels per window, from their average spacing
+    n = len(wl_free)
+    span = wl_free[-1] - wl_free[0]
+    size = n if span <= 0 else int(np.clip(round(n * cont_width / span), 1, n))
+
+    smooth = ndimage.median_filter(
+        np.asarray(flux_free, dtype=np.float64), size=size, mode="nearest"
+    )
+    return np.interp(wl, wl_free, smooth).astype(flux.dtype)
+
+
 def group_lines(line_list, tolerance):
     """
     Group together lines within a wavelength tolerance. These will be fit 
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import yaml
+from astropy import units as u
+from astropy.table import QTable, Table
+
+import gleam
+import gleam.main
+import gleam.constants as c
+
+LINES = {
+    "Hb": (4862.68, 3.0),
+    "OIII4": (4960.295, 2.7),
+    "OIII5": (5008.24, 8.0),
+    "NII1": (6549.86, 0.2),
+    "Ha": (6564.614, 10.0),
+    "NII2": (6585.27, 3.0),
+    "SII1": (6718.29, 1.2),
+    "SII2": (6732.67, 0.9),
+}
+
+
+@pytest.fixture
+def project(tmp_path):
+    """
+    A small project with a line catalog, sky bands and the spectra of three
+    sources at different redshifts; the last one is faint
+    Return:
+        function that fits all sources with the given fitting parameters, one
+        at a time or in batches of the given size, and returns the table of
+        line fits of each source
+    """
+    rng = np.random.default_rng(1)
+    lines = QTable()
+    lines["line"] = list(LINES)
+    lines["wavelength"] = [wl for wl, _ in LINES.values()] * u.Angstrom
+    lines["latex"] = list(LINES)
+    lines.write(tmp_path / "lines.fits")
+    sky = QTable()
+    sky["band"] = ["A", "B"]
+    sky["wavelength_min"] = [7586.0, 6864.0] * u.Angstrom
+    sky["wavelength_max"] = [7658.0, 6945.0] * u.Angstrom
+    sky.write(tmp_path / "sky.fits")
+
+    meta = Table()
+    meta["Setup"] = ["K"] * 3
+    meta["Pointing"] = ["P1"] * 3
+    meta["SourceNumber"] = [1, 2, 3]
+    meta["Sample"] = ["S"] * 3
+    meta["Redshift"] = [0.1, 0.05, 0.15]
+    meta.write(
+        tmp_path / "meta.S.K.P1.dat", format="ascii.commented_header",
+    )
+    flux_unit = 1e-17 * u.erg / u.s / u.cm ** 2 / u.Angstrom
+    for row, scale in zip(meta, [1.0, 0.5, 0.05]):
+        z = row["Redshift"]
+        wl = np.arange(5000.0, 8000.0, 1.1)
+        sigma = 4.4 / 2.3548 * 1.3 * (1 + z)
+        flux = 1.0 + rng.normal(0.0, 0.3, len(wl))
+        for line, amplitude in LINES.values():
+            flux += (
+                scale
+                * amplitude
+                * np.exp(-((wl - line * (1 + z)) ** 2) / (2 * sigma ** 2))
+            )
+        spectrum = QTable()
+        spectrum["wl"] = wl * u.Angstrom
+        spectrum["flux"] = flux * flux_unit
+        spectrum["stdev"] = np.full_like(wl, 0.3) * flux_unit
+        spectrum.write(tmp_path / f"spec1d.S.K.P1.{row['SourceNumber']:03d}.fits")
+
+    def fit(batch=1, **fitting):
+        config_file = tmp_path / "gleamconfig.yaml"
+        config_file.write_text(
+            yaml.safe_dump(
+                {
+                    "globals": {
+                        "line_table": str(tmp_path / "lines.fits"),
+                        "resolution": "4.4 Angstrom",
+                        "sky": str(tmp_path / "sky.fits"),
+                        "mask_sky": True,
+                        "fitting": fitting,
+                    }
+                }
+            )
+        )
+        config = c.read_config(config_file)
+        sources = gleam.find_sources(tmp_path, None)
+        for linefits in tmp_path.glob("linefits*"):
+            linefits.unlink()
+        if batch > 1:
+            for i in range(0, len(sources), batch):
+                gleam.main.run_batch(
+                    sources[i : i + batch], False, False, False, 1, config
+                )
+        else:
+            for spectrum_file, target in sources:
+                gleam.main.run_main(
+                    spectrum_file, target, False, False, False, 1, config
+                )
+        return [
+            QTable.read(linefits) for linefits in sorted(tmp_path.glob("linefits*"))
+        ]
+
+    return fit
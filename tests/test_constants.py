@@ -0,0 +1,21 @@
+import numpy as np
+from astropy import units as u
+from astropy.cosmology import FlatLambdaCDM
+
+import gleam.constants as c
+
+
+def test_distance_table_matches_the_cosmology():
+    cosmo = FlatLambdaCDM(H0=68 * u.km / u.s / u.Mpc, Om0=0.31, Tcmb0=2.725 * u.K)
+    table = c.distance_table(cosmo)
+    # Redshifts on and between the nodes, near zero and beyond the table
+    z = np.concatenate([[0.0, 1e-6, 1e-3], np.geomspace(0.01, 20.0, 500), [25.0]])
+
+    distance = table(z)
+
+    assert distance.unit == u.Mpc
+    np.testing.assert_allclose(
+        distance.value, cosmo.luminosity_distance(z).to_value(u.Mpc), rtol=1e-6
+    )
+    assert np.isclose(table(0.5), cosmo.luminosity_distance(0.5), rtol=1e-6)
+    assert c.distance_table(cosmo) is table
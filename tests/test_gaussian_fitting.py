@@ -0,0 +1,358 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.cosmology import FlatLambdaCDM
+
+import gleam.gaussian_fitting as gf
+import gleam.native_fitting as nf
+
+
+def spectrum():
+    """
+    Two emission lines on a flat continuum, with fixed noise
+    """
+    rng = np.random.default_rng(1)
+    x = np.linspace(6480.0, 6650.0, 2000)
+    error = np.full_like(x, 0.2)
+    y = (
+        1.0
+        + 3.0 * nf.unit_gaussian(x, 6565.1, 0.6)
+        + 1.0 * nf.unit_gaussian(x, 6585.6, 0.6)
+        + rng.normal(0.0, 1.0, x.size) * error
+    )
+    return x, y, error
+
+
+@pytest.mark.parametrize("engine", ["lmfit", "native"])
+def test_fits_stopped_by_max_nfev_are_not_good(engine):
+    x, y, error = spectrum()
+    wl_line = np.array([6564.61, 6585.27])
+    limits = gf.FitLimits(max_nfev=3)
+    model = gf.fit_model(
+        0.0, x, y, error, wl_line, "free", False, 70.0, 3.0, 1.4, engine, max_nfev=3
+    )
+    limits.check_fit(model)
+
+    assert limits.reached == "max_nfev"
+    assert not model.success and not model.errorbars
+    assert not gf.is_good(model, 3)
+
+    model = gf.fit_model(
+        0.0, x, y, error, wl_line, "free", False, 70.0, 3.0, 1.4, engine
+    )
+    assert model.success and gf.is_good(model, 3)
+
+
+@pytest.mark.parametrize("engine", ["lmfit", "native"])
+def test_invalid_data_stops_both_engines(engine, capsys):
+    x, y, error = spectrum()
+    y[100] = np.nan
+    with pytest.raises(SystemExit):
+        gf.fit_model(
+            0.0, x, y, error, np.array([6564.61]), "free", False, 70.0, 3.0, 1.4, engine
+        )
+    assert "No model could be fit" in capsys.readouterr().out
+
+
+def search(method, engine, wl_line, x, y, error, parallel=False):
+    return method(
+        0.0,
+        x,
+        y,
+        error,
+        wl_line,
+        "constrained",
+        False,
+        70.0,
+        3.0,
+        3,
+        1.4,
+        engine,
+        "free",
+        "independent",
+        None,
+        parallel,
+        None,
+        gf.FitLimits(),
+        "double",
+        None,
+    )
+
+
+@pytest.mark.parametrize("engine", ["lmfit", "native"])
+def test_backward_elimination_drops_the_undetected_line(engine):
+    x, y, error = spectrum()
+    wl_line = np.array([6549.86, 6564.61, 6585.27])
+    selected, model = search(gf.backward_elimination, engine, wl_line, x, y, error)
+    expected, reference = search(gf.exhaustive_search, engine, wl_line, x, y, error)
+
+    assert selected == expected == (1, 2)
+    for name in ("g0_amplitude", "g0_center", "g1_amplitude", "g1_center", "c"):
+        assert np.isclose(
+            model.params[name].value,
+            reference.params[name].value,
+            atol=1e-3 * reference.params[name].stderr,
+        ), name
+
+
+def test_warm_start_drops_a_line():
+    x, y, error = spectrum()
+    model = gf.fit_model(
+        0.0, x, y, error, np.array([6564.61, 6585.27]), "free", False, 70.0, 3.0, 1.4
+    )
+    init = gf.warm_start(model.params, 2, 0)
+
+    assert set(init) == {"c", "g0_amplitude", "g0_center", "g0_sigma"}
+    assert init["g0_center"] == model.params["g1_center"].value
+    assert init["c"] == model.params["c"].value
+
+
+def test_linear_models_keep_the_chosen_engine():
+    x, y, error = spectrum()
+    wl_line = np.array([6564.61, 6585.27])
+    fits = {
+        engine: gf.fit_model(
+            0.0,
+            x,
+            y,
+            error,
+            wl_line,
+            "fixed",
+            False,
+            70.0,
+            3.0,
+            1.4,
+            engine,
+            sigma_constraint="fixed",
+        )
+        for engine in ("lmfit", "native")
+    }
+
+    assert isinstance(fits["lmfit"], gf.ModelResult)
+    assert isinstance(fits["native"], nf.NativeResult)
+    for name in ("g0_amplitude", "g1_amplitude", "c"):
+        assert np.isclose(
+            fits["native"].params[name].value,
+            fits["lmfit"].params[name].value,
+            atol=1e-3 * fits["lmfit"].params[name].stderr,
+        ), name
+
+
+def test_moment_guess_recovers_isolated_lines():
+    x = np.linspace(6480.0, 6650.0, 2000)
+    y = 2.0 + 5.0 * np.exp(-((x - 6565.3) ** 2) / (2 * 0.8 ** 2))
+    y -= 3.0 * np.exp(-((x - 6600.2) ** 2) / (2 * 0.8 ** 2))
+    wl_line = np.array([6564.61, 6600.0])
+    height, center, sigma, continuum = gf.moment_guess(
+        x, y, wl_line, 3.0, wl_line - 3.0, wl_line + 3.0, "free"
+    )
+
+    assert np.isclose(continuum, 2.0)
+    assert np.allclose(height, [5.0, -3.0], rtol=1e-3)
+    assert np.allclose(center, [6565.3, 6600.2], atol=0.01)
+    assert np.allclose(sigma, 0.8, rtol=0.05)
+
+
+def test_moment_guess_without_pixels_near_the_line():
+    x = np.linspace(6480.0, 6550.0, 500)
+    y = np.full_like(x, 2.0)
+    height, center, sigma, _ = gf.moment_guess(
+        x, y, np.array([6564.61]), 1.4, np.array([6562.0]), np.array([6567.0]), "fixed"
+    )
+
+    assert np.isfinite(height).all()
+    assert center[0] == 6564.61
+    assert np.isclose(sigma[0], 1.4 / (2 * np.sqrt(2 * np.log(2))))
+
+
+@pytest.mark.parametrize("engine", ["lmfit", "native"])
+def test_tied_kinematics_and_ratios_hold(engine):
+    x, y, error = spectrum()
+    y = y + 0.34 * nf.unit_gaussian(x, 6550.2, 0.6)
+    wl_line = np.array([6549.86, 6564.61, 6585.27])
+    model = gf.fit_model(
+        0.0,
+        x,
+        y,
+        error,
+        wl_line,
+        "constrained",
+        False,
+        70.0,
+        3.0,
+        1.4,
+        engine,
+        kinematics="tied",
+        ratios={6549.86: (6585.27, 0.34)},
+    )
+    params = model.params
+
+    assert model.success
+    for i in (1, 2):
+        ratio = wl_line[i] / wl_line[0]
+        assert np.isclose(
+            params[f"g{i}_center"].value, ratio * params["g0_center"].value
+        )
+        assert np.isclose(params[f"g{i}_sigma"].value, ratio * params["g0_sigma"].value)
+    assert np.isclose(params["g0_amplitude"].value, 0.34 * params["g2_amplitude"].value)
+
+
+def dense_matched_filter(x, y, error, wl_line, lower, upper, continuum, widths):
+    """
+    Matched filter with one dense row of Gaussian weights per center
+    """
+    weights = 1.0 / error ** 2
+    centers = np.concatenate([wl_line, x])
+    significance = np.max(
+        [
+            np.abs(g @ (weights * (y - continuum))) / np.sqrt(g ** 2 @ weights)
+            for g in (
+                nf.unit_gaussian(x[None, :], centers[:, None], width)
+                for width in widths
+            )
+        ],
+        axis=0,
+    )
+    allowed = (centers[None, :] >= lower[:, None]) & (
+        centers[None, :] <= upper[:, None]
+    )
+    return np.max(np.where(allowed, significance[None, :], 0.0), axis=1)
+
+
+@pytest.mark.parametrize("sigma_constraint", ["free", "fixed"])
+def test_matched_filter_matches_dense_filter(sigma_constraint):
+    x, y, error = spectrum()
+    # A window with a gap, as left by a masked line
+    keep = (x > 6540.0) & (x < 6610.0) & ~((x > 6575.0) & (x < 6580.0))
+    x, y, error = x[keep], y[keep], error[keep]
+    wl_line = np.array([6549.86, 6564.61, 6585.27])
+    significance = gf.matched_filter_significance(
+        x, y, error, wl_line, "constrained", sigma_constraint, 20.0, 3.0, 1.4
+    )
+
+    *_, continuum = gf.moment_guess(
+        x, y, wl_line, 1.4, wl_line - 3.0, wl_line + 3.0, sigma_constraint
+    )
+    sigma = 1.4 / (2 * np.sqrt(2 * np.log(2)))
+    widths = (sigma,) if sigma_constraint == "fixed" else (sigma, 2 * sigma)
+    expected = dense_matched_filter(
+        x, y, error, wl_line, wl_line - 3.0, wl_line + 3.0, continuum, widths
+    )
+    assert np.allclose(significance, expected, rtol=1e-3)
+    assert significance[1] > 10 and significance[0] < 5
+
+
+@pytest.mark.parametrize("engine", ["lmfit", "native"])
+def test_parallel_search_selects_the_same_model(engine):
+    x, y, error = spectrum()
+    wl_line = np.array([6549.86, 6564.61, 6585.27])
+    selected, model = search(
+        gf.exhaustive_search, engine, wl_line, x, y, error, parallel=True
+    )
+    expected, reference = search(gf.exhaustive_search, engine, wl_line, x, y, error)
+
+    assert selected == expected
+    for name in reference.params:
+        assert np.isclose(
+            model.params[name].value, reference.params[name].value, rtol=1e-6
+        ), name
+
+
+@pytest.mark.parametrize("shift", [0.0, 1.0])
+def test_shifted_lines_need_wider_centers(shift):
+    rng = np.random.default_rng(2)
+    x = np.linspace(6480.0, 6650.0, 2000)
+    error = np.full_like(x, 0.2)
+    y = 1.0 + 3.0 * nf.unit_gaussian(x, 6564.61 + shift, 0.6)
+    y += rng.normal(0.0, 1.0, x.size) * error
+    wl_line = np.array([6564.61])
+    model = gf.fit_model(0.0, x, y, error, wl_line, "fixed", False, 70.0, 3.0, 1.4)
+    wider = gf.needs_wider_center(
+        "fixed", ((0,), model), x, y, error, wl_line, "free", 70.0, 3.0, 3, 1.4
+    )
+
+    assert wider == (shift > 0)
+
+
+@pytest.mark.parametrize("shift, center", [(0.0, "fixed"), (2.0, "constrained")])
+def test_auto_center_constraint_widens_for_shifted_lines(shift, center):
+    rng = np.random.default_rng(3)
+    x = np.linspace(6480.0, 6650.0, 2000)
+    error = np.full_like(x, 0.2)
+    y = 1.0 + 3.0 * nf.unit_gaussian(x, 6564.61 + shift, 0.6)
+    y += rng.normal(0.0, 1.0, x.size) * error
+    spectrum_fit = gf.model_selection(
+        0.0,
+        x,
+        y,
+        error,
+        np.array([6564.61]),
+        "auto",
+        False,
+        70.0,
+        3.0,
+        3,
+        1.4,
+        FlatLambdaCDM(H0=70, Om0=0.3),
+        gf.Units(u.Angstrom, u.erg / u.s / u.cm ** 2 / u.Angstrom),
+        x[1] - x[0],
+        "native",
+    )
+
+    (line,) = spectrum_fit.lines
+    assert line.center_constraint == center
+    assert np.isclose(line.wavelength.value.value, 6564.61 + shift, atol=0.05)
+
+
+@pytest.mark.parametrize("engine", ["lmfit", "native"])
+def test_coarse_pass_matches_the_direct_fit(engine):
+    x, y, error = spectrum()
+    wl_line = np.array([6564.61, 6585.27])
+    direct, refined = (
+        gf.fit_model(
+            0.0,
+            x,
+            y,
+            error,
+            wl_line,
+            "free",
+            False,
+            70.0,
+            3.0,
+            1.4,
+            engine,
+            coarse=coarse,
+        )
+        for coarse in (None, 4)
+    )
+
+    assert refined.success and gf.is_good(refined, 3)
+    assert np.isclose(refined.chisqr, direct.chisqr, rtol=1e-6)
+    for name, param in direct.params.items():
+        if param.stderr:
+            assert abs(refined.params[name].value - param.value) < 1e-2 * param.stderr
+
+
+@pytest.mark.parametrize("engine", ["lmfit", "native"])
+@pytest.mark.parametrize("constraint", ["free", "fixed"])
+def test_continuum_offset_is_bounded(engine, constraint):
+    # The continuum is 1, but a global continuum was assumed to account for it
+    x, y, error = spectrum()
+    wl_line = np.array([6564.61, 6585.27])
+    for offset, expected in [(None, 1.0), (0.1, 0.1)]:
+        model = gf.fit_model(
+            0.0,
+            x,
+            y,
+            error,
+            wl_line,
+            constraint,
+            False,
+            70.0,
+            3.0,
+            1.4,
+            engine,
+            sigma_constraint=constraint,
+            offset=offset,
+        )
+        assert np.isclose(model.params["c"].value, expected, rtol=0.02)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+import gleam.kernels as kernels
+import gleam.native_fitting as nf
+import gleam.spectra_operations as so
+
+pytest.importorskip("numba")
+
+
+@pytest.fixture
+def batch():
+    rng = np.random.default_rng(2)
+    nbatch, n, npix = 4, 3, 300
+    p = nf.pack_parameters(
+        rng.uniform(-2, 5, (nbatch, n)),
+        rng.uniform(4900, 5100, (nbatch, n)),
+        rng.uniform(0.5, 8, (nbatch, n)),
+        rng.uniform(-1, 1, nbatch),
+    )
+    x = np.sort(rng.uniform(4800, 5200, (nbatch, npix)), axis=1)
+    y = rng.normal(0, 1, (nbatch, npix))
+    weights = rng.uniform(0.1, 3, (nbatch, npix))
+    return x, y, weights, p
+
+
+@pytest.mark.parametrize("dtype, rtol", [(np.float64, 1e-10), (np.float32, 1e-4)])
+def test_numba_kernels_match_numpy(batch, dtype, rtol):
+    x, y, weights, p = batch
+    x, y, weights = x.astype(dtype), y.astype(dtype), weights.astype(dtype)
+    kernels.use("numpy")
+    model, jacobian = nf.model_and_jacobian(x, p)
+    residual = nf.weighted_residual(y, model, weights)
+
+    numba_model, numba_jacobian = kernels.model_and_jacobian(x, p)
+    atol = rtol * np.abs(jacobian).max()
+    np.testing.assert_allclose(numba_model, model, rtol=rtol, atol=atol)
+    np.testing.assert_allclose(numba_jacobian, jacobian, rtol=rtol, atol=atol)
+    np.testing.assert_allclose(
+        kernels.gaussian_model(x, p), model, rtol=rtol, atol=atol
+    )
+    np.testing.assert_allclose(
+        kernels.weighted_residual(y, model, weights), residual, rtol=rtol, atol=atol
+    )
+
+
+@pytest.mark.parametrize("closed", [False, True])
+def test_numba_masks_match_numpy(closed):
+    rng = np.random.default_rng(3)
+    lower = np.sort(rng.uniform(4800, 5200, 20))
+    upper = lower + rng.uniform(0, 15, 20)
+    # Include positions that fall exactly on the ends of the intervals
+    x = np.sort(np.concatenate([rng.uniform(4800, 5200, 500), lower, upper]))
+    kernels.use("numpy")
+    np.testing.assert_array_equal(
+        kernels.outside_intervals(x, lower, upper, closed),
+        so.outside_intervals(x, lower, upper, closed),
+    )
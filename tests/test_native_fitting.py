@@ -0,0 +1,99 @@
+import numpy as np
+from lmfit.models import GaussianModel, ConstantModel
+
+import gleam.native_fitting as nf
+
+
+def problem():
+    """
+    A single emission line on a flat continuum, with fixed noise
+    """
+    rng = np.random.default_rng(0)
+    x = np.linspace(4900.0, 5100.0, 401)
+    error = np.full_like(x, 2.0)
+    y = (
+        150.0 * nf.unit_gaussian(x, 5007.0, 3.0)
+        + 10.0
+        + rng.normal(0.0, 1.0, x.size) * error
+    )
+    return x, y, error
+
+
+def native_fit(x, y, error, max_nfev=None):
+    p0 = nf.pack_parameters([120.0], [5005.0], [4.0], 8.0)
+    lower = nf.pack_parameters([-np.inf], [-np.inf], [0.0], -np.inf)
+    upper = np.full_like(p0, np.inf)
+    batch = nf.levenberg_marquardt(
+        x[None],
+        y[None],
+        1.0 / error[None],
+        p0,
+        lower,
+        upper,
+        np.ones_like(p0, bool),
+        max_nfev=max_nfev,
+    )
+    return nf.NativeResult.from_batch(batch, 0)
+
+
+def test_matches_lmfit():
+    x, y, error = problem()
+    model = GaussianModel(prefix="g0_") + ConstantModel()
+    params = model.make_params(
+        g0_amplitude=120.0, g0_center=5005.0, g0_sigma=4.0, c=8.0
+    )
+    expected = model.fit(y, params, x=x, weights=1.0 / error)
+    result = native_fit(x, y, error)
+
+    assert result.success and result.errorbars and not result.aborted
+    for name in ("g0_amplitude", "g0_center", "g0_sigma", "g0_height", "g0_fwhm", "c"):
+        assert np.isclose(
+            result.params[name].value, expected.params[name].value, rtol=1e-6
+        ), name
+        assert np.isclose(
+            result.params[name].stderr, expected.params[name].stderr, rtol=1e-3
+        ), name
+    assert np.isclose(result.chisqr, expected.chisqr, rtol=1e-8)
+
+
+def test_unconverged_fit_has_no_errorbars():
+    x, y, error = problem()
+    result = native_fit(x, y, error, max_nfev=2)
+
+    assert result.aborted and not result.success
+    assert not result.errorbars
+    assert all(param.stderr is None for param in result.params.values())
+
+
+def coarse_problem(x, y, error, coarse):
+    return nf.Problem(
+        x=x,
+        y=y,
+        weights=1.0 / error,
+        p0=nf.pack_parameters([120.0], [5005.0], [4.0], 8.0)[0],
+        lower=nf.pack_parameters([-np.inf], [-np.inf], [0.0], -np.inf)[0],
+        upper=np.full(4, np.inf),
+        vary=np.ones(4, bool),
+        coarse=coarse,
+    )
+
+
+def test_coarse_pass_keeps_the_direct_fit():
+    x, y, error = problem()
+    (direct,) = nf.solve([coarse_problem(x, y, error, 1)])
+    (refined,) = nf.solve([coarse_problem(x, y, error, 4)])
+
+    assert refined.success and refined.errorbars
+    for name in ("g0_amplitude", "g0_center", "g0_sigma", "c"):
+        # Same minimum, to well within the uncertainties
+        assert abs(refined.params[name].value - direct.params[name].value) < (
+            1e-3 * direct.params[name].stderr
+        ), name
+
+
+def test_coarse_pass_shares_max_nfev():
+    x, y, error = problem()
+    (result,) = nf.solve([coarse_problem(x, y, error, 4)], max_nfev=3)
+
+    assert result.aborted and not result.errorbars
+    assert result.nfev >= 3
@@ -0,0 +1,99 @@
+import numpy as np
+from astropy import units as u
+from astropy.io import fits
+from astropy.table import QTable, Table
+
+import gleam
+import gleam.read_files as rf
+
+
+def write_spectrum(path, wl):
+    spectrum = QTable()
+    spectrum["wl"] = wl * u.AA
+    spectrum["flux"] = np.ones_like(wl) * u.erg / u.s / u.cm ** 2 / u.AA
+    spectrum["stdev"] = np.ones_like(wl) * u.erg / u.s / u.cm ** 2 / u.AA
+    spectrum.write(path)
+
+
+def test_spectral_range_of_unsorted_spectrum(tmp_path):
+    # Two arms, the red one first
+    wl = np.concatenate([np.arange(6000.0, 8000.0, 2.0), np.arange(4000.0, 6000.0)])
+    write_spectrum(tmp_path / "spec1d.fits", wl)
+
+    spectral_range = rf.read_spectral_range(tmp_path / "spec1d.fits")
+
+    assert u.allclose(spectral_range, [3999.5, 7999.0] * u.AA)
+
+
+def test_spectral_range_from_the_header(tmp_path):
+    write_spectrum(tmp_path / "spec1d.fits", np.arange(4000.0, 6001.0, 2.0))
+    # The header takes precedence over the wavelengths
+    fits.setval(tmp_path / "spec1d.fits", "TDMIN1", value=5000.0, ext=1)
+    fits.setval(tmp_path / "spec1d.fits", "TDMAX1", value=7000.0, ext=1)
+
+    spectral_range = rf.read_spectral_range(tmp_path / "spec1d.fits")
+
+    assert u.allclose(spectral_range, [4999.0, 7001.0] * u.AA)
+
+
+def test_spectrum_with_one_pixel_covers_nothing(tmp_path):
+    write_spectrum(tmp_path / "spec1d.fits", np.array([5000.0]))
+
+    low, high = rf.read_spectral_range(tmp_path / "spec1d.fits").to_value(u.AA)
+
+    assert low > high
+
+
+def assert_same_table(table, expected):
+    assert table.colnames == expected.colnames
+    for name in expected.colnames:
+        assert table[name].unit == expected[name].unit
+        np.testing.assert_array_equal(table[name].value, expected[name].value)
+
+
+def test_mapped_spectrum_matches_qtable_read(tmp_path):
+    rng = np.random.default_rng(4)
+    write_spectrum(tmp_path / "spec1d.fits", np.sort(rng.uniform(4000, 6000, 500)))
+
+    spectrum = rf.read_spectrum(tmp_path / "spec1d.fits")
+
+    assert not spectrum["wl"].flags.owndata
+    assert_same_table(spectrum, QTable.read(tmp_path / "spec1d.fits"))
+
+
+def test_spectrum_with_nan_is_read_with_qtable_read(tmp_path):
+    wl = np.arange(4000.0, 6000.0, 2.0)
+    wl[10] = np.nan
+    write_spectrum(tmp_path / "spec1d.fits", wl)
+
+    spectrum = rf.read_spectrum(tmp_path / "spec1d.fits")
+
+    assert_same_table(spectrum, QTable.read(tmp_path / "spec1d.fits"))
+
+
+def test_packed_spectra_match_qtable_read(tmp_path):
+    rng = np.random.default_rng(5)
+    meta = Table()
+    meta["Setup"] = ["K"] * 3
+    meta["Pointing"] = ["P1"] * 3
+    meta["SourceNumber"] = [1, 2, 3]
+    meta["Sample"] = ["S"] * 3
+    meta["Redshift"] = [0.1, 0.2, 0.3]
+    meta.write(tmp_path / "meta.S.K.P1.dat", format="ascii.commented_header")
+    for number, size in zip(meta["SourceNumber"], [100, 250, 40]):
+        write_spectrum(
+            tmp_path / f"spec1d.S.K.P1.{number:03d}.fits",
+            np.sort(rng.uniform(4000, 6000, size)),
+        )
+    sources = gleam.find_sources(tmp_path, None)
+    # The second block is appended to the pack written with the first
+    rf.pack_spectra(sources[:1], tmp_path / "pack.fits")
+    assert rf.pack_spectra(sources, tmp_path / "pack.fits") == 2
+
+    packed = rf.SpectrumPack.open(tmp_path / "pack.fits").sources()
+
+    assert len(packed) == len(sources)
+    for (spectrum_file, target), (original, _) in zip(packed, sources):
+        assert spectrum_file.path == str(original)
+        assert target["key"] == spectrum_file.key
+        assert_same_table(rf.read_spectrum(spectrum_file), QTable.read(original))
@@ -0,0 +1,197 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.table import QTable
+
+import gleam.spectra_operations as so
+
+
+def test_rebin_conserves_flux():
+    rng = np.random.default_rng(0)
+    wl = np.sort(rng.uniform(4000.0, 5000.0, 200))
+    edges = so.pixel_edges(wl)
+    flux = rng.normal(10.0, 1.0, wl.size)
+    new_edges = np.linspace(edges[0], edges[-1], 37)
+
+    _, new_flux, _ = so.rebin(edges, flux, np.ones_like(flux), new_edges)
+
+    assert np.isclose(
+        np.sum(new_flux * np.diff(new_edges)), np.sum(flux * np.diff(edges))
+    )
+
+
+def test_rebin_keeps_bad_pixels_local():
+    wl = np.arange(100.0)
+    edges = so.pixel_edges(wl)
+    flux, stdev = np.ones(100), np.ones(100)
+    flux[40], stdev[60] = np.nan, np.inf
+
+    _, new_flux, new_stdev = so.rebin(edges, flux, stdev, edges[::3])
+
+    lower, upper = edges[::3][:-1], edges[::3][1:]
+    assert np.array_equal(
+        np.flatnonzero(~np.isfinite(new_flux)),
+        np.flatnonzero((lower < edges[41]) & (upper > edges[40])),
+    )
+    assert np.array_equal(
+        np.flatnonzero(~np.isfinite(new_stdev)),
+        np.flatnonzero((lower < edges[61]) & (upper > edges[60])),
+    )
+    assert np.allclose(new_flux[np.isfinite(new_flux)], 1.0)
+
+
+def dense_selection(wl_rest, wl_selected, wl_other, sky, cont_width, mask_width):
+    # Selection with one full-length mask per line and per sky band
+    selected = np.full(np.shape(wl_rest), False)
+    for line in wl_selected:
+        selected |= so.select_singleline(wl_rest, line, cont_width)
+    for line in wl_other:
+        selected &= so.mask_line(wl_rest, line, mask_width)
+    for lower, upper in zip(sky["wavelength_min"], sky["wavelength_max"]):
+        selected &= ~((wl_rest > lower.value) & (wl_rest < upper.value))
+    return selected
+
+
+def sky_table(rng, n):
+    sky = QTable()
+    lower = rng.uniform(4000.0, 6000.0, n)
+    sky["wavelength_min"] = lower * u.Angstrom
+    sky["wavelength_max"] = (lower + rng.uniform(0.0, 30.0, n)) * u.Angstrom
+    return sky
+
+
+@pytest.mark.parametrize("grid", ["linear", "log", "sorted", "unsorted"])
+def test_select_window_matches_the_mask_selection(grid):
+    rng = np.random.default_rng(4)
+    wl = {
+        "linear": np.linspace(4000.0, 6000.0, 3000),
+        "log": np.geomspace(4000.0, 6000.0, 3000),
+        "sorted": np.sort(rng.uniform(4000.0, 6000.0, 3000)),
+        "unsorted": rng.uniform(4000.0, 6000.0, 3000),
+    }[grid]
+    # Lines on pixels and on the ends of windows, to check the comparisons
+    wavelengths = np.concatenate([rng.uniform(3900.0, 6100.0, 200), wl[::300]])
+    wavelengths[-3:] = wavelengths[-4] + np.array([-70.0, 10.0, 70.0])
+    catalog = so.LineCatalog.from_wavelengths(wavelengths)
+    sky = sky_table(rng, 100)
+    bands = so.sky_bands(so.SkyBands.from_table(sky), 0.0, u.Angstrom)
+
+    assert so.Grid.from_wavelengths(wl).kind == grid
+    groups = [[k] for k in range(0, len(wavelengths), 7)]
+    groups += [[len(wavelengths) - 4, len(wavelengths) - 2], [3, 50, 120]]
+    for group in groups:
+        window, mask = so.select_window(
+            so.Grid.from_wavelengths(wl), catalog, group, bands, 70.0, 20.0
+        )
+        selected = np.full(len(wl), False)
+        selected[window] = mask
+        expected = dense_selection(
+            wl, wavelengths[group], np.delete(wavelengths, group), sky, 70.0, 20.0,
+        )
+        np.testing.assert_array_equal(selected, expected, err_msg=str(group))
+
+
+def test_catalog_finds_the_lines_in_a_range():
+    rng = np.random.default_rng(5)
+    wavelengths = np.round(rng.uniform(4000.0, 6000.0, 300))
+    catalog = so.LineCatalog.from_wavelengths(wavelengths)
+    for lower, upper in rng.choice(wavelengths, (50, 2)):
+        for closed in (False, True):
+            inside = (
+                (wavelengths >= lower) & (wavelengths <= upper)
+                if closed
+                else (wavelengths > lower) & (wavelengths < upper)
+            )
+            np.testing.assert_array_equal(
+                catalog.between(lower, upper, closed), np.flatnonzero(inside)
+            )
+
+
+def test_merged_sky_bands_mask_the_raw_bands():
+    rng = np.random.default_rng(6)
+    sky = sky_table(rng, 500)
+    # Touching, nested and empty bands
+    sky["wavelength_min"][:3] = [4100.0, 4110.0, 4300.0] * u.Angstrom
+    sky["wavelength_max"][:3] = [4110.0, 4105.0, 4300.0] * u.Angstrom
+    bands = so.SkyBands.from_table(sky)
+
+    lower, upper = bands.wavelength_min.value, bands.wavelength_max.value
+    assert np.all(lower[1:] >= upper[:-1])
+    wl = np.sort(
+        np.concatenate(
+            [
+                rng.uniform(3900.0, 6100.0, 5000),
+                sky["wavelength_min"].value,
+                sky["wavelength_max"].value,
+            ]
+        )
+    )
+    raw = np.full(len(wl), True)
+    for low, high in zip(sky["wavelength_min"].value, sky["wavelength_max"].value):
+        raw &= (wl <= low) | (wl >= high)
+    np.testing.assert_array_equal(so.outside_bands(wl, lower, upper), raw)
+
+
+def test_pixel_width_matches_the_dispersion_of_each_window():
+    rng = np.random.default_rng(7)
+    # A spectrum with a gap and a change of dispersion
+    wl = np.concatenate(
+        [np.arange(4000.0, 5000.0, 1.0), np.arange(5200.0, 6000.0, 0.7)]
+    ) + rng.normal(0.0, 0.01, 2143)
+    profile = so.DispersionProfile.from_wavelengths(wl)
+    for start in rng.integers(0, len(wl), 50):
+        window = slice(start, start + rng.integers(2, 300))
+        mask = rng.uniform(size=len(wl[window])) > 0.2
+        if np.sum(mask) < 2:
+            continue
+        assert profile.pixel(window, mask) == so.dispersion(wl[window][mask])
+
+
+def test_global_continuum_follows_a_sloped_continuum():
+    rng = np.random.default_rng(8)
+    wl = np.arange(4000.0, 7000.0, 1.0)
+    continuum = 1.0 + 1e-3 * (wl - 4000.0)
+    catalog = so.LineCatalog.from_wavelengths(np.array([4861.0, 5007.0, 6563.0]))
+    flux = continuum + rng.normal(0.0, 0.05, len(wl))
+    for line in catalog.wavelengths:
+        flux += 20.0 * np.exp(-((wl - line) ** 2) / (2 * 3.0 ** 2))
+    # A sky band full of bad values
+    bands = (np.array([5800.0]), np.array([5900.0]))
+    flux[(wl > 5800.0) & (wl < 5900.0)] = -100.0
+
+    estimate = so.global_continuum(wl, flux, catalog, bands, 70.0, 20.0)
+
+    assert estimate.dtype == flux.dtype
+    # Within the noise of a pixel, away from the ends of the spectrum and from
+    # the masked sky band
+    inner = (wl > 4100.0) & (wl < 6900.0) & ((wl < 5800.0) | (wl > 5900.0))
+    assert np.max(np.abs(estimate - continuum)[inner]) < 0.05
+
+
+def test_bin_spectrum_averages_full_bins_in_single_precision():
+    rng = np.random.default_rng(9)
+    spectrum = QTable()
+    spectrum["wl"] = np.arange(5000.0, 5101.0) * u.Angstrom
+    spectrum["flux"] = rng.normal(1.0, 0.1, 101) * u.erg
+    spectrum["stdev"] = rng.uniform(0.1, 0.2, 101) * u.erg
+
+    binned = so.bin_spectrum(spectrum, 3)
+
+    assert len(binned) == 33
+    for name in ["wl", "flux", "stdev"]:
+        assert binned[name].dtype == np.float32
+    average = so.average_(spectrum["flux"].value[:99], 3)
+    assert np.allclose(binned["wl"].value, so.average_(spectrum["wl"].value[:99], 3))
+    assert np.allclose(binned["flux"].value, average)
+    assert np.allclose(
+        binned["stdev"].value, so.average_err(spectrum["stdev"].value[:99], 3)
+    )
+
+    shuffled = spectrum[rng.permutation(101)]
+    for name in ["wl", "flux", "stdev"]:
+        assert np.array_equal(so.bin_spectrum(shuffled, 3)[name], binned[name])
+
+
+def test_pixel_edges_need_increasing_wavelengths():
+    with pytest.raises(ValueError, match="strictly increasing"):
+        so.pixel_edges(np.array([1.0, 3.0, 2.0]))